@@ -0,0 +1,100 @@
+## Duración de los audios sin decodificarlos, para el cálculo del RTF (Real-Time Factor) en las pipelines y en metrics.py.
+# De los WAV se leen sólo las cabeceras RIFF (chunks `fmt ` y `data`); el resto de contenedores se consultan con ffprobe.
+# Las duraciones se guardan en un pequeño índice por carpeta de dataset (`.durations.json`), válido mientras no cambien
+# el tamaño ni la fecha de modificación del audio.
+import json
+import os
+import shutil
+import struct
+import subprocess
+
+DURATION_INDEX_FILE = ".durations.json"
+
+_indexes = {}  # Índices ya leídos, por carpeta
+
+
+def wav_header_duration(wav_file_path):
+    with open(wav_file_path, 'rb') as wav_file:
+        riff, _, wave = struct.unpack('<4sI4s', wav_file.read(12))
+        if riff not in (b'RIFF', b'RF64') or wave != b'WAVE':
+            return None
+        byte_rate = None
+        while True:
+            chunk_header = wav_file.read(8)
+            if len(chunk_header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                fmt = wav_file.read(chunk_size)
+                byte_rate = struct.unpack('<I', fmt[8:12])[0]
+                if chunk_size % 2:
+                    wav_file.seek(1, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                if not byte_rate:
+                    return None
+                # Algunos escritores en streaming dejan el tamaño sin rellenar: se toma lo que queda de archivo
+                if chunk_size in (0, 0xFFFFFFFF):
+                    chunk_size = os.path.getsize(wav_file_path) - wav_file.tell()
+                return chunk_size / byte_rate
+            else:
+                wav_file.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+def ffprobe_duration(audio_file_path):
+    ffprobe_path = shutil.which("ffprobe")
+    if ffprobe_path is None:
+        return None
+    result = subprocess.run([ffprobe_path, "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1",
+                             audio_file_path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        return float(result.stdout.decode('utf-8').strip())
+    except ValueError:
+        return None
+
+def _probe_duration(audio_file_path):
+    duration = None
+    if audio_file_path.lower().endswith(".wav"):
+        try:
+            duration = wav_header_duration(audio_file_path)
+        except struct.error:
+            duration = None
+    if duration is None:
+        duration = ffprobe_duration(audio_file_path)
+    if duration is None:
+        # Último recurso, decodificar el audio completo
+        from pydub import AudioSegment
+        duration = AudioSegment.from_file(audio_file_path).duration_seconds
+    return duration
+
+def _load_index(folder):
+    if folder not in _indexes:
+        _indexes[folder] = {}
+        index_path = os.path.join(folder, DURATION_INDEX_FILE)
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'r', encoding="utf-8") as index_file:
+                    _indexes[folder] = json.load(index_file)
+            except (OSError, ValueError):
+                _indexes[folder] = {}
+    return _indexes[folder]
+
+def _save_index(folder):
+    index_path = os.path.join(folder, DURATION_INDEX_FILE)
+    try:
+        with open(index_path + f'.{os.getpid()}.tmp', 'w', encoding="utf-8") as index_file:
+            json.dump(_indexes[folder], index_file)
+        os.replace(index_path + f'.{os.getpid()}.tmp', index_path)
+    except OSError:
+        pass  # El índice es sólo una caché, si la carpeta no admite escritura se vuelve a medir la próxima vez
+
+## Duración en segundos del audio, del índice de su carpeta si el archivo no ha cambiado o midiéndola si no
+def get_duration(audio_file_path):
+    folder, audio_file = os.path.split(os.path.abspath(audio_file_path))
+    stat = os.stat(audio_file_path)
+    index = _load_index(folder)
+    indexed = index.get(audio_file)
+    if indexed is not None and indexed[0] == stat.st_size and indexed[1] == stat.st_mtime:
+        return indexed[2]
+    duration = _probe_duration(audio_file_path)
+    index[audio_file] = [stat.st_size, stat.st_mtime, duration]
+    _save_index(folder)
+    return duration
@@ -0,0 +1,120 @@
+## Segmentación por lotes de varios archivos para la pipeline de Pyannote.
+# Pyannote desliza el modelo de segmentación sobre cada audio por separado: con muchos audios cortos cada archivo aporta pocos
+# fragmentos (y el último, incompleto, va siempre en un lote propio), así que los lotes salen casi vacíos y la CPU queda infrautilizada.
+# Aquí se cortan en fragmentos todos los audios de un bloque con la misma ventana deslizante que usa Pyannote, se juntan en lotes
+# de tamaño fijo, se pasa cada lote por el modelo (también los modelos de diarizers convertidos con `to_pyannote_model()`) y la salida
+# se reparte de nuevo por archivo. La pipeline recoge después la segmentación de cada archivo en `get_segmentations`, por lo que
+# con CachedSpeakerDiarization también se guarda en la caché de disco.
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from pyannote.core import SlidingWindow, SlidingWindowFeature
+
+DEFAULT_BATCH_SIZE = 32
+
+
+class BatchedSegmentationInference():
+
+    def __init__(self, inference, batch_size=DEFAULT_BATCH_SIZE):
+        # Se guardan con object.__setattr__ porque el resto de atributos se delegan en el Inference de Pyannote
+        object.__setattr__(self, "inference", inference)
+        object.__setattr__(self, "chunk_batch_size", batch_size)
+        object.__setattr__(self, "precomputed", {})
+
+    def __getattr__(self, name):
+        return getattr(self.inference, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.inference, name, value)
+
+    ## Sólo se pueden agrupar fragmentos de varios archivos si la salida del modelo no se agrega por archivo (la segmentación de
+    # SpeakerDiarization usa skip_aggregation) y es única, no una tupla de salidas
+    def supports_batching(self):
+        return self.inference.window == "sliding" and self.inference.skip_aggregation and \
+            not isinstance(self.inference.model.specifications, tuple)
+
+    ## Fragmentos de la ventana deslizante de un audio, igual que `Inference.slide`: los completos y, si sobra audio, un último
+    # fragmento rellenado con ceros
+    def _chunks(self, waveform, sample_rate):
+        window_size = self.inference.model.audio.get_num_samples(self.inference.duration)
+        step_size = round(self.inference.step * sample_rate)
+        _, num_samples = waveform.shape
+        chunks = []
+        num_chunks = 0
+        if num_samples >= window_size:
+            chunks.append(waveform.unfold(1, window_size, step_size).permute(1, 0, 2))
+            num_chunks = chunks[0].shape[0]
+        if num_samples < window_size or (num_samples - window_size) % step_size > 0:
+            last_chunk = waveform[:, num_chunks * step_size:]
+            chunks.append(F.pad(last_chunk, (0, window_size - last_chunk.shape[1]))[None])
+        return torch.cat(chunks)
+
+    ## Calcula la segmentación de los archivos (diccionarios de Pyannote con "audio") en lotes compartidos y la deja preparada
+    # para cuando la pipeline la pida. Los fragmentos de cada archivo se leen a medida que hacen falta para llenar los lotes.
+    # Devuelve el tiempo empleado repartido entre los archivos en proporción a sus fragmentos, para imputarlo a su RTF.
+    def precompute(self, files):
+        if not self.supports_batching():
+            return {}
+        start_time = time.time()
+        pending, outputs, chunk_counts = [], {}, {}
+        buffered = 0
+        for file in files:
+            waveform, sample_rate = self.inference.model.audio(file)
+            chunks = self._chunks(waveform, sample_rate)
+            key = self._key(file)
+            chunk_counts[key] = chunks.shape[0]
+            outputs[key] = []
+            pending.append((key, chunks))
+            buffered += chunks.shape[0]
+            while buffered >= self.chunk_batch_size:
+                buffered -= self._infer_batch(pending, outputs)
+        while pending:
+            self._infer_batch(pending, outputs)
+        frames = SlidingWindow(start=0.0, duration=self.inference.duration, step=self.inference.step)
+        for key, batch_outputs in outputs.items():
+            self.precomputed[key] = SlidingWindowFeature(np.vstack(batch_outputs), frames)
+        elapsed = time.time() - start_time
+        total_chunks = sum(chunk_counts.values())
+        return {key: elapsed * count / total_chunks for key, count in chunk_counts.items()} if total_chunks else {}
+
+    ## Toma hasta `chunk_batch_size` fragmentos de la cola (pueden ser de varios archivos), los infiere juntos y reparte la salida
+    # entre sus archivos. Devuelve cuántos fragmentos ha procesado.
+    def _infer_batch(self, pending, outputs):
+        batch, owners = [], []
+        size = 0
+        while pending and size < self.chunk_batch_size:
+            key, chunks = pending[0]
+            taken = chunks[:self.chunk_batch_size - size]
+            batch.append(taken)
+            owners.append((key, taken.shape[0]))
+            size += taken.shape[0]
+            if taken.shape[0] == chunks.shape[0]:
+                pending.pop(0)
+            else:
+                pending[0] = (key, chunks[taken.shape[0]:])
+        batch_outputs = self.inference.infer(torch.cat(batch))
+        start = 0
+        for key, count in owners:
+            outputs[key].append(batch_outputs[start:start + count])
+            start += count
+        return size
+
+    @staticmethod
+    def _key(file):
+        return str(file["audio"])
+
+    def __call__(self, file, hook=None):
+        segmentations = self.precomputed.pop(self._key(file), None) if "audio" in file else None
+        if segmentations is None:
+            return self.inference(file, hook=hook)
+        if hook is not None:
+            hook(completed=segmentations.data.shape[0], total=segmentations.data.shape[0])
+        return segmentations
+
+
+## Sustituye la segmentación de la pipeline por la versión por lotes (una sola vez) y la devuelve
+def enable_batched_segmentation(pipeline, batch_size=DEFAULT_BATCH_SIZE):
+    if not isinstance(pipeline._segmentation, BatchedSegmentationInference):
+        pipeline._segmentation = BatchedSegmentationInference(pipeline._segmentation, batch_size)
+    return pipeline._segmentation
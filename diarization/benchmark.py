@@ -0,0 +1,381 @@
+## Benchmark reproducible de velocidad de las pipelines de Pyannote y de NeMo en CPU, dentro del propio proceso.
+# Usa un corpus sintético fijo (generado con semilla: hablantes con voces armónicas distintas, turnos de duración aleatoria, silencios
+# y algún solapamiento, a las duraciones pedidas) o una carpeta de WAV indicada. Mide por etapa (carga de modelos y diarización de
+# cada archivo) el tiempo real, el tiempo de CPU, el pico de memoria residente y el RTF, y añade cada ejecución como una línea al
+# archivo de resultados versionado (`<volumen>/benchmark/benchmark_results.jsonl`), con la versión del esquema, el commit y las
+# versiones de los paquetes. Con --compare se compara con la última ejecución equivalente (misma pipeline, modelos, parámetros y
+# corpus) y termina con error si alguna etapa es más lenta que la tolerancia.
+#
+# La pipeline de Pyannote y la de NeMo están en contenedores distintos, así que cada ejecución mide una de las dos (--pipeline).
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import threading
+import time
+import wave
+from datetime import datetime
+import numpy as np
+from dataset_scan import scan_by_extension
+from audio_duration import get_duration
+
+SCHEMA_VERSION = 1
+BENCHMARK_FOLDER = "benchmark"
+BENCHMARK_RESULTS_FILE = "benchmark_results.jsonl"
+CORPUS_MANIFEST_FILE = "corpus.json"
+SYNTHETIC_DATASET = "synthetic"
+PATH_BASE_DATASETS = "datasets"
+SAMPLE_RATE = 16000
+DEFAULT_DURATIONS = [60, 300, 900]   # Segundos de cada audio del corpus sintético
+DEFAULT_NUM_SPEAKERS = [2, 3, 4]     # Hablantes de cada audio, en el mismo orden que las duraciones (se repite si hay menos)
+DEFAULT_SEED = 1234
+REGRESSION_TOLERANCE = 0.15          # Aumento relativo máximo del tiempo de una etapa respecto de la ejecución anterior
+RSS_SAMPLE_INTERVAL = 0.05
+MODEL_LOAD_STAGE = "model_load"
+DIARIZATION_STAGE = "diarization"
+
+
+## Memoria residente actual del proceso en MB (Linux), o None si no se puede leer
+def _current_rss_mb():
+    try:
+        with open("/proc/self/statm", 'r') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+## Mide una etapa: tiempo real, tiempo de CPU del proceso (todos los hilos) y pico de memoria residente durante la etapa, que se
+# muestrea en un hilo aparte. Si no hay /proc se usa el pico del proceso hasta el final de la etapa.
+class StageMeter():
+
+    def __init__(self, stage, file=None, audio_duration=0.0):
+        self.record = {"stage": stage, "file": file, "audio_duration": audio_duration}
+        self._peak_rss = 0.0
+        self._stop = threading.Event()
+
+    def _sample_rss(self):
+        while not self._stop.wait(RSS_SAMPLE_INTERVAL):
+            self._peak_rss = max(self._peak_rss, _current_rss_mb() or 0.0)
+
+    def __enter__(self):
+        self._peak_rss = _current_rss_mb() or 0.0
+        self._sampler = threading.Thread(target=self._sample_rss, daemon=True)
+        self._sampler.start()
+        self._start_wall, self._start_cpu = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall_time, cpu_time = time.perf_counter() - self._start_wall, time.process_time() - self._start_cpu
+        self._stop.set()
+        self._sampler.join()
+        current_rss = _current_rss_mb()
+        if current_rss is None:
+            self._peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        else:
+            self._peak_rss = max(self._peak_rss, current_rss)
+        duration = self.record["audio_duration"]
+        self.record.update({"wall_time": wall_time, "cpu_time": cpu_time, "peak_rss_mb": self._peak_rss,
+                            "rtf": wall_time / duration if duration else None})
+        return False
+
+
+## Voz sintética de un hablante: armónicos de su f0 (con vibrato) modelados por dos formantes que cambian en cada sílaba
+def _synthesize_turn(rng, speaker, duration):
+    num_samples = int(duration * SAMPLE_RATE)
+    signal = np.zeros(num_samples, dtype=np.float64)
+    position = 0
+    while position < num_samples:
+        syllable = int(rng.uniform(0.6, 1.4) / speaker["rate"] * SAMPLE_RATE)
+        end = min(position + syllable, num_samples)
+        t = np.arange(end - position) / SAMPLE_RATE
+        f0 = speaker["f0"] * (1 + 0.03 * np.sin(2 * np.pi * 5 * t) + rng.normal(0, 0.02))
+        phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+        formants = (rng.uniform(300, 850) * speaker["formant_shift"], rng.uniform(900, 2300) * speaker["formant_shift"])
+        syllable_signal = np.zeros(end - position)
+        for harmonic in range(1, int(4000 / speaker["f0"]) + 1):
+            frequency = harmonic * speaker["f0"]
+            amplitude = sum(np.exp(-((frequency - formant) / 150) ** 2) for formant in formants) + 0.05
+            syllable_signal += amplitude / harmonic * np.sin(harmonic * phase)
+        signal[position:end] = syllable_signal * np.hanning(end - position) ** 0.5
+        position = end
+        if rng.random() < 0.15:  # Pausa breve entre palabras
+            position += int(0.15 * SAMPLE_RATE)
+    return speaker["loudness"] * signal / max(np.abs(signal).max(), 1e-9)
+
+## Audio sintético de `duration` segundos y `num_speakers` hablantes, con sus turnos de referencia (inicio, fin, hablante)
+def synthesize_audio(rng, duration, num_speakers):
+    speakers = [{"f0": rng.uniform(90, 260), "formant_shift": rng.uniform(0.85, 1.2), "rate": rng.uniform(3, 6),
+                 "loudness": rng.uniform(0.3, 0.6)} for _ in range(num_speakers)]
+    audio = rng.normal(0, 0.003, int(duration * SAMPLE_RATE))
+    turns = []
+    start, previous = 0.5, None
+    while start < duration - 1.0:
+        speaker = rng.choice([index for index in range(num_speakers) if index != previous])
+        end = min(start + rng.exponential(4.0) + 0.8, duration - 0.5)
+        turn_signal = _synthesize_turn(rng, speakers[speaker], end - start)
+        first = int(start * SAMPLE_RATE)
+        audio[first:first + len(turn_signal)] += turn_signal
+        turns.append((start, end, f"spk{speaker}"))
+        previous = speaker
+        # Algún turno empieza antes de que acabe el anterior, para que haya solapamientos
+        start = end - rng.uniform(0.3, 0.8) if rng.random() < 0.1 else end + rng.uniform(0.1, 0.8)
+    return np.clip(audio, -1, 1), turns
+
+def _write_wav(wav_file_path, audio):
+    with wave.open(wav_file_path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes((audio * 32767).astype('<i2').tobytes())
+
+def _file_hash(file_path):
+    with open(file_path, 'rb') as audio_file:
+        return hashlib.sha1(audio_file.read()).hexdigest()
+
+## Genera (o reutiliza si ya existe con los mismos parámetros) el corpus sintético en `<benchmark>/datasets/synthetic`, con los RTTM
+# de referencia en `<benchmark>/rttm_ref/synthetic`. Devuelve el manifiesto del corpus.
+def generate_synthetic_corpus(benchmark_path, durations=DEFAULT_DURATIONS, num_speakers=DEFAULT_NUM_SPEAKERS, seed=DEFAULT_SEED):
+    datasets_path = os.path.join(benchmark_path, PATH_BASE_DATASETS, SYNTHETIC_DATASET)
+    manifest_path = os.path.join(benchmark_path, CORPUS_MANIFEST_FILE)
+    params = {"durations": list(durations), "num_speakers": list(num_speakers), "seed": seed, "sample_rate": SAMPLE_RATE}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest["params"] == params and all(os.path.exists(os.path.join(datasets_path, entry["file"])) for entry in manifest["files"]):
+            return manifest
+    reference_path = os.path.join(benchmark_path, "rttm_ref", SYNTHETIC_DATASET)
+    os.makedirs(datasets_path, exist_ok=True)
+    os.makedirs(reference_path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    files = []
+    for index, duration in enumerate(durations):
+        speakers = num_speakers[index % len(num_speakers)]
+        uri = f"synth_{int(duration):05d}s_{speakers}spk"
+        print(f"Generando el audio sintético {uri}")
+        audio, turns = synthesize_audio(rng, duration, speakers)
+        _write_wav(os.path.join(datasets_path, uri + ".wav"), audio)
+        with open(os.path.join(reference_path, uri + ".rttm"), 'w', encoding="utf-8") as rttm_file:
+            for start, end, speaker in turns:
+                rttm_file.write(f"SPEAKER {uri} 1 {start:.3f} {end - start:.3f} <NA> <NA> {speaker} <NA> <NA>\n")
+        files.append({"file": uri + ".wav", "dataset": SYNTHETIC_DATASET, "duration": float(duration), "num_speakers": speakers,
+                      "sha1": _file_hash(os.path.join(datasets_path, uri + ".wav"))})
+    manifest = {"name": SYNTHETIC_DATASET, "params": params, "files": files, "hash": _corpus_hash(files)}
+    with open(manifest_path, 'w', encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+## Manifiesto de una carpeta de WAV ya existente (con subcarpetas de dataset, como en el volumen)
+def scan_corpus(corpus_path):
+    files = []
+    for wav_audio_file, dataset in scan_by_extension(corpus_path, ".wav"):
+        wav_file_path = os.path.join(corpus_path, dataset, wav_audio_file) if dataset != os.path.basename(os.path.normpath(corpus_path)) else os.path.join(corpus_path, wav_audio_file)
+        files.append({"file": wav_audio_file, "dataset": dataset, "path": wav_file_path, "duration": get_duration(wav_file_path),
+                      "sha1": _file_hash(wav_file_path)})
+    return {"name": os.path.basename(os.path.normpath(corpus_path)), "params": None, "files": files, "hash": _corpus_hash(files)}
+
+def _corpus_hash(files):
+    return hashlib.sha1("|".join(sorted(entry["sha1"] for entry in files)).encode("utf-8")).hexdigest()
+
+def _corpus_audio_paths(benchmark_path, manifest):
+    return [entry.get("path") or os.path.join(benchmark_path, PATH_BASE_DATASETS, entry["dataset"], entry["file"]) for entry in manifest["files"]]
+
+
+## Pyannote: carga la pipeline (etapa de carga de modelos) y diariza cada archivo con ella
+def benchmark_pyannote(audio_paths, config, huggingface_token):
+    import torch
+    from pyannote_pipeline import load_pipeline, build_pipeline_params
+    stages = []
+    with StageMeter(MODEL_LOAD_STAGE) as meter:
+        pipeline = load_pipeline(config["segmentation_model"], config["speaker_model"], huggingface_token, torch.device('cpu'))
+        pipeline.instantiate(build_pipeline_params(config["segmentation_model"], config["min_duration_off"], config["method_cluster"],
+                                                   config["min_cluster_size"], config["threshold_cluster"]))
+    stages.append(meter.record)
+    for wav_file_path in audio_paths:
+        with StageMeter(DIARIZATION_STAGE, os.path.basename(wav_file_path), get_duration(wav_file_path)) as meter:
+            pipeline(wav_file_path)
+        stages.append(meter.record)
+    return stages
+
+## Configuración de inferencia de NeMo igual que en nemo_pipeline.py, con VAD de modelo (el corpus no siempre tiene referencia)
+def _nemo_config(benchmark_path, config):
+    from omegaconf import OmegaConf
+    from nemo_pipeline import CONFIG_DIAR_INF_URL
+    config_path = os.path.join(benchmark_path, config["msdd_model"] + '.yaml')
+    if not os.path.exists(config_path):
+        import wget
+        wget.download(CONFIG_DIAR_INF_URL + config["msdd_model"] + '.yaml', config_path)
+    nemo_config = OmegaConf.load(config_path)
+    nemo_config.num_workers = 0
+    nemo_config.verbose = False
+    nemo_config.device = 'cpu'
+    nemo_config.diarizer.msdd_model.model_path = config["msdd_model"]
+    nemo_config.diarizer.speaker_embeddings.model_path = config["speaker_model"]
+    nemo_config.diarizer.speaker_embeddings.parameters.window_length_in_sec = config["window_lengths"]
+    nemo_config.diarizer.speaker_embeddings.parameters.shift_length_in_sec = [length / 2 for length in config["window_lengths"]]
+    nemo_config.diarizer.speaker_embeddings.parameters.multiscale_weights = [1 for _ in config["window_lengths"]]
+    nemo_config.diarizer.clustering.parameters.oracle_num_speakers = False
+    nemo_config.diarizer.oracle_vad = False
+    nemo_config.diarizer.vad.model_path = config["vad_model"]
+    nemo_config.diarizer.vad.parameters.min_duration_off = config["min_duration_off"]
+    return nemo_config
+
+## NeMo: construye el ClusteringDiarizer una vez (etapa de carga de modelos, como el modo batch) y diariza cada archivo con su manifiesto
+def benchmark_nemo(audio_paths, config, benchmark_path):
+    from nemo_pipeline import get_warm_diarizer
+    nemo_config = _nemo_config(benchmark_path, config)
+    stages = []
+    warm_diarizers = {}
+    with StageMeter(MODEL_LOAD_STAGE) as meter:
+        diarizer, _ = get_warm_diarizer(warm_diarizers, nemo_config, config["vad_model"])
+    stages.append(meter.record)
+    for wav_file_path in audio_paths:
+        uri = os.path.splitext(os.path.basename(wav_file_path))[0]
+        out_dir = os.path.join(benchmark_path, "nemo_out", uri)
+        os.makedirs(out_dir, exist_ok=True)
+        manifest_path = os.path.join(out_dir, uri + '_input_manifest.json')
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump({'audio_filepath': wav_file_path, 'offset': 0, 'duration': None, 'label': 'infer', 'text': '-', 'num_speakers': None,
+                       'rttm_filepath': None, 'uem_filepath': None}, manifest_file)
+            manifest_file.write('\n')
+        diarizer._diarizer_params.manifest_filepath = manifest_path
+        diarizer._diarizer_params.out_dir = out_dir
+        with StageMeter(DIARIZATION_STAGE, os.path.basename(wav_file_path), get_duration(wav_file_path)) as meter:
+            diarizer.diarize()
+        stages.append(meter.record)
+    return stages
+
+
+## Totales por etapa: tiempos sumados, pico de memoria máximo y RTF sobre la duración total de audio
+def summarize_stages(stages):
+    totals = {}
+    for record in stages:
+        total = totals.setdefault(record["stage"], {"wall_time": 0.0, "cpu_time": 0.0, "peak_rss_mb": 0.0, "audio_duration": 0.0})
+        total["wall_time"] += record["wall_time"]
+        total["cpu_time"] += record["cpu_time"]
+        total["peak_rss_mb"] = max(total["peak_rss_mb"], record["peak_rss_mb"])
+        total["audio_duration"] += record["audio_duration"]
+    for total in totals.values():
+        total["rtf"] = total["wall_time"] / total["audio_duration"] if total["audio_duration"] else None
+    return totals
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _package_versions(packages):
+    from importlib.metadata import version, PackageNotFoundError
+    versions = {}
+    for package in packages:
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+def _environment():
+    import torch
+    return {"platform": platform.platform(), "python": platform.python_version(), "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+            "packages": _package_versions(["torch", "pyannote.audio", "nemo_toolkit", "numpy"])}
+
+def load_results(results_path):
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path, 'r', encoding="utf-8") as results_file:
+        return [json.loads(line) for line in results_file if line.strip()]
+
+def append_result(results_path, result):
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, 'a', encoding="utf-8") as results_file:
+        results_file.write(json.dumps(result) + "\n")
+
+## Última ejecución anterior equivalente: misma pipeline, configuración y corpus, y mismo esquema
+def previous_result(results, result):
+    for candidate in reversed(results):
+        if candidate.get("schema_version") == result["schema_version"] and candidate["pipeline"] == result["pipeline"] \
+                and candidate["config"] == result["config"] and candidate["corpus"]["hash"] == result["corpus"]["hash"]:
+            return candidate
+    return None
+
+## Compara los tiempos por etapa con la ejecución anterior. Devuelve las etapas que superan la tolerancia.
+def compare_results(previous, result, tolerance=REGRESSION_TOLERANCE):
+    regressions = []
+    for stage, total in result["totals"].items():
+        previous_total = previous["totals"].get(stage)
+        if previous_total is None or not previous_total["wall_time"]:
+            continue
+        change = total["wall_time"] / previous_total["wall_time"] - 1
+        print(f"{stage}: {previous_total['wall_time']:.2f}s -> {total['wall_time']:.2f}s ({change:+.1%}), "
+              f"pico de memoria {previous_total['peak_rss_mb']:.0f} -> {total['peak_rss_mb']:.0f} MB")
+        if change > tolerance:
+            regressions.append(stage)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark de velocidad (tiempo, CPU, memoria y RTF por etapa) de las pipelines en CPU')
+    parser.add_argument('-p', '--pipeline', type=str, choices=['pyannote', 'nemo'], default='pyannote', help='Pipeline a medir')
+    parser.add_argument('-vp', '--volume_path', type=str, help='Carpeta del volumen, el benchmark usa su subcarpeta benchmark')
+    parser.add_argument('-cp', '--corpus_path', type=str, default=None, help='Carpeta de WAV a usar en lugar del corpus sintético')
+    parser.add_argument('-du', '--durations', type=str, default=",".join(str(duration) for duration in DEFAULT_DURATIONS),
+                        help='Duraciones en segundos de los audios del corpus sintético, separadas por comas')
+    parser.add_argument('-ns', '--num_speakers', type=str, default=",".join(str(speakers) for speakers in DEFAULT_NUM_SPEAKERS),
+                        help='Hablantes de cada audio del corpus sintético, separados por comas')
+    parser.add_argument('-sd', '--seed', type=int, default=DEFAULT_SEED, help='Semilla del corpus sintético')
+    parser.add_argument('-th', '--threads', type=int, default=None, help='Hilos de torch (por defecto los de la máquina)')
+    parser.add_argument('-hft', '--huggingface_token', type=str, help="Token de Huggingface")
+    parser.add_argument('-sem', '--segmentation_model', type=str, default='pyannote/segmentation-3.0', help="Modelo de segmentacion de Pyannote")
+    parser.add_argument('-sm', '--speaker_model', type=str, default=None, help="Modelo de embeddings (pyannote/embedding o titanet_large por defecto)")
+    parser.add_argument('-vad', '--vad_model', type=str, default='vad_multilingual_marblenet', help='Modelo VAD de NeMo')
+    parser.add_argument('-mm', '--msdd_model', type=str, default='diar_infer_general', help='Modelo MSDD de NeMo')
+    parser.add_argument('-wl', '--window_lengths', type=str, default='1.5', help='Longitudes de ventana de NeMo, separadas por comas')
+    parser.add_argument('-cmp', '--compare', action='store_true', help='Compara con la ejecución anterior equivalente y falla si hay regresión')
+    parser.add_argument('-tol', '--tolerance', type=float, default=REGRESSION_TOLERANCE, help='Aumento relativo máximo del tiempo de una etapa')
+    args = parser.parse_args()
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""  # Sólo CPU, para que las mediciones sean comparables entre máquinas
+    import torch
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    benchmark_path = os.path.join(args.volume_path, BENCHMARK_FOLDER)
+    if args.corpus_path:
+        corpus = scan_corpus(args.corpus_path)
+    else:
+        corpus = generate_synthetic_corpus(benchmark_path, [float(duration) for duration in args.durations.split(',')],
+                                           [int(speakers) for speakers in args.num_speakers.split(',')], args.seed)
+    audio_paths = _corpus_audio_paths(benchmark_path, corpus)
+
+    if args.pipeline == 'pyannote':
+        config = {"segmentation_model": args.segmentation_model, "speaker_model": args.speaker_model or 'pyannote/embedding',
+                  "min_duration_off": 0.0, "method_cluster": 'centroid', "min_cluster_size": 12, "threshold_cluster": 0.7045654963945799}
+        stages = benchmark_pyannote(audio_paths, config, args.huggingface_token)
+    else:
+        config = {"vad_model": args.vad_model, "speaker_model": args.speaker_model or 'titanet_large', "msdd_model": args.msdd_model,
+                  "window_lengths": [float(length) for length in args.window_lengths.split(',')], "min_duration_off": 0.0}
+        stages = benchmark_nemo(audio_paths, config, benchmark_path)
+
+    result = {"schema_version": SCHEMA_VERSION, "timestamp": datetime.now().isoformat(timespec='seconds'), "git_commit": _git_commit(),
+              "pipeline": args.pipeline, "config": config, "environment": _environment(),
+              "corpus": {"name": corpus["name"], "params": corpus["params"], "hash": corpus["hash"],
+                         "files": len(corpus["files"]), "duration": sum(entry["duration"] for entry in corpus["files"])},
+              "stages": stages, "totals": summarize_stages(stages)}
+    results_path = os.path.join(benchmark_path, BENCHMARK_RESULTS_FILE)
+    previous = previous_result(load_results(results_path), result)
+    append_result(results_path, result)
+    for stage, total in result["totals"].items():
+        rtf = f"{total['rtf']:.4f}" if total["rtf"] is not None else "-"
+        print(f"{stage}: {total['wall_time']:.2f}s reales, {total['cpu_time']:.2f}s de CPU, pico {total['peak_rss_mb']:.0f} MB, RTF {rtf}")
+    print(f"Resultados añadidos a {results_path}")
+    if args.compare:
+        if previous is None:
+            print("No hay una ejecución anterior equivalente con la que comparar")
+        else:
+            regressions = compare_results(previous, result, args.tolerance)
+            if regressions:
+                print(f"Regresión en las etapas: {', '.join(regressions)}")
+                exit(1)
@@ -1,9 +1,66 @@
 from moviepy import AudioFileClip
 from pydub import AudioSegment
 import os, shutil
+import subprocess
 import argparse
 import logging
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+VIDEO_EXTENSIONS = (".mp4",)
+AUDIO_EXTENSIONS = (".m4a", ".mp3", ".wav")
+TMP_PREFIX = ".tmp_"
+SAMPLE_RATE = 16000  # Frecuencia de muestreo que esperan los modelos de Pyannote y de NeMo
+
+## Ejecutable de ffmpeg: el del sistema o, si no lo hay, el que trae moviepy a través de imageio-ffmpeg
+def _find_ffmpeg():
+    ffmpeg_path = shutil.which("ffmpeg")
+    if ffmpeg_path is None:
+        try:
+            import imageio_ffmpeg
+            ffmpeg_path = imageio_ffmpeg.get_ffmpeg_exe()
+        except (ImportError, RuntimeError):
+            ffmpeg_path = None
+    return ffmpeg_path
+
+## Decodifica, mezcla a mono, remuestrea a 16 kHz y escribe PCM de 16 bits en una sola pasada de ffmpeg, en streaming:
+# la memoria no depende de la duración del audio
+def _ffmpeg_to_wav_16k_mono(ffmpeg_path, source_path, wav_path):
+    result = subprocess.run([ffmpeg_path, "-nostdin", "-y", "-loglevel", "error", "-i", source_path, "-vn", "-ac", "1", "-ar", str(SAMPLE_RATE),
+                             "-c:a", "pcm_s16le", "-f", "wav", wav_path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg no ha podido convertir {source_path}: {result.stderr.decode('utf-8', errors='replace').strip()}")
+
+## Alternativa sin ffmpeg accesible: moviepy/pydub cargan el audio completo en memoria
+def _pydub_to_wav_16k_mono(source_path, wav_path):
+    extension = os.path.splitext(source_path)[1].lower()
+    if extension == ".mp4":
+        audio = AudioFileClip(source_path)
+        audio.write_audiofile(wav_path, fps=SAMPLE_RATE, nbytes=2, codec='pcm_s16le', logger=None)
+        audio.close()
+        audio_file = AudioSegment.from_wav(wav_path)
+    else:
+        audio_file = AudioSegment.from_file(source_path, format=extension[1:])
+    audio_file.set_channels(1).set_frame_rate(SAMPLE_RATE).set_sample_width(2).export(wav_path, format="wav")
+
+## Convierte un archivo de video o audio a WAV mono de 16 kHz en su carpeta de salida. Se ejecuta en los procesos del pool, así que es
+# una función de módulo. Se escribe en un temporal y se renombra al final: una conversión interrumpida nunca deja una salida
+# "más reciente" que su origen que luego se daría por buena.
+def _convert_to_mono_wav(source_path, output_path):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(output_path), TMP_PREFIX + os.path.basename(output_path))
+    ffmpeg_path = _find_ffmpeg()
+    try:
+        if ffmpeg_path is not None:
+            _ffmpeg_to_wav_16k_mono(ffmpeg_path, source_path, tmp_path)
+        else:
+            _pydub_to_wav_16k_mono(source_path, tmp_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, output_path)
+    return output_path
 
 class ConverterToAudio:
     def __init__(self, video_media_path, audio_media_path, output_media_path = './data/media/datasets'):
@@ -18,166 +75,95 @@ class ConverterToAudio:
                                 encoding='utf-8', level=logging.DEBUG, format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')           
               
         
-    def convert(self):
-        
-       def _buscar_by_extension_in_dataset(path, extension):
-            resultados = []
-            for carpeta_actual, subcarpetas, archivos in os.walk(path):
-                # Obtener el nombre de la carpeta actual
-                nombre_carpeta = os.path.basename(carpeta_actual)
-                for archivo in archivos:
-                    if archivo.lower().endswith(extension):
-                        resultados.append((archivo, nombre_carpeta))
-            return resultados
-        
-       try:
-        if self.audio_media_path is None:
-            # Si no se proporciona una carpeta de audio destino, se crea una por defecto si no está ya creada
-            audio_media_path = os.path.join(os.getcwd(), 'audio')
-            if not os.path.exists(audio_media_path):
-                os.mkdir(audio_media_path)
-                self.logger.warning(f"Creamos un path de audio de entrada: {self.audio_media_path} puesto que no se ha suministrado ninguno.")
-                print(f"Creamos un path de audio de entrada: {self.audio_media_path} puesto que no se ha suministrado ninguno.")
-            self.audio_media_path = audio_media_path          
-            self.logger.warning(f"El path de audio de entrada será: {self.audio_media_path}.")  
-            print(f"El path de audio de entrada será: {self.audio_media_path}.")  
-
+    ## Recorre una sola vez las carpetas de entrada y construye la lista de conversiones (origen, salida). Los nombres con espacios
+    # se renombran con guiones bajos, como antes. Se omiten los archivos cuya salida ya existe y es más reciente que el origen.
+    def _scan_work_list(self):
+        work_list = {}
+        # Los videos MP4 se buscan en la carpeta de video y el resto de formatos en la de audio
+        roots = [(self.audio_media_path, AUDIO_EXTENSIONS)]
         if self.video_media_path is not None:
-            # Existe un path de entrada de video ??            
-            if os.path.exists(self.video_media_path):
-                #dataset_tuplas_list = [[ (video,video_subfolder) for video in os.listdir(os.path.join(self.video_media_path, video_subfolder))] for video_subfolder in os.listdir(self.video_media_path) if os.path.isdir(os.path.join(self.video_media_path, video_subfolder))]
-                tuplas = _buscar_by_extension_in_dataset(self.video_media_path, ".mp4")
-                                
-                for tupla in tuplas:
-                    video_file = tupla[0]   
-                    video_subfolder = tupla[1]   
-                    video_file_under = video_file.replace(" ","_")
-                    os.rename(os.path.join(self.video_media_path, video_subfolder, video_file), os.path.join(self.video_media_path, video_subfolder, video_file_under))    
-                    self.convert_video_to_audio(video_file_under, video_subfolder)                
-                    
-                ## En caso de que los videos MP4 no vengan agrupados en carpetas de Datasets, sino en la misma carpeta 
-                video_files = [video for video in os.listdir(self.video_media_path) if video.lower().endswith(".mp4")]
-                # Convert the video to audio
-                for video_file in video_files:          
-                    video_file_under = video_file.replace(" ","_")
-                    os.rename(os.path.join(self.video_media_path, video_file), os.path.join(self.video_media_path, video_file_under))    
-                    self.convert_video_to_audio(video_file_under)
+            if not os.path.exists(self.video_media_path):
+                self.logger.warning(f"Path de entrada: {self.video_media_path} con videos para convertir, no existe.")
+            elif os.path.abspath(self.video_media_path) == os.path.abspath(self.audio_media_path):
+                roots = [(self.audio_media_path, VIDEO_EXTENSIONS + AUDIO_EXTENSIONS)]
             else:
-                self.logger.warning(f"Path de entrada: {self.video_media_path} con videos para convertir, no existe.")        
-                
-        tuplas = _buscar_by_extension_in_dataset(self.audio_media_path, ".m4a")
-        for tupla in tuplas:
-            m4a_audio_file = tupla[0]   
-            m4a_audio_subfolder = tupla[1]           
-            m4a_audio_file_under = m4a_audio_file.replace(" ","_")
-            os.rename(os.path.join(self.audio_media_path, m4a_audio_subfolder, m4a_audio_file), os.path.join(self.audio_media_path, m4a_audio_subfolder, m4a_audio_file_under))    
-            self.convert_M4A_to_Wav(m4a_audio_file_under, m4a_audio_subfolder)            
-        ## En caso de que los audios M4A no vengan agrupados en carpetas de Datasets, sino en la misma carpeta 
-        for m4a_audio_file in [m4a_audio for m4a_audio in os.listdir(self.audio_media_path) if m4a_audio.lower().endswith(".m4a")]:
-            m4a_audio_file_under = m4a_audio_file.replace(" ","_")
-            os.rename(os.path.join(self.audio_media_path, m4a_audio_file), os.path.join(self.audio_media_path, m4a_audio_file_under))    
-            self.convert_M4A_to_Wav(m4a_audio_file_under)  
-            
-        tuplas = _buscar_by_extension_in_dataset(self.audio_media_path, ".mp3")
-        for tupla in tuplas:
-            mp3_audio_file = tupla[0]   
-            mp3_audio_subfolder = tupla[1]           
-            mp3_audio_file_under = mp3_audio_file.replace(" ","_")
-            os.rename(os.path.join(self.audio_media_path, mp3_audio_subfolder, mp3_audio_file), os.path.join(self.audio_media_path, mp3_audio_subfolder, mp3_audio_file_under))    
-            self.convert_MP3_to_Wav(mp3_audio_file_under, mp3_audio_subfolder)            
-        ## En caso de que los audios MP3 no vengan agrupados en carpetas de Datasets, sino en la misma carpeta                
-        for mp3_audio_file in [mp3_audio for mp3_audio in os.listdir(self.audio_media_path) if mp3_audio.lower().endswith(".mp3")]:
-            mp3_audio_file_under = mp3_audio_file.replace(" ","_")
-            os.rename(os.path.join(self.audio_media_path, mp3_audio_file), os.path.join(self.audio_media_path, mp3_audio_file_under))    
-            self.convert_MP3_to_Wav(mp3_audio_file_under)                           
-                                                          
-        tuplas = _buscar_by_extension_in_dataset(self.audio_media_path, ".wav")
-        for tupla in tuplas:
-            audio_file = tupla[0]   
-            if self.audio_media_path != tupla[1]:
-                audio_subfolder = tupla[1]
-                if audio_subfolder ==  os.path.basename(self.audio_media_path):
-                    audio_subfolder = '.'                                      
-                audio_file_under = audio_file.replace(" ","_")
-                os.rename(os.path.join(self.audio_media_path, audio_subfolder, audio_file), os.path.join(self.audio_media_path, audio_subfolder, audio_file_under))    
-                if not os.path.exists(self.output_media_path):
-                    os.mkdir(self.output_media_path)
-                    self.logger.warning(f"Creamos el path de audio de salida: {str(self.output_media_path)} ")
-                if not os.path.exists(os.path.join(self.output_media_path, audio_subfolder)):
-                    os.mkdir(os.path.join(self.output_media_path, audio_subfolder))
-                    self.logger.warning(f"Creamos el path de audio de salida: {str(os.path.join(self.output_media_path, audio_subfolder))}, para el dataset {audio_subfolder}")            
-                shutil.copy2(os.path.join(self.audio_media_path, audio_subfolder, audio_file_under), os.path.join(self.output_media_path, audio_subfolder, audio_file_under))
-                
-                self.convert_stereo_to_mono(os.path.join(self.output_media_path, audio_subfolder, audio_file_under))                
-                self.logger.debug(f"Copiado {audio_file_under} a {self.output_media_path}.")
-        ## En caso de que los audios WAV no vengan agrupados en carpetas de Datasets, sino en la misma carpeta                    
-        for audio_file in [audio_file for audio_file in os.listdir(self.audio_media_path) if audio_file.lower().endswith(".wav")]:
-                # Move the audio files converted or not converted to the output path 
-                audio_file_under = audio_file.replace(" ","_")
-                os.rename(os.path.join(self.audio_media_path, audio_file), os.path.join(self.audio_media_path, audio_file_under))    
-                shutil.copy2(os.path.join(self.audio_media_path, audio_file_under), os.path.join(self.output_media_path, audio_file_under))                   
-                
-                self.convert_stereo_to_mono(os.path.join(self.output_media_path, audio_file_under))
-                self.logger.debug(f"Copiado {audio_file_under} a {self.output_media_path}.")
-                
-       except Exception as e:
-            self.logger.error(f"Error: {e}")
-            raise e    
-       self.logger.debug(f"Conversiones finalizadas.")
+                roots.insert(0, (self.video_media_path, VIDEO_EXTENSIONS))
+        for root, extensions in roots:
+            for carpeta_actual, subcarpetas, archivos in os.walk(root):
+                # La carpeta de salida puede estar dentro de la de entrada, no se vuelve a convertir lo ya convertido
+                subcarpetas[:] = [subcarpeta for subcarpeta in subcarpetas
+                                  if os.path.abspath(os.path.join(carpeta_actual, subcarpeta)) != os.path.abspath(self.output_media_path)]
+                # Los audios sin carpeta de Datasets van directamente a la carpeta de salida
+                dataset_subfolder = os.path.relpath(carpeta_actual, root)
+                for archivo in archivos:
+                    extension = os.path.splitext(archivo)[1].lower()
+                    if extension not in extensions or archivo.startswith(TMP_PREFIX):
+                        continue
+                    archivo_under = archivo.replace(" ", "_")
+                    if archivo_under != archivo:
+                        os.rename(os.path.join(carpeta_actual, archivo), os.path.join(carpeta_actual, archivo_under))
+                    source_path = os.path.join(carpeta_actual, archivo_under)
+                    output_path = os.path.normpath(os.path.join(self.output_media_path, dataset_subfolder,
+                                                                os.path.splitext(archivo_under)[0] + ".wav"))
+                    # Si varios orígenes dan la misma salida (p. ej. x.mp4 y x.wav) manda el más reciente
+                    if output_path in work_list and os.path.getmtime(work_list[output_path]) >= os.path.getmtime(source_path):
+                        continue
+                    work_list[output_path] = source_path
+        pending = [(source_path, output_path) for output_path, source_path in work_list.items()
+                   if not os.path.exists(output_path) or os.path.getmtime(output_path) < os.path.getmtime(source_path)]
+        return pending, len(work_list) - len(pending)
 
-    def convert_stereo_to_mono(self, path_wav_file):
-        audio_file = AudioSegment.from_wav(path_wav_file)
-        audio_file = audio_file.set_channels(1)    
-        audio_file.export(path_wav_file, format="wav")
-        
-     # Convert MP4 video to WAV audio   
-    def convert_video_to_audio(self, input_file, dataset_subfolder=None):
-        output_file = input_file.replace('.mp4', '.wav')
-        if dataset_subfolder is None:
-            input_path = os.path.join(self.video_media_path, input_file)
-            output_path = os.path.join(self.audio_media_path, output_file)
-        else:
-            input_path = os.path.join(self.video_media_path, dataset_subfolder, input_file)
-            output_path = os.path.join(self.audio_media_path, dataset_subfolder, output_file)                
-        # Load the MP4 audio file
-        audio = AudioFileClip(input_path)
-        # Convert and save the audio to WAV format
-        audio.write_audiofile(output_path, codec='pcm_s16le', bitrate='16000')
-        audio.close()        
-        self.logger.debug(f"Convertido {input_file} a {output_file}.")
+    ## Convierte los archivos pendientes. Un archivo que no se puede convertir (p. ej. una grabación corrupta) se registra y se sigue
+    # con el resto; al final se informa de todos los fallidos, que se devuelven en una lista de (origen, error)
+    def convert(self, workers=None):
+        failed = []
+        try:
+            if self.audio_media_path is None:
+                # Si no se proporciona una carpeta de audio destino, se crea una por defecto si no está ya creada
+                audio_media_path = os.path.join(os.getcwd(), 'audio')
+                if not os.path.exists(audio_media_path):
+                    os.mkdir(audio_media_path)
+                    self.logger.warning(f"Creamos un path de audio de entrada: {self.audio_media_path} puesto que no se ha suministrado ninguno.")
+                    print(f"Creamos un path de audio de entrada: {self.audio_media_path} puesto que no se ha suministrado ninguno.")
+                self.audio_media_path = audio_media_path
+                self.logger.warning(f"El path de audio de entrada será: {self.audio_media_path}.")
+                print(f"El path de audio de entrada será: {self.audio_media_path}.")
 
-    def convert_M4A_to_Wav(self, m4a_audio_file, dataset_subfolder=None):
-        if dataset_subfolder is None:            
-            m4a_audio_filepath = os.path.join(self.audio_media_path, m4a_audio_file) 
-        else:
-            m4a_audio_filepath = os.path.join(self.audio_media_path, dataset_subfolder, m4a_audio_file) 
-        m4a_wrapper = AudioSegment.from_file(m4a_audio_filepath, format='m4a')
-        wav_audio_file = m4a_audio_file.replace('.m4a', '.wav').replace('.M4A', '.wav')
-        if dataset_subfolder is None:
-            m4a_wrapper.export(os.path.join(self.audio_media_path, wav_audio_file), format='wav', )
-        else:    
-            m4a_wrapper.export(os.path.join(self.audio_media_path, dataset_subfolder, wav_audio_file), format='wav')
-        self.logger.debug(f"Convertido {m4a_audio_file} a {wav_audio_file}.")
-            
-    def convert_MP3_to_Wav(self, mp3_audio_file, dataset_subfolder=None):
-        if dataset_subfolder is None:            
-            mp3_audio_filepath = os.path.join(self.audio_media_path, mp3_audio_file) 
-        else:        
-            mp3_audio_filepath = os.path.join(self.audio_media_path, dataset_subfolder, mp3_audio_file) 
-        mp3_wrapper = AudioSegment.from_mp3(mp3_audio_filepath, )
-        wav_audio_file = mp3_audio_file.replace('.mp3', '.wav').replace('.MP3', '.wav')
-        if dataset_subfolder is None:            
-            mp3_wrapper.export(os.path.join(self.audio_media_path, wav_audio_file),  format='wav')
+            pending, up_to_date = self._scan_work_list()
+            print(f"Archivos a convertir: {len(pending)}, ya convertidos y sin cambios: {up_to_date}")
+            self.logger.info(f"Archivos a convertir: {len(pending)}, ya convertidos y sin cambios: {up_to_date}")
+            if pending:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = {executor.submit(_convert_to_mono_wav, source_path, output_path): source_path for source_path, output_path in pending}
+                    for future in as_completed(futures):
+                        try:
+                            output_path = future.result()
+                        except Exception as e:
+                            failed.append((futures[future], str(e)))
+                            print(f"No se ha podido convertir {futures[future]}: {e}")
+                            self.logger.error(f"No se ha podido convertir {futures[future]}: {e}")
+                            continue
+                        self.logger.debug(f"Convertido {futures[future]} a {output_path}.")
+        except Exception as e:
+            self.logger.error(f"Error: {e}")
+            raise e
+        if failed:
+            print(f"Conversiones finalizadas con {len(failed)} archivos sin convertir:")
+            self.logger.warning(f"Conversiones finalizadas con {len(failed)} archivos sin convertir:")
+            for source_path, error in failed:
+                print(f"  {source_path}: {error}")
+                self.logger.warning(f"  {source_path}: {error}")
         else:
-            mp3_wrapper.export(os.path.join(self.audio_media_path, dataset_subfolder, wav_audio_file),  format='wav')    
-        self.logger.debug(f"Convertido {mp3_audio_file} a {wav_audio_file}.")            
+            self.logger.debug(f"Conversiones finalizadas.")
+        return failed
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Convert MP4 video to WAV audio and other audio formats to WAV")
     parser.add_argument('-vmp', '--video_media_path', type=str, help='Carpeta de entrada con los archivos de video(.mp4)')
     parser.add_argument('-amp', '--audio_media_path', type=str, help='Carpeta de entrada con los archivos de audio(.wav, .mp3, .m4u)')
-    parser.add_argument('-omp', '--output_media_path', type=str, help='Carpeta de salida con los archivos de audio(.wav) convertidos a Mono y muestreados 16Kbps.')
+    parser.add_argument('-omp', '--output_media_path', type=str, help='Carpeta de salida con los archivos de audio(.wav) convertidos a Mono, PCM de 16 bits y muestreados a 16 kHz.')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Número de procesos de conversión (por defecto, uno por CPU)')
 
     args = parser.parse_args()
     converter = ConverterToAudio(args.video_media_path, args.audio_media_path,  args.output_media_path)
-    converter.convert()
\ No newline at end of file
+    exit(1 if converter.convert(args.workers) else 0)
\ No newline at end of file
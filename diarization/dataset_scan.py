@@ -0,0 +1,48 @@
+## Búsqueda de archivos por extensión en las carpetas de datasets (audios) y de hipótesis (RTTM), común a las pipelines y a metrics.py.
+# Se recorre cada árbol una única vez con os.scandir, sin volver a listar subárboles ya visitados, y los resultados se devuelven
+# a medida que se encuentran (generadores). Las entradas de cada carpeta se recorren ordenadas por nombre para que el orden
+# de los resultados no dependa del sistema de archivos.
+import os
+
+
+## Recorre en profundidad `path` (primero los archivos de cada carpeta, después sus subcarpetas) y devuelve (carpeta, archivo)
+# para cada archivo con la extensión dada
+def _scan_tree(path, extension):
+    extension = extension.lower()
+    pending = [path]
+    while pending:
+        folder = pending.pop()
+        try:
+            with os.scandir(folder) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        subfolders = []
+        for entry in entries:
+            if entry.is_dir():
+                subfolders.append(entry.path)
+            elif entry.name.lower().endswith(extension) and entry.is_file():
+                yield folder, entry.name
+        pending.extend(reversed(subfolders))
+
+## Tuplas (archivo, nombre de su carpeta) de todos los archivos con la extensión bajo `path`, p. ej. (audio, dataset) para los WAV
+def scan_by_extension(path, extension):
+    for folder, archivo in _scan_tree(path, extension):
+        yield archivo, os.path.basename(folder)
+
+## Tuplas (archivo, carpeta del archivo, carpeta de primer nivel) de los archivos con la extensión bajo cada carpeta de primer nivel
+# de `path`, p. ej. (RTTM, combinación de modelos, dataset) para las hipótesis. Si la combinación de modelos cuelga directamente
+# de `path` (sin carpeta de dataset) la carpeta del archivo y la de primer nivel coinciden. Las tuplas repetidas se descartan.
+def scan_by_extension_2_levels(path, extension):
+    seen = set()
+    try:
+        with os.scandir(path) as entries:
+            top_folders = sorted(entry.name for entry in entries if entry.is_dir())
+    except FileNotFoundError:
+        return
+    for carpeta in top_folders:
+        for folder, archivo in _scan_tree(os.path.join(path, carpeta), extension):
+            record = (archivo, os.path.basename(folder), carpeta)
+            if record not in seen:
+                seen.add(record)
+                yield record
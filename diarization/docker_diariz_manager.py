@@ -1,17 +1,26 @@
 import argparse
 import docker
 import os
+import json
 from pathlib import Path
 import logging
 import time
+import queue
+import threading
 from datetime import datetime
 from enum import Enum
 from docker.models.containers import Container
 
 from pyannote_import import SpeakerModels as SpeakerModelPyannote, SegmentationModels, ClusteringMethods
 from nemo_import import SpeakerModels as SpeakerModelNemo, VADModels, MSDDModels
+from exec_time_log import exec_time_file_path, load_exec_times
+from stage_timing import stage_time_file_path, load_stage_times
+from resource_sampler import (ContainerResourceSampler, SAMPLE_INTERVAL, attribute_samples, resource_samples_file_path,
+                              resource_usage_file_path, write_resource_samples, write_resource_usage)
 
 STATUS_FILE = 'status.txt'
+PATH_JOBS = 'jobs'
+PROGRESS_PREFIX = 'FIN de la diarización por'  # Línea que imprimen las pipelines al terminar cada archivo
 FIN="FIN"
 
 class DockerImages(Enum):
@@ -27,8 +36,17 @@ class DockerDiarizationManager:
      except docker.errors.ImageNotFound:
         return client.images.pull(image_name)
     
-    def __init__(self, image_name_list, host_volume_path, container_volume_path='/media'):
+    ## resource_limits: cuotas opcionales por contenedor, p. ej. {'nemo_pipeline': {'cpus': 8, 'mem_limit': '16g'}}
+    ## exec_timeout: segundos máximos que se espera a una ejecución (None, sin límite)
+    ## sample_resources: muestrea cada `sample_interval` segundos CPU, memoria y E/S de los contenedores mientras ejecutan un comando
+    def __init__(self, image_name_list, host_volume_path, container_volume_path='/media', use_worker=False, resource_limits=None, exec_timeout=None,
+                 sample_resources=False, sample_interval=SAMPLE_INTERVAL):
         self.host_volume_path = Path(host_volume_path).absolute()          
+        self.exec_timeout = exec_timeout
+        self.sample_resources = sample_resources
+        self.sample_interval = sample_interval
+        self.use_worker = use_worker  # Si el contenedor de Pyannote recibe trabajos en su worker persistente en lugar de `docker exec`
+        self.resource_limits = resource_limits if resource_limits is not None else {}
         logs_path = os.path.join(self.host_volume_path, "logs")
         if not os.path.exists(logs_path):
             os.makedirs( logs_path, exist_ok=True)        
@@ -57,8 +75,13 @@ class DockerDiarizationManager:
                         container_volume_rttm_ref_path = '/data'                        
                         if not host_volume_rttm_ref_path in binding: 
                             binding[host_volume_rttm_ref_path] = {"bind" : container_volume_rttm_ref_path, "mode" : "rw"}  
+                    ## Con el worker, el contenedor de Pyannote arranca pyannote_pipeline.py --worker sobre la ruta del volumen en el contenedor
+                    entrypoint = None
+                    if use_worker and container_name == DockerImages.pyannote_pipeline.name:
+                        entrypoint = ["python", "/" + container_name + ".py", "--worker", "--volume_path", container_volume_path]
                     image = self._get_or_pull_image(self.client, self.image_name)                                    
-                    self.containers[container_name] = self.run_container(image.tags[0], container_name, binding)    
+                    self.containers[container_name] = self.run_container(image.tags[0], container_name, binding,
+                                                                         resource_limits=self.resource_limits.get(container_name), entrypoint=entrypoint)    
                 except docker.errors.ImageNotFound as e:
                     print(f"Image not found: {e}")
                     self.logger.error(f"Image not found: {container_name} : {e}")
@@ -93,11 +116,18 @@ class DockerDiarizationManager:
             print(f"Un error ha ocurrido mienstras se detenía el contenedor: {e}")            
             exit(1)     
 
-    def run_container(self, image_name: str, container_name:str, volume_binding=None, command=None, detach=True):        
+    def run_container(self, image_name: str, container_name:str, volume_binding=None, command=None, detach=True, resource_limits=None, entrypoint=None):        
         try:
             self.stop_if_running(container_name)
+            quotas = {}
+            if resource_limits is not None:
+                if resource_limits.get('cpus') is not None:
+                    quotas['nano_cpus'] = int(float(resource_limits['cpus']) * 1e9)
+                if resource_limits.get('mem_limit') is not None:
+                    quotas['mem_limit'] = resource_limits['mem_limit']
+                self.logger.info(f"Cuotas de recursos para el contenedor {container_name}: {resource_limits}")
             container = self.client.containers.run(image_name, name=container_name, 
-                                                   volumes=volume_binding, command=command, detach=detach)
+                                                   volumes=volume_binding, command=command, entrypoint=entrypoint, detach=detach, **quotas)
             if isinstance(container, Container):
                 self.logger.info(f"Contenedor {container_name} iniciado con ID: {container.id}")
             else:    
@@ -132,59 +162,147 @@ class DockerDiarizationManager:
         self.run_container(image.tags[0], container_name, binding, command="-d="+str(delta), detach=False)
 
 
-    # Este método puede ejecutar más de un contenedor distinto con sus parámetros correspondientes   
-    def execute_command(self, container_name, params:dict): 
+    ## Envía un trabajo al worker persistente de Pyannote (pyannote_pipeline.py --worker) dejándolo en la carpeta de spool del volumen
+    ## compartido, así la pipeline ya cargada en el contenedor se reutiliza y sólo se instancian de nuevo los hiperparámetros.
+    ## El final del trabajo se detecta en el stream de logs del contenedor, cuando el worker escribe "Trabajo <job> terminado".
+    def submit_worker_job(self, container_name, params:dict, files=None):
+        events = queue.Queue()
+        sampler = self._start_sampler(container_name)
+        job_name = None
         try:
-            with open(os.path.join(self.host_volume_path, container_name+'_'+STATUS_FILE), 'w', encoding="utf-8") as status_file:
-                status_file.write('Inicializado el archivo de estado')
-                self.logger.info('Inicializado el archivo de estado')
-                status_file.close()
-            cmd_list = ["python", container_name + ".py", "--volume_path", self.container_volume_path]
-            if container_name == DockerImages.pyannote_pipeline.name:
-                if 'pipeline_version' in params and params['pipeline_version'] is not None:
-                    cmd_list.extend([ "--pipeline_version", params['pipeline_version'] ])
-                if 'huggingface_token' in params and params['huggingface_token'] is not None:
-                    cmd_list.extend([ "--huggingface_token", params['huggingface_token'] ])  
-                if 'segmentation_model' in params and params['segmentation_model'] is not None:                    
-                    cmd_list.extend([ "--segmentation_model", params['segmentation_model'] ]) 
-                if 'speaker_model_pyannote' in params and params['speaker_model_pyannote'] is not None:
-                    cmd_list.extend([ "--speaker_model", params['speaker_model_pyannote'] ])
-                if 'min_cluster_size' in params and params['min_cluster_size'] is not None:
-                    cmd_list.extend([ "--min_cluster_size", params['min_cluster_size'] ])
-                if 'method_cluster' in params and params['method_cluster'] is not None:
-                    cmd_list.extend([ "--method_cluster", params['method_cluster'] ])
-                if 'threshold_cluster' in params and params['threshold_cluster'] is not None:
-                    cmd_list.extend([ "--threshold_cluster", params['threshold_cluster'] ])                    
-                                       
-            elif container_name == DockerImages.nemo_pipeline.name:
-                if 'vad_model' in params and params['vad_model'] is not None:
-                    cmd_list.extend([ "--vad_model", params['vad_model'] ])
-                if 'speaker_model_nemo' in params and params['speaker_model_nemo'] is not None:
-                    cmd_list.extend([ "--speaker_model", params['speaker_model_nemo'] ])
-                if 'reference_path' in params and params['reference_path'] is not None:
-                    cmd_list.extend([ "--reference_path", params['reference_path'] ])
-                if 'msdd_model' in params and params['msdd_model'] is not None:
-                    cmd_list.extend([ "--msdd_model", params['msdd_model'] ])
-                if 'window_lengths' in params and params['window_lengths'] is not None:
-                    cmd_list.extend([ "--window_lengths", params['window_lengths'] ])                    
+            job_name = self._start_worker_job(container_name, params, events, files)
+            self._wait_for_completion({container_name: None}, events)
+            return 0
+        except Exception as e:
+            print(f"An error occurred while executing the job {job_name}: {e}")
+            self.logger.error(f"An error occurred while executing the job {job_name}: {e}")
+            self.stop_if_running(self.containers[container_name].name)
+            exit(1)
+        finally:
+            self._finish_sampler(container_name, sampler, params.get('append_exec_time'))
 
-            else:
-                print(f"No se ha podido preparar un comando de ejecución al contenedor {container_name}")
-                self.logger.info(f"No se ha podido preparar un comando de ejecución al contenedor {container_name}")
-                exit(1)
-                
-            if 'min_duration_off' in params and params['min_duration_off'] is not None:
-                cmd_list.extend([ "--min_duration_off", params['min_duration_off'] ])
-            if 'num_speakers' in params and params['num_speakers'] is not None:
-                cmd_list.extend([ "--num_speakers", params['num_speakers'] ])
-            exec_command = self.client.api.exec_create(self.containers[container_name].id, cmd_list)    
+    ## Deja un trabajo en la carpeta de spool del worker y lleva a la cola `events` los eventos del stream de logs del contenedor,
+    ## terminando con ('done', línea) cuando el worker escribe su línea de fin. Devuelve el nombre del trabajo
+    def _start_worker_job(self, container_name, params:dict, events:queue.Queue, files=None):
+        job = {}
+        params_to_job = {'huggingface_token': 'huggingface_token', 'segmentation_model': 'segmentation_model', 'speaker_model_pyannote': 'speaker_model',
+                         'min_duration_off': 'min_duration_off', 'min_cluster_size': 'min_cluster_size', 'method_cluster': 'method_cluster',
+                         'threshold_cluster': 'threshold_cluster', 'num_speakers': 'num_speakers', 'run_tag': 'run_tag',
+                         'append_exec_time': 'append_exec_time', 'batch_segmentation_files': 'batch_segmentation_files',
+                         'quantize_segmentation': 'quantize_segmentation', 'long_audio_block': 'long_audio_block',
+                         'long_audio_overlap': 'long_audio_overlap', 'cache_embeddings': 'cache_embeddings'}
+        for param, job_key in params_to_job.items():
+            if param in params and params[param] is not None:
+                job[job_key] = params[param]
+        if files is not None:
+            job['files'] = files
+        jobs_path = os.path.join(self.host_volume_path, PATH_JOBS, container_name)
+        os.makedirs(jobs_path, exist_ok=True)
+        with open(os.path.join(self.host_volume_path, container_name+'_'+STATUS_FILE), 'w', encoding="utf-8") as status_file:
+            status_file.write('Inicializado el archivo de estado')
+            self.logger.info('Inicializado el archivo de estado')
+        job_name = f"job_{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+        # Nos suscribimos a los logs antes de dejar el trabajo, para no perder su línea de fin
+        logs = self.containers[container_name].logs(stream=True, follow=True, since=datetime.now())
+        self._stream_events(container_name, logs, events, done_marker=f"Trabajo {job_name}.json terminado")
+        # Se escribe con otra extensión y se renombra, para que el worker nunca lea un trabajo a medio escribir
+        with open(os.path.join(jobs_path, job_name + '.tmp'), 'w', encoding="utf-8") as job_file:
+            json.dump(job, job_file)
+        os.replace(os.path.join(jobs_path, job_name + '.tmp'), os.path.join(jobs_path, job_name + '.json'))
+        print(f"Enviado el trabajo {job_name} al worker del contenedor {container_name} ...")
+        self.logger.info(f"Enviado el trabajo {job_name} al worker del contenedor {container_name} ...")
+        return job_name
+
+    ## Inicializa el archivo de estado y construye la línea de comandos del script de la pipeline del contenedor
+    def _prepare_command(self, container_name, params:dict):
+        with open(os.path.join(self.host_volume_path, container_name+'_'+STATUS_FILE), 'w', encoding="utf-8") as status_file:
+            status_file.write('Inicializado el archivo de estado')
+            self.logger.info('Inicializado el archivo de estado')
+            status_file.close()
+        cmd_list = ["python", container_name + ".py", "--volume_path", self.container_volume_path]
+        if container_name == DockerImages.pyannote_pipeline.name:
+            if 'pipeline_version' in params and params['pipeline_version'] is not None:
+                cmd_list.extend([ "--pipeline_version", params['pipeline_version'] ])
+            if 'huggingface_token' in params and params['huggingface_token'] is not None:
+                cmd_list.extend([ "--huggingface_token", params['huggingface_token'] ])  
+            if 'segmentation_model' in params and params['segmentation_model'] is not None:                    
+                cmd_list.extend([ "--segmentation_model", params['segmentation_model'] ]) 
+            if 'speaker_model_pyannote' in params and params['speaker_model_pyannote'] is not None:
+                cmd_list.extend([ "--speaker_model", params['speaker_model_pyannote'] ])
+            if 'min_cluster_size' in params and params['min_cluster_size'] is not None:
+                cmd_list.extend([ "--min_cluster_size", params['min_cluster_size'] ])
+            if 'method_cluster' in params and params['method_cluster'] is not None:
+                cmd_list.extend([ "--method_cluster", params['method_cluster'] ])
+            if 'threshold_cluster' in params and params['threshold_cluster'] is not None:
+                cmd_list.extend([ "--threshold_cluster", params['threshold_cluster'] ])                    
+            if 'workers' in params and params['workers'] is not None:
+                cmd_list.extend([ "--workers", params['workers'] ])
+            if 'cache_embeddings' in params and params['cache_embeddings']:
+                cmd_list.append("--cache_embeddings")
+            if 'batch_segmentation_files' in params and params['batch_segmentation_files'] is not None:
+                cmd_list.extend([ "--batch_segmentation_files", params['batch_segmentation_files'] ])
+            if 'quantize_segmentation' in params and params['quantize_segmentation']:
+                cmd_list.append("--quantize_segmentation")
+            if 'long_audio_block' in params and params['long_audio_block'] is not None:
+                cmd_list.extend([ "--long_audio_block", params['long_audio_block'] ])
+            if 'long_audio_overlap' in params and params['long_audio_overlap'] is not None:
+                cmd_list.extend([ "--long_audio_overlap", params['long_audio_overlap'] ])
+                                   
+        elif container_name == DockerImages.nemo_pipeline.name:
+            if 'vad_model' in params and params['vad_model'] is not None:
+                cmd_list.extend([ "--vad_model", params['vad_model'] ])
+            if 'speaker_model_nemo' in params and params['speaker_model_nemo'] is not None:
+                cmd_list.extend([ "--speaker_model", params['speaker_model_nemo'] ])
+            if 'reference_path' in params and params['reference_path'] is not None:
+                cmd_list.extend([ "--reference_path", params['reference_path'] ])
+            if 'msdd_model' in params and params['msdd_model'] is not None:
+                cmd_list.extend([ "--msdd_model", params['msdd_model'] ])
+            if 'window_lengths' in params and params['window_lengths'] is not None:
+                cmd_list.extend([ "--window_lengths", params['window_lengths'] ])                    
+            if 'batch_mode' in params and params['batch_mode']:
+                cmd_list.append("--batch_mode")
+
+        else:
+            print(f"No se ha podido preparar un comando de ejecución al contenedor {container_name}")
+            self.logger.info(f"No se ha podido preparar un comando de ejecución al contenedor {container_name}")
+            exit(1)
             
-            self.client.api.exec_start(exec_command['Id'], detach=False)
-            print(f"Ejecutando comando: {exec_command} en contenedor {self.containers[container_name].name} ...")    
-            self.logger.info(f"Ejecutando comando: {exec_command} en contenedor {self.containers[container_name].name} ...")            
+        if 'min_duration_off' in params and params['min_duration_off'] is not None:
+            cmd_list.extend([ "--min_duration_off", params['min_duration_off'] ])
+        if 'num_speakers' in params and params['num_speakers'] is not None:
+            cmd_list.extend([ "--num_speakers", params['num_speakers'] ])
+        if 'run_tag' in params and params['run_tag'] is not None:
+            cmd_list.extend([ "--run_tag", params['run_tag'] ])
+        if 'append_exec_time' in params and params['append_exec_time']:
+            cmd_list.append("--append_exec_time")
+        return cmd_list
+
+    ## Crea y arranca el comando en el contenedor, leyendo su salida en streaming en lugar de esperar a que termine
+    def _start_exec(self, container_name, cmd_list, events:queue.Queue):
+        # Sin buffer en stdout, para recibir cada línea de progreso en cuanto el script la imprime
+        exec_command = self.client.api.exec_create(self.containers[container_name].id, cmd_list, environment={"PYTHONUNBUFFERED": "1"})
+        output = self.client.api.exec_start(exec_command['Id'], stream=True)
+        self._stream_events(container_name, output, events)
+        print(f"Ejecutando comando: {exec_command} en contenedor {self.containers[container_name].name} ...")
+        self.logger.info(f"Ejecutando comando: {exec_command} en contenedor {self.containers[container_name].name} ...")
+        return exec_command['Id']
 
-            self._check_status_file(container_name)         
-            self.stop_if_running(self.containers[container_name].name)                        
+    # Este método puede ejecutar más de un contenedor distinto con sus parámetros correspondientes.
+    # Con `stop_after=False` el contenedor sigue arrancado para ejecutar más comandos (p. ej. en un barrido de hiperparámetros)
+    def execute_command(self, container_name, params:dict, stop_after=True): 
+        if self.use_worker and container_name == DockerImages.pyannote_pipeline.name:
+            return self.submit_worker_job(container_name, params)
+        sampler = None
+        try:
+            cmd_list = self._prepare_command(container_name, params)
+            events = queue.Queue()
+            sampler = self._start_sampler(container_name)
+            exec_id = self._start_exec(container_name, cmd_list, events)
+            self._wait_for_completion({container_name: exec_id}, events)
+            self._finish_sampler(container_name, sampler, params.get('append_exec_time'))
+            sampler = None
+            if stop_after:
+                self.stop_if_running(self.containers[container_name].name)                        
             return 0
         except docker.errors.NotFound:
             print(f"Container {self.containers[container_name].name} not found.")
@@ -196,30 +314,130 @@ class DockerDiarizationManager:
             self.logger.error(f"An error occurred while executing the command: {e}")
             self.stop_if_running(self.containers[container_name].name) 
             exit(1)  
+        finally:
+            self._finish_sampler(container_name, sampler, params.get('append_exec_time'))
             
             
-    def _check_status_file(self, container_name):        
-                        
-        def _in_process(visual_anim):
-            if len(visual_anim) == 60:
-                visual_anim = "_"       
-            else:    
-                visual_anim += "_"   
-            return visual_anim        
-        
-        result_path = os.path.join(self.host_volume_path, container_name+'_'+STATUS_FILE)
-        status = 0
-        visual_anim = "_"
-        while(status != FIN):
-            if(os.path.exists(result_path)):
-                with open(result_path, 'r') as file:
-                    status = file.readline()                    
-                visual_anim = _in_process(visual_anim)
-                termin = '\n' if len(visual_anim) == 60 else '\r'
-                print(f"Running {container_name} {visual_anim}", end=termin, flush=True)                
-                time.sleep(1)
-        file.close()                                
-            
+    ## Lanza a la vez los scripts de varios contenedores (cada uno con sus parámetros y su carpeta de salida) y espera a todos.
+    ## Muestra el progreso de cada contenedor y, si alguno muere o su comando termina con error, detiene el resto y sale (fail fast).
+    ## Con `use_worker`, Pyannote recibe su trabajo en el worker y sus eventos llegan a la misma cola desde los logs del contenedor.
+    def execute_commands_concurrently(self, params_by_container:dict, stop_after=True):
+        samplers = {}
+        try:
+            events = queue.Queue()
+            exec_ids = {}
+            for container_name, params in params_by_container.items():
+                samplers[container_name] = self._start_sampler(container_name)
+                if self.use_worker and container_name == DockerImages.pyannote_pipeline.name:
+                    self._start_worker_job(container_name, params, events)
+                    exec_ids[container_name] = None
+                else:
+                    cmd_list = self._prepare_command(container_name, params)
+                    exec_ids[container_name] = self._start_exec(container_name, cmd_list, events)
+            self._wait_for_completion(exec_ids, events)
+            for container_name in list(samplers):
+                self._finish_sampler(container_name, samplers.pop(container_name), params_by_container[container_name].get('append_exec_time'))
+            if stop_after:
+                for container_name in exec_ids:
+                    self.stop_if_running(self.containers[container_name].name)
+            return 0
+        except Exception as e:
+            print(f"An error occurred while executing the commands: {e}")
+            self.logger.error(f"An error occurred while executing the commands: {e}")
+            for container_name in params_by_container:
+                self.stop_if_running(self.containers[container_name].name)
+            exit(1)
+        finally:
+            for container_name, sampler in samplers.items():
+                self._finish_sampler(container_name, sampler, params_by_container[container_name].get('append_exec_time'))
+
+    ## Arranca el muestreo de recursos del contenedor con la API de estadísticas de Docker (None si no se muestrea)
+    def _start_sampler(self, container_name):
+        if not self.sample_resources:
+            return None
+        status_path = os.path.join(self.host_volume_path, container_name+'_'+STATUS_FILE)
+        stats_stream = ContainerResourceSampler.docker_stats_stream(self.containers[container_name])
+        return ContainerResourceSampler(container_name, stats_stream, status_path, self.sample_interval).start()
+
+    ## Detiene el muestreo y guarda, en la carpeta de RTTM del volumen, las muestras y el uso de recursos de cada archivo diarizado,
+    ## atribuyendo las muestras por los registros de etapas de la pipeline o, si no los hay, por el archivo de estado.
+    ## Con `append` (como --append_exec_time) se añade a los registros anteriores en lugar de sustituirlos.
+    def _finish_sampler(self, container_name, sampler, append=False):
+        if sampler is None:
+            return
+        samples = sampler.stop()
+        pipeline_name = container_name.split('_')[0].upper()
+        rttm_path = os.path.join(self.host_volume_path, "rttm")
+        usage = attribute_samples(samples, load_stage_times(stage_time_file_path(rttm_path, pipeline_name)),
+                                  load_exec_times(exec_time_file_path(rttm_path, pipeline_name)))
+        write_resource_samples(resource_samples_file_path(rttm_path, pipeline_name), samples, append=append)
+        write_resource_usage(resource_usage_file_path(rttm_path, pipeline_name), usage, append=append)
+        print(f"Muestreo de recursos de {container_name}: {len(samples)} muestras atribuidas a {len(usage)} archivos")
+        self.logger.info(f"Muestreo de recursos de {container_name}: {len(samples)} muestras atribuidas a {len(usage)} archivos")
+
+    ## Lee en un hilo las líneas de un stream de salida (de `exec_start` o de los logs del contenedor) y las convierte en eventos
+    ## de la cola: ('progress', línea) cada vez que termina un archivo, ('done', línea) si aparece `done_marker`,
+    ## ('eof', None) al cerrarse el stream y ('error', mensaje) si falla la lectura.
+    def _stream_events(self, container_name, stream, events:queue.Queue, done_marker=None):
+        def _reader():
+            buffer = ''
+            try:
+                for chunk in stream:
+                    buffer += chunk.decode('utf-8', errors='replace') if isinstance(chunk, bytes) else chunk
+                    *lines, buffer = buffer.split('\n')
+                    for line in lines:
+                        self.logger.debug(f"[{container_name}] {line}")
+                        if line.startswith(PROGRESS_PREFIX):
+                            events.put((container_name, 'progress', line))
+                        elif done_marker is not None and line.startswith(done_marker):
+                            events.put((container_name, 'done', line))
+                            return
+            except Exception as e:
+                events.put((container_name, 'error', str(e)))
+                return
+            events.put((container_name, 'eof', None))
+
+        threading.Thread(target=_reader, daemon=True).start()
+
+    ## Espera a los eventos de los contenedores hasta que todos terminan. Un comando termina bien cuando su stream se cierra
+    ## con código de salida 0 (`exec_inspect`); un trabajo del worker, cuando aparece su línea de fin con estado OK.
+    ## Cualquier otro final, o superar `exec_timeout`, es un error: así una ejecución colgada no ocupa el host indefinidamente.
+    def _wait_for_completion(self, exec_ids:dict, events:queue.Queue):
+        deadline = time.time() + self.exec_timeout if self.exec_timeout is not None else None
+        pending = set(exec_ids.keys())
+        processed_files = {container_name: 0 for container_name in exec_ids}
+        while pending:
+            remaining = deadline - time.time() if deadline is not None else None
+            try:
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                container_name, kind, payload = events.get(timeout=remaining)
+            except queue.Empty:
+                raise TimeoutError(f"Superado el tiempo máximo de {self.exec_timeout} segundos esperando a {', '.join(sorted(pending))}")
+            if kind == 'progress':
+                processed_files[container_name] += 1
+                print(f"[{container_name}] ({processed_files[container_name]}) {payload}")
+                self.logger.info(f"[{container_name}] ({processed_files[container_name]}) {payload}")
+            elif kind == 'done':
+                if not payload.rstrip().endswith('OK'):
+                    raise RuntimeError(f"El trabajo del contenedor {container_name} ha terminado con error: {payload}")
+                pending.discard(container_name)
+            elif kind == 'eof':
+                if exec_ids[container_name] is None:
+                    raise RuntimeError(f"El contenedor {container_name} se ha detenido sin terminar el trabajo")
+                exec_info = self.client.api.exec_inspect(exec_ids[container_name])
+                while exec_info['Running']:
+                    time.sleep(0.05)
+                    exec_info = self.client.api.exec_inspect(exec_ids[container_name])
+                if exec_info['ExitCode'] != 0:
+                    raise RuntimeError(f"El comando del contenedor {container_name} ha terminado con código de salida {exec_info['ExitCode']}")
+                pending.discard(container_name)
+            else:
+                raise RuntimeError(f"Error leyendo la salida del contenedor {container_name}: {payload}")
+            if kind != 'progress':
+                print(f"Contenedor {container_name} terminado ({processed_files[container_name]} archivos).")
+                self.logger.info(f"Contenedor {container_name} terminado ({processed_files[container_name]} archivos).")
+
 if __name__ == '__main__':
     speakerModels = list(SpeakerModelPyannote.__members__.values())
     speakerModels.extend(list(SpeakerModelNemo.__members__.values()))
@@ -0,0 +1,81 @@
+## Pipeline de Pyannote que persiste en disco las salidas de la segmentación y los embeddings por fragmento de cada audio.
+# Al barrer hiperparámetros del clustering (threshold, method, min_cluster_size) sólo cambia el clustering aglomerativo,
+# así que la segmentación y la extracción de embeddings, que son lo costoso, se calculan una única vez por archivo y después
+# se leen de los .npy mapeados en memoria.
+import hashlib
+import json
+import os
+import numpy as np
+from pyannote.core import SlidingWindow, SlidingWindowFeature
+from pyannote.audio.pipelines import SpeakerDiarization
+
+SEGMENTATION_FILE = "segmentation"
+EMBEDDINGS_FILE = "embeddings"
+
+
+def _save_npy(path, data):
+    with open(path + ".tmp", 'wb') as npy_file:
+        np.save(npy_file, data)
+    os.replace(path + ".tmp", path)
+
+
+class CachedSpeakerDiarization(SpeakerDiarization):
+
+    def __init__(self, cache_path, **kwargs):
+        super().__init__(**kwargs)
+        self.cache_path = cache_path
+        os.makedirs(self.cache_path, exist_ok=True)
+
+    ## Carpeta de la caché del archivo: depende de la ruta, el tamaño y la fecha de modificación del audio, para que un audio
+    # modificado no reutilice lo calculado para la versión anterior. Si el audio viene ya cargado en memoria no se cachea.
+    def _file_cache_path(self, file):
+        if "waveform" in file or not isinstance(file.get("audio"), (str, os.PathLike)):
+            return None
+        audio_path = os.path.abspath(str(file["audio"]))
+        stat = os.stat(audio_path)
+        file_key = hashlib.sha1(f"{audio_path}|{stat.st_size}|{stat.st_mtime}".encode("utf-8")).hexdigest()
+        file_cache_path = os.path.join(self.cache_path, file_key)
+        os.makedirs(file_cache_path, exist_ok=True)
+        return file_cache_path
+
+    def has_cached_segmentation(self, file):
+        file_cache_path = self._file_cache_path(file)
+        return file_cache_path is not None and os.path.exists(os.path.join(file_cache_path, SEGMENTATION_FILE + ".npy")) \
+            and os.path.exists(os.path.join(file_cache_path, SEGMENTATION_FILE + ".json"))
+
+    def get_segmentations(self, file, hook=None) -> SlidingWindowFeature:
+        file_cache_path = self._file_cache_path(file)
+        if file_cache_path is None:
+            return super().get_segmentations(file, hook=hook)
+        npy_path = os.path.join(file_cache_path, SEGMENTATION_FILE + ".npy")
+        window_path = os.path.join(file_cache_path, SEGMENTATION_FILE + ".json")
+        if os.path.exists(npy_path) and os.path.exists(window_path):
+            with open(window_path, 'r', encoding="utf-8") as window_file:
+                window = json.load(window_file)
+            # 'c' (copy-on-write): la pipeline puede modificar el array sin tocar el archivo de la caché
+            return SlidingWindowFeature(np.load(npy_path, mmap_mode='c'),
+                                        SlidingWindow(start=window["start"], duration=window["duration"], step=window["step"]))
+        segmentations = super().get_segmentations(file, hook=hook)
+        _save_npy(npy_path, segmentations.data)
+        with open(window_path, 'w', encoding="utf-8") as window_file:
+            json.dump({"start": segmentations.sliding_window.start, "duration": segmentations.sliding_window.duration,
+                       "step": segmentations.sliding_window.step}, window_file)
+        return segmentations
+
+    ## Los embeddings dependen de la segmentación binarizada: salvo en modo powerset, del umbral de segmentación.
+    # También dependen de si se excluyen los solapamientos, así que ambos forman parte del nombre del archivo.
+    def get_embeddings(self, file, binary_segmentations, exclude_overlap=False, hook=None):
+        file_cache_path = self._file_cache_path(file)
+        if file_cache_path is None:
+            return super().get_embeddings(file, binary_segmentations, exclude_overlap=exclude_overlap, hook=hook)
+        embeddings_name = EMBEDDINGS_FILE
+        if not self._segmentation.model.specifications.powerset:
+            embeddings_name += f"_thr{self.segmentation.threshold}"
+        if exclude_overlap:
+            embeddings_name += "_exov"
+        npy_path = os.path.join(file_cache_path, embeddings_name + ".npy")
+        if os.path.exists(npy_path):
+            return np.load(npy_path, mmap_mode='c')
+        embeddings = super().get_embeddings(file, binary_segmentations, exclude_overlap=exclude_overlap, hook=hook)
+        _save_npy(npy_path, embeddings)
+        return embeddings
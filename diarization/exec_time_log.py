@@ -0,0 +1,54 @@
+## Registro de tiempos de ejecución de las pipelines (`<PIPELINE>_exec_time.csv` en la carpeta de RTTM), del que metrics.py
+# calcula el RTF. Es un CSV con cabecera, una fila por archivo diarizado: cada fila se escribe con una única escritura en modo
+# append, así que varios procesos pueden añadir registros al mismo archivo sin mezclarlos. Al leerlo se indexa una única vez
+# por (archivo RTTM, combinación de modelos, dataset); si un archivo aparece varias veces vale su último registro.
+import csv
+import io
+import os
+
+EXEC_TIME_FIELDS = ["rttm_file", "combination", "dataset", "diarization_time", "duration"]
+MODEL_LOAD = "MODEL_LOAD"   # Filas con el tiempo de carga de modelos de una combinación, que no cuentan para el RTF de ningún archivo
+
+
+def exec_time_file_path(rttm_path, pipeline_name):
+    return os.path.join(rttm_path, f"{pipeline_name}_exec_time.csv")
+
+def csv_line(values):
+    line = io.StringIO()
+    csv.writer(line, lineterminator="\n").writerow(values)
+    return line.getvalue()
+
+def append_exec_time(log_path, rttm_file, combination, dataset, diarization_time, duration):
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, "a", encoding="utf-8", newline="") as log_file:
+        record = csv_line([rttm_file, combination, dataset, diarization_time, duration])
+        if log_file.tell() == 0:
+            record = csv_line(EXEC_TIME_FIELDS) + record
+        log_file.write(record)
+
+def remove_exec_times(log_path):
+    if os.path.exists(log_path):
+        os.remove(log_path)
+
+## Devuelve {(archivo RTTM, combinación, dataset): (tiempo de diarización, duración)}. La duración es None si no se registró.
+# Si no existe el CSV se lee el antiguo `<PIPELINE>_exec_time.txt` (campos separados por espacios, sin cabecera)
+def load_exec_times(log_path):
+    exec_times = {}
+    legacy_path = log_path[:-len(".csv")] + ".txt"
+    if os.path.exists(log_path):
+        with open(log_path, "r", encoding="utf-8", newline="") as log_file:
+            rows = (row for row in csv.DictReader(log_file))
+            records = ((row["rttm_file"], row["combination"], row["dataset"], row["diarization_time"], row["duration"]) for row in rows)
+            _index_records(exec_times, records)
+    elif os.path.exists(legacy_path):
+        with open(legacy_path, "r", encoding="utf-8") as log_file:
+            records = (tuple(line.split()) + (None,) * (5 - len(line.split())) for line in log_file if len(line.split()) >= 4)
+            _index_records(exec_times, records)
+    return exec_times
+
+def _index_records(exec_times, records):
+    for rttm_file, combination, dataset, diarization_time, duration in records:
+        if rttm_file == MODEL_LOAD:
+            continue
+        duration = float(duration) if duration not in (None, "", "None") else None
+        exec_times[(rttm_file, combination, dataset)] = (float(diarization_time), duration)
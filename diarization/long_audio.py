@@ -0,0 +1,152 @@
+## Diarización de grabaciones largas (p. ej. clases de varias horas de canal.uned) por bloques, con memoria acotada.
+# La pipeline de Pyannote tiene en memoria a la vez la segmentación, los embeddings y la matriz de distancias del clustering de
+# todo el audio. Aquí el audio se diariza en bloques de duración fija que se solapan, cargando sólo la forma de onda de cada bloque,
+# y los hablantes de cada bloque se enlazan con los globales comparando sus centroides de embeddings (asignación uno a uno): si el
+# más cercano supera el umbral, el hablante es nuevo. La distancia es la euclídea entre centroides normalizados, la misma escala en
+# la que el clustering aglomerativo de Pyannote aplica su umbral, así que sirve el `clustering.threshold` de la pipeline. Cada bloque aporta su parte del solape hasta
+# la mitad, y al final se unen los turnos contiguos del mismo hablante.
+#
+# Ejecutado como script compara, en audios del volumen, la diarización por bloques con la de una sola pasada (DER tomando la de
+# una sola pasada como referencia) y termina con error si alguno supera la tolerancia.
+import argparse
+import os
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import cdist
+from pyannote.core import Annotation, Segment
+from audio_duration import get_duration
+
+BLOCK_DURATION = 600.0      # Segundos de cada bloque
+BLOCK_OVERLAP = 30.0        # Segundos de solape entre bloques consecutivos
+DEFAULT_LINK_THRESHOLD = 0.7045654963945799   # Umbral por defecto del clustering de Pyannote (distancia euclídea normalizada)
+DER_TOLERANCE = 0.05
+
+
+## Distancias euclídeas entre los embeddings normalizados de `first` y de `second`, como en el clustering de Pyannote
+# (equivale a sqrt(2 * distancia coseno))
+def _normalized_distances(first, second):
+    first, second = np.asarray(first, dtype=np.float64), np.asarray(second, dtype=np.float64)
+    first = first / np.maximum(np.linalg.norm(first, axis=-1, keepdims=True), 1e-12)
+    second = second / np.maximum(np.linalg.norm(second, axis=-1, keepdims=True), 1e-12)
+    return cdist(first, second, metric="euclidean")
+
+
+## Hablantes globales: centroide de cada uno, como media de los centroides de bloque ponderada por su tiempo de habla
+class SpeakerLinker():
+
+    def __init__(self, link_threshold):
+        self.link_threshold = link_threshold
+        self.centroids = []
+        self.weights = []
+
+    ## Devuelve la etiqueta global de cada hablante del bloque y actualiza los centroides
+    def link(self, block_centroids, speech_durations):
+        mapping = {}
+        if self.centroids and len(block_centroids):
+            distances = _normalized_distances(block_centroids, np.vstack(self.centroids))
+            # Las parejas por encima del umbral no se enlazan: todas cuestan lo mismo, más que cualquier asignación de parejas válidas,
+            # para que no desplacen a las que sí se pueden enlazar
+            costs = np.where(distances <= self.link_threshold, distances, len(block_centroids) * self.link_threshold + 1)
+            rows, cols = linear_sum_assignment(costs)
+            for row, col in zip(rows, cols):
+                if distances[row, col] <= self.link_threshold:
+                    mapping[int(row)] = int(col)
+        for row in range(len(block_centroids)):
+            if row not in mapping:
+                self.centroids.append(np.array(block_centroids[row], dtype=np.float64))
+                self.weights.append(0.0)
+                mapping[row] = len(self.centroids) - 1
+            col = mapping[row]
+            weight = max(speech_durations[row], 1e-3)
+            self.centroids[col] = (self.centroids[col] * self.weights[col] + block_centroids[row] * weight) / (self.weights[col] + weight)
+            self.weights[col] += weight
+        return mapping
+
+    ## Con número de hablantes fijo, une los dos hablantes globales más cercanos hasta no superarlo. Devuelve {índice: índice final}
+    def merge_down_to(self, num_speakers):
+        merged = {index: index for index in range(len(self.centroids))}
+        active = list(range(len(self.centroids)))
+        while num_speakers is not None and len(active) > max(1, num_speakers):
+            active_centroids = np.vstack([self.centroids[index] for index in active])
+            distances = _normalized_distances(active_centroids, active_centroids)
+            np.fill_diagonal(distances, np.inf)
+            first, second = np.unravel_index(np.argmin(distances), distances.shape)
+            keep, drop = active[min(first, second)], active[max(first, second)]
+            total = self.weights[keep] + self.weights[drop]
+            self.centroids[keep] = (self.centroids[keep] * self.weights[keep] + self.centroids[drop] * self.weights[drop]) / max(total, 1e-3)
+            self.weights[keep] = total
+            active.remove(drop)
+            merged = {index: (keep if target == drop else target) for index, target in merged.items()}
+        return merged
+
+
+def _block_bounds(duration, block_duration, overlap):
+    step = block_duration - overlap
+    starts = list(np.arange(0.0, max(duration - overlap, 0.0), step)) or [0.0]
+    return [(float(start), float(min(start + block_duration, duration))) for start in starts]
+
+## Diariza `wav_file_path` por bloques. Si el audio no supera un bloque se diariza de una sola pasada, como siempre.
+def diarize_long_audio(pipeline, wav_file_path, block_duration=BLOCK_DURATION, overlap=BLOCK_OVERLAP, num_speakers=None,
+                       link_threshold=None, hook=None):
+    duration = get_duration(wav_file_path)
+    uri = os.path.splitext(os.path.basename(wav_file_path))[0]
+    if duration <= block_duration:
+        return pipeline(wav_file_path, hook=hook) if num_speakers is None else pipeline(wav_file_path, hook=hook, num_speakers=num_speakers)
+    from pyannote.audio import Audio
+    audio = Audio(sample_rate=16000, mono="downmix")
+    if link_threshold is None:
+        link_threshold = getattr(getattr(pipeline, "clustering", None), "threshold", DEFAULT_LINK_THRESHOLD)
+    linker = SpeakerLinker(link_threshold)
+    bounds = _block_bounds(duration, block_duration, overlap)
+    turns = []
+    for index, (start, end) in enumerate(bounds):
+        waveform, sample_rate = audio.crop(wav_file_path, Segment(start, end))
+        # En un bloque pueden no hablar todos: el número de hablantes se usa como máximo y se impone al final
+        block_diarization, block_centroids = pipeline({"waveform": waveform, "sample_rate": sample_rate, "uri": uri}, hook=hook,
+                                                      max_speakers=num_speakers, return_embeddings=True)
+        labels = block_diarization.labels()
+        mapping = linker.link(block_centroids[:len(labels)], [block_diarization.label_duration(label) for label in labels])
+        # Cada bloque se queda con su parte del solape hasta la mitad
+        keep_start = start + overlap / 2 if index > 0 else start
+        keep_end = end - overlap / 2 if index < len(bounds) - 1 else end
+        for segment, _, label in block_diarization.itertracks(yield_label=True):
+            segment = Segment(segment.start + start, segment.end + start) & Segment(keep_start, keep_end)
+            if segment:
+                turns.append((segment, mapping[labels.index(label)]))
+    merged = linker.merge_down_to(num_speakers)
+    diarization = Annotation(uri=uri)
+    for track, (segment, speaker) in enumerate(turns):
+        diarization[segment, track] = f"SPEAKER_{merged[speaker]:02d}"
+    return diarization.support()
+
+
+if __name__ == '__main__':
+    import torch
+    from pyannote.metrics.diarization import DiarizationErrorRate
+    from pyannote_pipeline import PATH_BASE_DATASETS, build_pipeline_params, load_pipeline
+    from dataset_scan import scan_by_extension
+    parser = argparse.ArgumentParser(description='Compara la diarización por bloques de audios largos con la de una sola pasada')
+    parser.add_argument('-hft', '--huggingface_token', type=str, help="Token de Huggingface")
+    parser.add_argument('-sem', '--segmentation_model', type=str, default='pyannote/segmentation-3.0', help="Modelo de segmentacion")
+    parser.add_argument('-sm', '--speaker_model', type=str, default='pyannote/embedding', help="Modelo de embedding o del hablante")
+    parser.add_argument('-vp', '--volume_path', type=str, help='Carpeta del volumen, con los audios en datasets')
+    parser.add_argument('-n', '--num_files', type=int, default=3, help='Número de audios del volumen con los que se compara')
+    parser.add_argument('-lab', '--long_audio_block', type=float, default=BLOCK_DURATION, help='Segundos de cada bloque')
+    parser.add_argument('-lao', '--long_audio_overlap', type=float, default=BLOCK_OVERLAP, help='Segundos de solape entre bloques')
+    parser.add_argument('-dt', '--der_tolerance', type=float, default=DER_TOLERANCE, help='DER máximo respecto de la diarización de una sola pasada')
+    args = parser.parse_args()
+
+    datasets_path = os.path.join(args.volume_path, PATH_BASE_DATASETS)
+    audio_files = [os.path.join(datasets_path, dataset, wav_audio_file) if dataset != PATH_BASE_DATASETS else os.path.join(datasets_path, wav_audio_file)
+                   for wav_audio_file, dataset in scan_by_extension(datasets_path, ".wav")]
+    audio_files = [audio_file for audio_file in audio_files if get_duration(audio_file) > args.long_audio_block][:args.num_files]
+    pipeline = load_pipeline(args.segmentation_model, args.speaker_model, args.huggingface_token, torch.device('cpu'))
+    pipeline.instantiate(build_pipeline_params(args.segmentation_model, 0.0, 'centroid', 12, DEFAULT_LINK_THRESHOLD))
+    failed = False
+    for audio_file in audio_files:
+        der = DiarizationErrorRate()(pipeline(audio_file), diarize_long_audio(pipeline, audio_file, args.long_audio_block, args.long_audio_overlap))
+        failed = failed or der > args.der_tolerance
+        print(f"{'OK ' if der <= args.der_tolerance else 'MAL'} {audio_file}: DER respecto de una sola pasada {der:.4f}")
+    if not audio_files:
+        print(f"No hay audios de más de {args.long_audio_block} segundos en {datasets_path}")
+    exit(1 if failed else 0)
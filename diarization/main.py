@@ -7,14 +7,33 @@ from converter_audio import ConverterToAudio
 from docker_diariz_manager import DockerDiarizationManager
 from docker_diariz_manager import DockerImages
 from metrics import MetricsCalculator
+from sweep import SweepRunner
 from pyannote_import import SpeakerModels as SpeakerModelPyannote, SegmentationModels
 from nemo_import import SpeakerModels as SpeakerModelNemo, VADModels, MSDDModels
 
+def get_container_name(image_name):
+    return image_name.split('/')[1].split(':')[0]  ## TODO: Podría fallar si la imagen no empieza por dasaenzd? probarlo...  
+
 def call_manager_to_execute_container(image_name, params):
-    container_name =  image_name.split('/')[1].split(':')[0]  ## TODO: Podría fallar si la imagen no empieza por dasaenzd? probarlo...  
+    container_name = get_container_name(image_name)
     if params:
         dockerManager.execute_command(container_name, params)
 
+## Convierte una cuota de la línea de comandos en un diccionario por contenedor: admite un valor común ("8")
+## o valores por contenedor ("nemo_pipeline=8,pyannote_pipeline=24")
+def parse_quota(quota, container_names):
+    quotas = {}
+    if quota is None:
+        return quotas
+    for item in quota.split(','):
+        if '=' in item:
+            container_name, value = item.split('=', 1)
+            quotas[container_name.strip()] = value.strip()
+        else:
+            for container_name in container_names:
+                quotas[container_name] = item.strip()
+    return quotas
+
 if __name__ == '__main__':    
     parser = argparse.ArgumentParser(description="Módulo principal")
     parser.add_argument('-mp', '--media_path', type=str, default='./datasets', help='Carpeta de entrada con los archivos de video(.mp4) y audio a convertir')
@@ -39,6 +58,19 @@ if __name__ == '__main__':
     parser.add_argument('-ns', '--num_speakers', default=None,  type=int, help='Indicamos el numero de speakers (pero tendría que ser el mismo número en todos los archivos). Mismo valor tanto para Pyannote como para NeMo')    
     parser.add_argument('-mm', '--msdd_model', type=str, help='Indicamos el nombre del modelo Multiescala Diarization Decoder para NeMo')
     parser.add_argument('-wl', '--window_lengths', type=str, help='Lista de longitudes de ventana para el modelo Multiscale Diarization Decoder para NeMo')    
+    parser.add_argument('-bm', '--batch_mode', action='store_true', help='NeMo carga los modelos una sola vez y los reutiliza para todos los archivos')
+    parser.add_argument('-wk', '--use_worker', action='store_true', help='Envía los trabajos al worker persistente del contenedor de Pyannote en lugar de relanzar el script')
+    parser.add_argument('-w', '--workers', type=int, help='Número de procesos de Pyannote entre los que se reparten los archivos a diarizar')
+    parser.add_argument('-qs', '--quantize_segmentation', action='store_true', help='Cuantiza a int8 el modelo de segmentación de Pyannote para inferencia en CPU')
+    parser.add_argument('-lab', '--long_audio_block', type=float, help='Pyannote diariza por bloques solapados de estos segundos los audios más largos')
+    parser.add_argument('-lao', '--long_audio_overlap', type=float, help='Segundos de solape entre bloques en la diarización por bloques de Pyannote')
+    parser.add_argument('-bsf', '--batch_segmentation_files', type=int, help='Segmentación de Pyannote por bloques de este número de archivos, con sus fragmentos en lotes compartidos')
+    parser.add_argument('-par', '--parallel', action='store_true', help='Ejecuta a la vez los contenedores de Pyannote y de NeMo')
+    parser.add_argument('-cpus', '--container_cpus', type=str, help='Cuota de CPUs por contenedor, común ("8") o por contenedor ("nemo_pipeline=8,pyannote_pipeline=24")')
+    parser.add_argument('-mem', '--container_mem', type=str, help='Límite de memoria por contenedor, común ("16g") o por contenedor ("nemo_pipeline=16g,pyannote_pipeline=8g")')
+    parser.add_argument('-swg', '--sweep_grid', type=str, help='YAML/JSON con la rejilla de modelos e hiperparámetros a barrer; el barrido se puede reanudar relanzándolo')
+    parser.add_argument('-eto', '--exec_timeout', type=float, help='Segundos máximos de espera a la ejecución de cada contenedor (sin límite si no se indica)')
+    parser.add_argument('-srs', '--sample_resources', action='store_true', help='Muestrea CPU, memoria y E/S de bloque de los contenedores durante la diarización y los añade a las métricas por archivo')
 
     parser.add_argument('-hp', '--hypotheses_path', type=str, help='Ruta de la carpeta con archivos rttm hipotesis.') 
     parser.add_argument('-rp', '--reference_path', type=str, help='Ruta de la carpeta con archivos rttm de referencia si disponemos de ellos (necesarios si se selecciona `oracle_vad` en la pipeline NeMo )')    
@@ -46,6 +78,9 @@ if __name__ == '__main__':
     parser.add_argument('-out', '--out_met_filename', type=str, default='metrics', help='Nombre del archivo de salida de métricas sin extensión')    
     parser.add_argument('-co', '--collar', type=float, default=0.0, help='Collar (Umbral de tiempo que se concede al principio y al final de cada segmento)')
     parser.add_argument('-so', '--skip_overlap', type=bool, default=False, help='Si se ignora el habla solapada o no')    
+    parser.add_argument('-mw', '--metrics_workers', type=int, help='Número de procesos para calcular las métricas (por defecto, uno por CPU)')
+    parser.add_argument('-nox', '--no_excel', action='store_true', help='Sólo escribe el CSV de métricas, sin generar el Excel')
+    parser.add_argument('-rs', '--rescore', action='store_true', help='Evalúa de nuevo todas las hipótesis, sin reutilizar el almacén de resultados')
         
     args = parser.parse_args()
 
@@ -74,13 +109,19 @@ if __name__ == '__main__':
                 if di.name.find( args.image_name.lower()) > -1:
                     images_name_list.append(di.value)
     if not args.no_diarize or args.genera_all_rttm:            
+        container_names = [get_container_name(img) for img in images_name_list]
+        cpus_quotas, mem_quotas = parse_quota(args.container_cpus, container_names), parse_quota(args.container_mem, container_names)
+        resource_limits = {container_name: {'cpus': cpus_quotas.get(container_name), 'mem_limit': mem_quotas.get(container_name)} 
+                           for container_name in container_names if container_name in cpus_quotas or container_name in mem_quotas}
         dockerManager = DockerDiarizationManager(host_volume_path=args.host_volume_path, container_volume_path=args.container_volume_path, 
-                                             image_name_list=images_name_list)     
+                                             image_name_list=images_name_list, use_worker=args.use_worker, resource_limits=resource_limits,
+                                             exec_timeout=args.exec_timeout, sample_resources=args.sample_resources)     
     if args.genera_all_rttm:
         dockerManager.run_converter_rttm_container(image_name='dasaenzd/converter_subtitles:latest', container_name='converter_java_subtitles', delta=args.delta)
     
     if not args.no_diarize:    
         params = {}
+        params_by_container = {}
         for img in images_name_list:
             if img == DockerImages.pyannote_pipeline.value:
                 params['pipeline_version'] = args.pipeline_version
@@ -117,6 +158,16 @@ if __name__ == '__main__':
                         print("Umbral de cluster debe ser un número decimal!")    
                     else:    
                         params['threshold_cluster'] = str(args.threshold_cluster)
+                if args.workers is not None and args.workers > 1:
+                    params['workers'] = str(args.workers)
+                if args.batch_segmentation_files is not None and args.batch_segmentation_files > 1:
+                    params['batch_segmentation_files'] = str(args.batch_segmentation_files)
+                if args.quantize_segmentation:
+                    params['quantize_segmentation'] = True
+                if args.long_audio_block is not None:
+                    params['long_audio_block'] = str(args.long_audio_block)
+                if args.long_audio_overlap is not None:
+                    params['long_audio_overlap'] = str(args.long_audio_overlap)
                 
             if img == DockerImages.nemo_pipeline.value:                            
                 if args.vad_model is not None:  #Nemo
@@ -141,6 +192,7 @@ if __name__ == '__main__':
                 
                 params['window_lengths'] = args.window_lengths
                 params['reference_path'] = '/data/rttm_ref'  # Pasamos el valor de la carpeta en el contenedor con los rttm de referencia              
+                params['batch_mode'] = args.batch_mode
             
             if args.min_duration_off is not None and not 'min_duration_off' in params:
                 params['min_duration_off'] = str(args.min_duration_off)
@@ -153,7 +205,16 @@ if __name__ == '__main__':
             #else:        
             #    params['num_speakers'] = None
                 
-            call_manager_to_execute_container(img, params)
+            if args.parallel or args.sweep_grid:
+                params_by_container[get_container_name(img)] = dict(params)
+            else:
+                call_manager_to_execute_container(img, params)
+        if args.sweep_grid:
+            # Los parámetros de la línea de comandos son la base de cada combinación, la rejilla los sobrescribe
+            sweep_runner = SweepRunner(dockerManager, args.sweep_grid, args.host_volume_path, params_by_container)
+            run_tags = sweep_runner.run()
+        elif args.parallel and params_by_container:
+            dockerManager.execute_commands_concurrently(params_by_container)
         
     if args.hypotheses_path is None or not os.path.exists(args.hypotheses_path): 
         args.hypotheses_path = os.path.join(args.host_volume_path, "rttm")
@@ -161,10 +222,17 @@ if __name__ == '__main__':
     if args.reference_path is None or not os.path.exists(args.reference_path):  #args.reference_path es usada para el cálculo de métricas
         args.reference_path = os.path.join(os.path.curdir, "subtitles/data/rttm_ref")
         
-    if args.metrics_list is not None and len(args.metrics_list)>0:
+    if args.sweep_grid and not args.no_diarize:
+        if os.path.exists(args.hypotheses_path) and os.path.exists(args.reference_path):
+            sweep_runner.write_consolidated_metrics(run_tags, args.hypotheses_path, args.reference_path,
+                                                    args.metrics_list if args.metrics_list else 'DER,JER,RTF', args.collar, args.skip_overlap)
+        else:
+            print("No existe la carpeta de archivos RTTM de hipótesis o la carpeta de archivos de referencia. NO se pueden calcular las métricas.")
+    elif args.metrics_list is not None and len(args.metrics_list)>0:
         if os.path.exists(args.hypotheses_path) and os.path.exists(args.reference_path):
             metrics_calc = MetricsCalculator(hypotheses_path=args.hypotheses_path, reference_path = args.reference_path, metrics_list = args.metrics_list, 
-                            out_met_filename=args.out_met_filename, collar=args.collar, skip_overlap = args.skip_overlap)
+                            out_met_filename=args.out_met_filename, collar=args.collar, skip_overlap = args.skip_overlap, workers=args.metrics_workers,
+                            write_excel=not args.no_excel, use_store=not args.rescore)
             metrics_calc.calculate_and_write_metrics()            
         else:
             print("No existe la carpeta de archivos RTTM de hipótesis o la carpeta de archivos de referencia. NO se pueden calcular las métricas.")        
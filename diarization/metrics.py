@@ -1,13 +1,13 @@
 from enum import Enum
-from io import FileIO
 import string
 import argparse
+import csv
 import os
 import logging
-import math
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
-from openpyxl import load_workbook
 from openpyxl.styles import fills, PatternFill
 from pyannote.core import Annotation, Segment
 from pyannote.metrics.diarization import DiarizationErrorRate, DiarizationCompleteness, DiarizationCoverage, DiarizationPurity, DiarizationHomogeneity, \
@@ -15,14 +15,22 @@ from pyannote.metrics.diarization import DiarizationErrorRate, DiarizationComple
 from pyannote.metrics.detection import DetectionErrorRate, DetectionAccuracy, DetectionCostFunction, DetectionPrecision, DetectionRecall, DetectionPrecisionRecallFMeasure
 from pyannote.metrics.segmentation import SegmentationCoverage, SegmentationPurity, SegmentationPurityCoverageFMeasure, SegmentationPrecision, SegmentationRecall
 from pyannote.metrics.identification import IdentificationErrorRate, IdentificationPrecision, IdentificationRecall
+from audio_duration import get_duration
+from dataset_scan import scan_by_extension_2_levels
+from exec_time_log import load_exec_times, MODEL_LOAD
+from stage_timing import load_stage_times, stage_time_file_path
+from resource_sampler import load_resource_usage, resource_usage_file_path
+from metrics_store import MetricsStore, file_hash
 
 RTTM = "rttm"
 RTTM_REF = "rttm_ref"
+TOTAL_ROW = "TOTAL"         # Fila con las métricas acumuladas de un dataset (o de todos) para una combinación de modelos
+ALL_DATASETS = "ALL"
 COLLAR = 0.
-EXECUTION_TIME_FILE = "exec_time.txt"
-EXECUTION_NEMO_TIME_FILE = "NEMO_exec_time.txt"
-EXECUTION_PYANNOTE_TIME_FILE = "PYANNOTE_exec_time.txt"  
-EXECUTION_SPEECHBRAIN_TIME_FILE = "SPEECHBRAIN_exec_time.txt"  
+EXECUTION_TIME_FILE = "exec_time.csv"
+EXECUTION_NEMO_TIME_FILE = "NEMO_exec_time.csv"
+EXECUTION_PYANNOTE_TIME_FILE = "PYANNOTE_exec_time.csv"  
+EXECUTION_SPEECHBRAIN_TIME_FILE = "SPEECHBRAIN_exec_time.csv"  
 
 
 class DatasetEnum(Enum):
@@ -60,6 +68,8 @@ class MetricsEnum(Enum):
   #IdentRec = "Identification Recall"
     # Performance
   RTF = "Real Time Factor"  
+  PeakMem = "Peak Memory (MB)"   # Muestreo de recursos de los contenedores (resource_sampler)
+  CPUSec = "CPU Seconds"
   
     
 class PipelineEnum(Enum):
@@ -87,8 +97,9 @@ class Speaker_Models(Enum):
 
 
 class MetricsByAudioFile():    
-    def __init__(self, rttm_file:str, segmentation_model:str, vad_model:str, embedding_model:str, metrics_map:dict, dataset=DatasetEnum):
+    def __init__(self, rttm_file:str, segmentation_model:str, vad_model:str, embedding_model:str, metrics_map:dict, dataset=DatasetEnum, run_tag:str=''):
         self.rttm_file = rttm_file
+        self.run_tag = run_tag
         self.segmentation_model = segmentation_model
         self.vad_model = vad_model
         self.embedding_model = embedding_model
@@ -98,37 +109,157 @@ class MetricsByAudioFile():
         else:
             self.dataset = dataset
 
-total_metrics:list[MetricsByAudioFile] = []
+    def to_row(self, metric_columns:list):
+        return [self.rttm_file, self.dataset, self.segmentation_model, self.vad_model, self.embedding_model, self.run_tag] + \
+            [self.metrics_map.get(metric, 'NA') for metric in metric_columns]
 
-def _check_in_list(tuplas_list, new_tupla):
-    for tupla in tuplas_list:
-        if tupla==new_tupla:
-            return True
-    return False    
+## Columnas fijas de la tabla de métricas; les siguen las de las métricas pedidas, en el orden de la lista
+METRICS_COLUMNS = ["Audios", "Datasets", "Pyannote Segmentation Model", "NeMo VAD Model", "P/N Embeddings Models", "Run Tag"]
 
-def _buscar_by_extension_in_dataset_2_niveles(path, extension):
-    resultados = []
-    for carpeta_actual, carpetas, _ in os.walk(path):
-        for carpeta in carpetas:
-           for subcarpeta_actual, _, archivos in os.walk(os.path.join(path, carpeta)): 
-            nombre_subcarpeta = os.path.basename(subcarpeta_actual)
-            for archivo in archivos:
-                if archivo.lower().endswith(extension):
-                    new_tupla = (archivo, nombre_subcarpeta, carpeta)
-                    if not _check_in_list(resultados, new_tupla):
-                        resultados.append(new_tupla)
-    return resultados
+## Columnas de la tabla de RTF por etapa (`<out_met_filename>_stage_rtf.csv`)
+STAGE_RTF_COLUMNS = ["Pipeline", "Combination", "Datasets", "Stage", "Audios", "Stage Time", "Audio Duration", "Stage RTF"]
+
+## RTF por etapa de cada combinación, por dataset y en todos (ALL): tiempo total de la etapa entre la duración total de los audios
+# de la combinación. La carga de modelos registrada aparte (modo batch de NeMo) sólo entra en la fila ALL.
+def stage_rtf_breakdown(stage_records:list)->pd.DataFrame:
+    if not stage_records:
+        return pd.DataFrame(columns=STAGE_RTF_COLUMNS)
+    records_df = pd.DataFrame(stage_records)
+    files_df = records_df[records_df["rttm_file"] != MODEL_LOAD].drop_duplicates(["pipeline", "combination", "dataset", "rttm_file"])
+    audio_by_dataset = files_df.groupby(["pipeline", "combination", "dataset"])["duration"].agg(["count", "sum"])
+    audio_by_combination = files_df.groupby(["pipeline", "combination"])["duration"].agg(["count", "sum"])
+    by_dataset = records_df[records_df["rttm_file"] != MODEL_LOAD].groupby(["pipeline", "combination", "dataset", "stage"], sort=False)["stage_time"].sum()
+    by_combination = records_df.groupby(["pipeline", "combination", "stage"], sort=False)["stage_time"].sum()
+    rows = []
+    for (pipeline, combination, dataset, stage), stage_time in by_dataset.items():
+        audios, duration = audio_by_dataset.loc[(pipeline, combination, dataset)]
+        rows.append([pipeline, combination, dataset, stage, int(audios), stage_time, duration, stage_time / duration if duration > 0 else np.nan])
+    for (pipeline, combination, stage), stage_time in by_combination.items():
+        audios, duration = audio_by_combination.loc[(pipeline, combination)] if (pipeline, combination) in audio_by_combination.index else (0, 0.0)
+        rows.append([pipeline, combination, ALL_DATASETS, stage, int(audios), stage_time, duration, stage_time / duration if duration > 0 else np.nan])
+    # Las filas ALL de cada combinación van tras las de sus datasets
+    stage_rtf_df = pd.DataFrame(rows, columns=STAGE_RTF_COLUMNS)
+    return stage_rtf_df.sort_values(["Pipeline", "Combination"], kind="stable", ignore_index=True)
+
+## Lee la tabla de métricas del CSV: las columnas fijas quedan como texto ('NA' incluido) y en las de métricas 'NA' es un nulo
+def read_metrics_csv(csv_path)->pd.DataFrame:
+    metric_columns = pd.read_csv(csv_path, nrows=0).columns[len(METRICS_COLUMNS):]
+    return pd.read_csv(csv_path, keep_default_na=False, na_values={metric: ['NA', ''] for metric in metric_columns},
+                       dtype={column: str for column in METRICS_COLUMNS}, float_precision='round_trip')
+
+## Lee un RTTM de una vez con pandas y construye la anotación en bloque (`Annotation.from_records`), con los tiempos exactos
+# en segundos. Cada turno va en su propia pista, así que dos turnos con el mismo segmento no se pisan
+def read_rttm(rttm_file_path, uri, modality)->Annotation:
+    turns = pd.read_csv(rttm_file_path, sep=r'\s+', header=None, usecols=[3, 4, 7], names=["start", "duration", "speaker"],
+                        dtype={"start": np.float64, "duration": np.float64, "speaker": str}, comment=';', skip_blank_lines=True,
+                        keep_default_na=False, na_filter=False)
+    turns = turns[turns["duration"].to_numpy() > 0]
+    starts = turns["start"].to_numpy()
+    ends = starts + turns["duration"].to_numpy()
+    return Annotation.from_records(zip(map(Segment, starts.tolist(), ends.tolist()), range(len(turns)), turns["speaker"].tolist()),
+                                   uri, modality)
+
+## Objetos de pyannote.metrics que se evalúan, por clave. Algunos dan varias métricas de una única evaluación (mismo alineamiento
+# referencia/hipótesis): con `detailed=True` se calculan una vez los componentes y `compute_metrics` devuelve las tres a la vez
+METRIC_GROUPS = {
+    "DetPrecRecFMeas": (lambda collar, skip_overlap: DetectionPrecisionRecallFMeasure(collar, skip_overlap), [MetricsEnum.DetPrec, MetricsEnum.DetRec, MetricsEnum.DetFMeas]),
+    "SegPurCoverFMeas": (lambda collar, skip_overlap: SegmentationPurityCoverageFMeasure(collar), [MetricsEnum.SegPur, MetricsEnum.SegCover, MetricsEnum.SegFMeas]),
+    "DiariPurCoverFMeas": (lambda collar, skip_overlap: DiarizationPurityCoverageFMeasure(collar), [MetricsEnum.DiariPur, MetricsEnum.DiariCover, MetricsEnum.DiariFMeas]),
+    MetricsEnum.DetAcc.name: (lambda collar, skip_overlap: DetectionAccuracy(collar, skip_overlap), [MetricsEnum.DetAcc]),
+    MetricsEnum.DetCost.name: (lambda collar, skip_overlap: DetectionCostFunction(collar, skip_overlap), [MetricsEnum.DetCost]),
+    MetricsEnum.DetER.name: (lambda collar, skip_overlap: DetectionErrorRate(collar, skip_overlap), [MetricsEnum.DetER]),
+    MetricsEnum.DER.name: (lambda collar, skip_overlap: DiarizationErrorRate(collar, skip_overlap), [MetricsEnum.DER]),
+    MetricsEnum.DiariCompl.name: (lambda collar, skip_overlap: DiarizationCompleteness(collar, skip_overlap), [MetricsEnum.DiariCompl]),
+    MetricsEnum.DiariHomog.name: (lambda collar, skip_overlap: DiarizationHomogeneity(collar, skip_overlap), [MetricsEnum.DiariHomog]),
+    MetricsEnum.GreedyDER.name: (lambda collar, skip_overlap: GreedyDiarizationErrorRate(collar, skip_overlap), [MetricsEnum.GreedyDER]),
+    MetricsEnum.JER.name: (lambda collar, skip_overlap: JaccardErrorRate(collar, skip_overlap), [MetricsEnum.JER]),
+}
+
+## Acumula en `metric` los componentes de una evaluación hecha en otro proceso, igual que haría `metric(reference, hypothesis)`
+def _accumulate(metric, uri, components):
+    metric.results_.append((uri, components))
+    for name in metric.components_:
+        metric.accumulated_[name] += components[name]
+
+## Valores de las métricas del grupo a partir de unos componentes, sean los de un archivo o los acumulados del corpus
+def _metric_values(metric, components):
+    if hasattr(metric, "compute_metrics"):
+        return metric.compute_metrics(components)
+    return (metric.compute_metric(components),)
+
+def _load_annotation(rttm_file_path, uri, modality):
+    if not os.path.exists(rttm_file_path):
+        return None
+    return read_rttm(rttm_file_path, uri, modality)
+
+## Anotaciones de referencia ya leídas en este proceso, por (dataset, archivo): una referencia se lee una vez por ejecución
+# aunque se evalúen contra ella todas las combinaciones de modelos. Se valida con el tamaño y la fecha de modificación del RTTM
+_reference_annotations = {}
+
+def get_reference_annotation(ref_rttm_file_path, uri):
+    key = (os.path.basename(os.path.dirname(ref_rttm_file_path)), os.path.basename(ref_rttm_file_path))
+    if not os.path.exists(ref_rttm_file_path):
+        _reference_annotations.pop(key, None)
+        return None
+    stat = os.stat(ref_rttm_file_path)
+    cached = _reference_annotations.get(key)
+    if cached is None or cached[0] != (stat.st_size, stat.st_mtime):
+        cached = ((stat.st_size, stat.st_mtime), read_rttm(ref_rttm_file_path, uri, RTTM_REF))
+        _reference_annotations[key] = cached
+    # Las métricas no modifican las anotaciones, así que todas las hipótesis comparten el mismo objeto
+    return cached[1]
+
+## Evalúa un RTTM de hipótesis contra su referencia.
+# Devuelve las métricas calculadas (por nombre de la métrica), los componentes de cada objeto de pyannote.metrics para acumularlos
+# en el proceso principal y si existe la hipótesis (para el RTF)
+def _score_hypothesis(metrics, hyp_rttm_file_path, reference, collar, skip_overlap):
+    rttm_file = os.path.basename(hyp_rttm_file_path)
+    hypothesis = _load_annotation(hyp_rttm_file_path, rttm_file, os.path.basename(os.path.dirname(hyp_rttm_file_path)))
+    if collar is None:
+        collar = 0.0
+    requested = {MetricsEnum[metric] for metric in metrics if metric in MetricsEnum.__members__}
+    values, components_by_key = {}, {}
+    for key, (factory, group) in METRIC_GROUPS.items():
+        if requested.intersection(group):
+            if hypothesis is not None and reference is not None:
+                metric = factory(collar, skip_overlap)
+                components_by_key[key] = metric(reference, hypothesis, detailed=True)
+                for member, value in zip(group, _metric_values(metric, components_by_key[key])):
+                    values[member.value] = value
+            else:
+                values.update({member.value: 'NA' for member in group})
+    return values, components_by_key, hypothesis is not None
+
+## Evalúa todas las hipótesis de una misma referencia, que se lee una sola vez. Se ejecuta en los procesos del pool,
+# por eso es una función de módulo
+def _score_reference(reference_args):
+    metrics, ref_rttm_file_path, hyp_rttm_file_paths, collar, skip_overlap = reference_args
+    reference = get_reference_annotation(ref_rttm_file_path, os.path.basename(ref_rttm_file_path))
+    return [_score_hypothesis(metrics, hyp_rttm_file_path, reference, collar, skip_overlap) for hyp_rttm_file_path in hyp_rttm_file_paths]
 
 
 class MetricsCalculator():
         
-    def __init__(self, hypotheses_path, reference_path, metrics_list, out_met_filename, collar, skip_overlap):
+    def __init__(self, hypotheses_path, reference_path, metrics_list, out_met_filename, collar, skip_overlap, workers=None, write_excel=True,
+                 use_store=True):
         self.hypotheses_path = hypotheses_path
+        self.use_store = use_store      # Reutiliza del almacén (metrics_store) las evaluaciones de hipótesis que no han cambiado
+        self.write_excel = write_excel  # El Excel con formato se genera al final a partir del CSV; sin él sólo queda el CSV
+        self.workers = workers  # Procesos para evaluar los archivos (por defecto uno por CPU)
+        self.corpus_metrics = {}  # (dataset, combinación, pipeline) -> {clave de METRIC_GROUPS: objeto de métrica acumulado}
+        self.rtf_totals = {}      # (dataset, combinación) -> [tiempo de ejecución total, duración total]
+        self.exec_times = {}      # pipeline -> registro de tiempos de ejecución ya indexado (exec_time_log.load_exec_times)
+        self.resource_totals = {} # (dataset, combinación) -> [pico de memoria, segundos de CPU totales]
+        self.resource_usage = {}  # pipeline -> uso de recursos por archivo (resource_sampler.load_resource_usage)
         self.reference_path = reference_path
         self.metrics_list = metrics_list
         self.out_met_filename = out_met_filename
         self.collar = collar
         self.skip_overlap = skip_overlap
+        self.metrics_path = os.path.join(self.hypotheses_path, os.path.pardir, "metrics")
+        self.csv_path = os.path.join(self.metrics_path, self.out_met_filename + ".csv")
+        self.stage_rtf_path = os.path.join(self.metrics_path, self.out_met_filename + "_stage_rtf.csv")
+        self._sink = None
         
         logs_path = os.path.join(self.hypotheses_path, os.path.pardir, "logs")
         if not os.path.exists(logs_path):
@@ -147,8 +278,13 @@ class MetricsCalculator():
             self.metrics_list = self.metrics_list[:-1]         
         
         
+    ## Las filas se escriben en el CSV (`<metrics>/<out_met_filename>.csv`) a medida que se evalúa cada archivo, así que
+    # si el proceso se interrumpe se conservan las ya calculadas. Devuelve la ruta del CSV.
     def calculate_and_write_metrics(self):
-        tuplas_hyp = _buscar_by_extension_in_dataset_2_niveles(self.hypotheses_path, ".rttm")                                                                         
+        tuplas_hyp = scan_by_extension_2_levels(self.hypotheses_path, ".rttm")                                                                         
+        metrics = [metric.strip() for metric in self.metrics_list.split(',')]
+        self.metric_columns = [MetricsEnum[metric].value for metric in metrics if metric in MetricsEnum.__members__]
+        tasks = []
         for tupla_hyp in tuplas_hyp:
             rttm_hyp_file = tupla_hyp[0]               
             combined_model_subfolder = tupla_hyp[1]
@@ -159,134 +295,267 @@ class MetricsCalculator():
             pipeline = PipelineEnum.PYANNOTE.name if combined_model_subfolder.startswith(PipelineEnum.PYANNOTE.value) \
                 else PipelineEnum.NEMO.name if combined_model_subfolder.startswith(PipelineEnum.NEMO.value) \
                 else PipelineEnum.SPEECHBRAIN.name
-            self.executeMetrics(self.metrics_list.split(','), self.hypotheses_path, dataset_subfolder_path, combined_model_subfolder, \
-                rttm_hyp_file, self.reference_path, pipeline, self.collar, self.skip_overlap)
+            tasks.append((dataset_subfolder_path, combined_model_subfolder, rttm_hyp_file, pipeline))
 
-        self.write_metrics()
-            
-        
-  
-    def executeMetrics(self, metrics:list, rttms_hyp_path, dataset_subfolder_path, combin_model_subfold, rttm_file, rttms_ref_path, pipeline, collar=COLLAR, skip_overlap=False):
-        
-        def _create_annot(file:FileIO, annot:Annotation)->Annotation:              
-            for line in file:
-                if line.strip() != "":
-                    data_list = line.split()
-                    annot[Segment( math.trunc(float(data_list[3])*100),     
-                        math.trunc(float(data_list[3])*100) + math.trunc(float(data_list[4])*100))] = data_list[7]
-            return annot
-                                                
+        # Las tareas se agrupan por referencia: cada grupo (un RTTM de referencia y las hipótesis de todas las combinaciones de
+        # modelos para ese audio) se evalúa en un proceso del pool, que lee la referencia una sola vez. Las filas se escriben por
+        # grupos, en el orden de los grupos, así que la tabla de salida no depende del reparto entre procesos
+        groups = {}
+        for index, (dataset_subfolder_path, combined_model_subfolder, rttm_hyp_file, _) in enumerate(tasks):
+            ref_rttm_file_path = os.path.join(self.reference_path, os.path.basename(dataset_subfolder_path), rttm_hyp_file)
+            groups.setdefault(ref_rttm_file_path, []).append((index, os.path.join(dataset_subfolder_path, combined_model_subfolder, rttm_hyp_file)))
+        os.makedirs(self.metrics_path, exist_ok=True)
+        store = MetricsStore(self.metrics_path)
+        all_groups = dict(groups)
+        stored_scores, pending_hashes = self._restore_stored_scores(store, metrics, groups)
+        reference_args = [(metrics, ref_rttm_file_path, [hyp_rttm_file_path for _, hyp_rttm_file_path in group], self.collar, self.skip_overlap)
+                          for ref_rttm_file_path, group in groups.items()]
+        with open(self.csv_path, 'w', encoding="utf-8", newline='') as csv_file:
+            self._sink = (csv_file, csv.writer(csv_file))
+            self._sink[1].writerow(METRICS_COLUMNS + self.metric_columns)
+            if self.workers == 1 or len(groups) < 2:
+                group_scores = map(_score_reference, reference_args)
+                self._record_scores(metrics, tasks, self._scores_as_completed(store, all_groups, groups, group_scores, stored_scores, pending_hashes))
+            else:
+                with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                    chunksize = max(1, len(groups) // ((self.workers or os.cpu_count() or 1) * 4))
+                    group_scores = executor.map(_score_reference, reference_args, chunksize=chunksize)
+                    self._record_scores(metrics, tasks, self._scores_as_completed(store, all_groups, groups, group_scores, stored_scores, pending_hashes))
+            store.close()
+            self._sink = None
+        print(f"Métricas escritas en {self.csv_path}")
+        self.logger.info(f"Métricas escritas en {self.csv_path}")
+
+        self.write_stage_rtf()
+        if self.write_excel:
+            self.write_metrics()
+        return self.csv_path
+
+    def _collar_value(self):
+        return self.collar if self.collar is not None else 0.0
+
+    ## Saca de los grupos las hipótesis cuyas métricas ya están en el almacén (mismo contenido de hipótesis y referencia, mismo
+    # collar y skip_overlap) y recalcula sus valores a partir de los componentes guardados. Devuelve esas puntuaciones, por índice
+    # de tarea, y los hashes (hipótesis, referencia) de las que quedan por evaluar, para guardarlas después.
+    def _restore_stored_scores(self, store:MetricsStore, metrics:list, groups:dict):
+        requested = {MetricsEnum[metric] for metric in metrics if metric in MetricsEnum.__members__}
+        metric_keys = [key for key, (_, group) in METRIC_GROUPS.items() if requested.intersection(group)]
+        stored_scores, pending_hashes = {}, {}
+        for ref_rttm_file_path in list(groups):
+            if not os.path.exists(ref_rttm_file_path) or not metric_keys:
+                continue
+            ref_hash = file_hash(ref_rttm_file_path)
+            pending = []
+            for index, hyp_rttm_file_path in groups[ref_rttm_file_path]:
+                hyp_hash = file_hash(hyp_rttm_file_path)
+                components_by_key = store.get(hyp_hash, ref_hash, metric_keys, self._collar_value(), self.skip_overlap) if self.use_store else None
+                if components_by_key is None:
+                    pending.append((index, hyp_rttm_file_path))
+                    pending_hashes[index] = (hyp_hash, ref_hash)
+                    continue
+                values = {}
+                for key, components in components_by_key.items():
+                    metric = METRIC_GROUPS[key][0](self._collar_value(), self.skip_overlap)
+                    for member, value in zip(METRIC_GROUPS[key][1], _metric_values(metric, components)):
+                        values[member.value] = value
+                stored_scores[index] = (values, components_by_key, True)
+            if pending:
+                groups[ref_rttm_file_path] = pending
+            else:
+                del groups[ref_rttm_file_path]
+        if stored_scores:
+            print(f"Reutilizadas del almacén de resultados las métricas de {len(stored_scores)} hipótesis")
+            self.logger.info(f"Reutilizadas del almacén de resultados las métricas de {len(stored_scores)} hipótesis")
+        return stored_scores, pending_hashes
+
+    ## Devuelve (índice de tarea, puntuación) grupo a grupo, en el orden de los grupos, según se evalúa cada uno: las recuperadas del
+    # almacén y las recién calculadas, que se guardan en el almacén en ese momento. Así las filas llegan al CSV sin esperar al resto
+    def _scores_as_completed(self, store:MetricsStore, all_groups:dict, groups:dict, group_scores, stored_scores:dict, pending_hashes:dict):
+        group_scores = iter(group_scores)
+        for ref_rttm_file_path, group in all_groups.items():
+            scores = {index: stored_scores[index] for index, _ in group if index in stored_scores}
+            if ref_rttm_file_path in groups:
+                entries = []
+                for (index, _), score in zip(groups[ref_rttm_file_path], next(group_scores)):
+                    scores[index] = score
+                    if index in pending_hashes and score[1]:
+                        entries.append(pending_hashes[index] + (score[1],))
+                store.put_many(entries, self._collar_value(), self.skip_overlap)
+            for index in sorted(scores):
+                yield index, scores[index]
+
+    def _record_scores(self, metrics:list, tasks:list, indexed_scores):
+        for index, (values, components_by_key, hypothesis_found) in indexed_scores:
+            dataset_subfolder_path, combined_model_subfolder, rttm_hyp_file, pipeline = tasks[index]
+            self.executeMetrics(metrics, self.hypotheses_path, dataset_subfolder_path, combined_model_subfolder, rttm_hyp_file, pipeline,
+                                values, hypothesis_found)
+            # Un único objeto de métrica por (dataset, combinación, métrica) acumula los componentes de todos sus archivos
+            corpus_metrics = self.corpus_metrics.setdefault((os.path.basename(dataset_subfolder_path), combined_model_subfolder, pipeline), {})
+            for key, components in components_by_key.items():
+                if key not in corpus_metrics:
+                    corpus_metrics[key] = METRIC_GROUPS[key][0](self._collar_value(), self.skip_overlap)
+                _accumulate(corpus_metrics[key], rttm_hyp_file, components)
+        self._add_corpus_rows(metrics)
+
+    ## Filas TOTAL de cada dataset y combinación y filas ALL de cada combinación sobre todos los datasets. Salen de los componentes
+    # acumulados (p. ej. DER = errores totales / duración total de la referencia), no de promediar los porcentajes de cada archivo
+    def _add_corpus_rows(self, metrics:list):
+        combinations = {}
+        for (dataset, combined_model_subfolder, pipeline), corpus_metrics in self.corpus_metrics.items():
+            self._append_row(TOTAL_ROW, dataset, combined_model_subfolder, pipeline,
+                             self._corpus_metrics_map(metrics, corpus_metrics, [self.rtf_totals.get((dataset, combined_model_subfolder))],
+                                                      [self.resource_totals.get((dataset, combined_model_subfolder))]))
+            combinations.setdefault((combined_model_subfolder, pipeline), []).append(dataset)
+        all_metrics_maps = self.grouped_corpus_metrics(metrics, lambda combined_model_subfolder, pipeline: (combined_model_subfolder, pipeline))
+        for (combined_model_subfolder, pipeline) in sorted(combinations):
+            self._append_row(TOTAL_ROW, ALL_DATASETS, combined_model_subfolder, pipeline, all_metrics_maps[(combined_model_subfolder, pipeline)])
+
+    ## Métricas del corpus de cada grupo de (combinación, pipeline) según `group_of(combinación, pipeline)` (None para no incluirla),
+    # acumulando los componentes de todos sus datasets y combinaciones en un único objeto de métrica, como las filas ALL.
+    # Devuelve {grupo: {nombre de la métrica: valor}}
+    def grouped_corpus_metrics(self, metrics:list, group_of):
+        groups = {}
+        for (dataset, combined_model_subfolder, pipeline), corpus_metrics in self.corpus_metrics.items():
+            group = group_of(combined_model_subfolder, pipeline)
+            if group is None:
+                continue
+            group_metrics, rtf_totals, resource_totals = groups.setdefault(group, ({}, [], []))
+            for key, metric in corpus_metrics.items():
+                if key not in group_metrics:
+                    group_metrics[key] = METRIC_GROUPS[key][0](self._collar_value(), self.skip_overlap)
+                _accumulate(group_metrics[key], f"{dataset}/{combined_model_subfolder}", metric.accumulated_)
+            rtf_totals.append(self.rtf_totals.get((dataset, combined_model_subfolder)))
+            resource_totals.append(self.resource_totals.get((dataset, combined_model_subfolder)))
+        return {group: self._corpus_metrics_map(metrics, group_metrics, rtf_totals, resource_totals)
+                for group, (group_metrics, rtf_totals, resource_totals) in groups.items()}
+
+    def _corpus_metrics_map(self, metrics:list, corpus_metrics:dict, rtf_totals:list, resource_totals:list):
+        values = {}
+        for key, metric in corpus_metrics.items():
+            for member, value in zip(METRIC_GROUPS[key][1], _metric_values(metric, metric.accumulated_)):
+                values[member.value] = value
+        metrics_map = {}
+        for metric in metrics:
+            if metric == MetricsEnum.RTF.name:
+                # RTF del corpus: tiempo total de ejecución entre duración total de los audios
+                rtf_totals = [rtf_total for rtf_total in rtf_totals if rtf_total is not None]
+                metrics_map[MetricsEnum.RTF.value] = sum(exec_time for exec_time, _ in rtf_totals) / sum(duration for _, duration in rtf_totals) \
+                    if rtf_totals and sum(duration for _, duration in rtf_totals) > 0 else 'NA'
+            elif metric in (MetricsEnum.PeakMem.name, MetricsEnum.CPUSec.name):
+                # Del corpus: el mayor pico de memoria y la suma de los segundos de CPU de sus archivos
+                resource_totals = [resource_total for resource_total in resource_totals if resource_total is not None]
+                metrics_map[MetricsEnum[metric].value] = 'NA' if not resource_totals \
+                    else max(peak_memory for peak_memory, _ in resource_totals) if metric == MetricsEnum.PeakMem.name \
+                    else sum(cpu_seconds for _, cpu_seconds in resource_totals)
+            elif metric in MetricsEnum.__members__:
+                metrics_map[MetricsEnum[metric].value] = values.get(MetricsEnum[metric].value, 'NA')
+        return metrics_map
+
+    ## Construye la fila de un archivo con las métricas ya calculadas (`values`), en el orden pedido, y añade el RTF y el uso de recursos
+    def executeMetrics(self, metrics:list, rttms_hyp_path, dataset_subfolder_path, combin_model_subfold, rttm_file, pipeline, values:dict, hypothesis_found:bool):
         dataset = os.path.basename(dataset_subfolder_path)
-        hyp_rttm_file_path = os.path.join(dataset_subfolder_path, combin_model_subfold, rttm_file)
-        ref_rttm_file_path = os.path.join(rttms_ref_path, dataset, rttm_file)
-        hypothesis, reference = None, None
-        if os.path.exists(hyp_rttm_file_path):    
-            hypothesis = Annotation(rttm_file, combin_model_subfold)
-            with open(hyp_rttm_file_path, 'r') as hyp_file:
-                hypothesis = _create_annot(hyp_file, hypothesis)
-            hyp_file.close()    
-        
-        if os.path.exists(ref_rttm_file_path):    
-            reference = Annotation(rttm_file, RTTM_REF)
-            with open(ref_rttm_file_path, 'r') as ref_file:
-                reference = _create_annot(ref_file, reference)
-            ref_file.close()    
-        if collar is None:
-            collar = 0.0 
+        resources_requested = hypothesis_found and (MetricsEnum.PeakMem.name in metrics or MetricsEnum.CPUSec.name in metrics)
+        usage = self._resource_usage(rttms_hyp_path, dataset, combin_model_subfold, rttm_file, pipeline) if resources_requested else None
         metrics_map = {}
-                                        
         for metric in metrics:
-            metric = metric.strip()        
-            match metric:
-                case MetricsEnum.DetAcc.name : metrics_map[ MetricsEnum.DetAcc.value] = DetectionAccuracy(collar, skip_overlap)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                case MetricsEnum.DetCost.name : metrics_map[ MetricsEnum.DetCost.value] = DetectionCostFunction(collar, skip_overlap)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                case MetricsEnum.DetER.name : metrics_map[ MetricsEnum.DetER.value] = DetectionErrorRate(collar, skip_overlap)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                case MetricsEnum.DetPrec.name : metrics_map[ MetricsEnum.DetPrec.value] = DetectionPrecision(collar, skip_overlap)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                case MetricsEnum.DetRec.name : metrics_map[ MetricsEnum.DetRec.value] = DetectionRecall(collar, skip_overlap)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                case MetricsEnum.DetFMeas.name : metrics_map[ MetricsEnum.DetFMeas.value] = DetectionPrecisionRecallFMeasure(collar, skip_overlap)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                case MetricsEnum.SegPur.name : metrics_map[ MetricsEnum.SegPur.value] = SegmentationPurity(collar)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                case MetricsEnum.SegCover.name : metrics_map[ MetricsEnum.SegCover.value] = SegmentationCoverage(collar)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                case MetricsEnum.SegFMeas.name : metrics_map[ MetricsEnum.SegFMeas.value] = SegmentationPurityCoverageFMeasure(collar)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                case MetricsEnum.DER.name : metrics_map[ MetricsEnum.DER.value] = DiarizationErrorRate(collar, skip_overlap)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                case MetricsEnum.DiariCompl.name : metrics_map[ MetricsEnum.DiariCompl.value] = DiarizationCompleteness(collar, skip_overlap)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                case MetricsEnum.DiariPur.name : metrics_map[ MetricsEnum.DiariPur.value] = DiarizationPurity(collar)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'            
-                case MetricsEnum.DiariCover.name : metrics_map[ MetricsEnum.DiariCover.value] = DiarizationCoverage(collar)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                case MetricsEnum.DiariFMeas.name : metrics_map[ MetricsEnum.DiariFMeas.value] = DiarizationPurityCoverageFMeasure(collar)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'            
-                case MetricsEnum.DiariHomog.name : metrics_map[ MetricsEnum.DiariHomog.value] = DiarizationHomogeneity(collar, skip_overlap)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'                        
-                case MetricsEnum.GreedyDER.name : metrics_map[ MetricsEnum.GreedyDER.value] = GreedyDiarizationErrorRate(collar, skip_overlap)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                case MetricsEnum.JER.name : metrics_map[ MetricsEnum.JER.value] = JaccardErrorRate(collar, skip_overlap)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                #case MetricsEnum.IER.name : metrics_map[ MetricsEnum.IER.value] = IdentificationErrorRate(collar)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                #case MetricsEnum.IdentPrec.name : metrics_map[ MetricsEnum.IdentPrec.value] = IdentificationPrecision(collar)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                #case MetricsEnum.IdentRec.name : metrics_map[ MetricsEnum.IdentRec.value] = IdentificationRecall(collar)(reference, hypothesis) if hypothesis is not None and reference is not None else 'NA'
-                
+            if metric == MetricsEnum.RTF.name:
                 #La métrica de rendimiento lleva un proceso totalmente distinto
-                case MetricsEnum.RTF.name : metrics_map[MetricsEnum.RTF.value] = self._calcula_ratio(rttms_hyp_path, dataset_subfolder_path, combin_model_subfold, rttm_file, pipeline) if hypothesis is not None else 'NA'
-        mbaf = MetricsByAudioFile(rttm_file, combin_model_subfold.split('__')[1].split('+')[0], VAD_Models._.value, combin_model_subfold.split('__')[1].split('+')[1], metrics_map, dataset) if pipeline == PipelineEnum.PYANNOTE.name \
-            else MetricsByAudioFile(rttm_file, PipelineVersions._.value, combin_model_subfold.split('__')[1].split('+')[0], combin_model_subfold.split('__')[1].split('+')[1], metrics_map, dataset) if pipeline == PipelineEnum.NEMO.name \
+                metrics_map[MetricsEnum.RTF.value] = self._calcula_ratio(rttms_hyp_path, dataset_subfolder_path, combin_model_subfold, rttm_file, pipeline) if hypothesis_found else 'NA'
+            elif metric in (MetricsEnum.PeakMem.name, MetricsEnum.CPUSec.name):
+                metrics_map[MetricsEnum[metric].value] = 'NA' if usage is None else usage[0] if metric == MetricsEnum.PeakMem.name else usage[1]
+            elif metric in MetricsEnum.__members__ and MetricsEnum[metric].value in values:
+                metrics_map[MetricsEnum[metric].value] = values[MetricsEnum[metric].value]
+        self._append_row(rttm_file, dataset, combin_model_subfold, pipeline, metrics_map)
+
+    def _append_row(self, rttm_file, dataset, combin_model_subfold, pipeline, metrics_map:dict):
+        # Lo que sigue a los modelos tras otro '__' es la etiqueta de la ejecución (barridos de hiperparámetros)
+        run_tag = '__'.join(combin_model_subfold.split('__')[2:])
+        mbaf = MetricsByAudioFile(rttm_file, combin_model_subfold.split('__')[1].split('+')[0], VAD_Models._.value, combin_model_subfold.split('__')[1].split('+')[1], metrics_map, dataset, run_tag) if pipeline == PipelineEnum.PYANNOTE.name \
+            else MetricsByAudioFile(rttm_file, PipelineVersions._.value, combin_model_subfold.split('__')[1].split('+')[0], combin_model_subfold.split('__')[1].split('+')[1], metrics_map, dataset, run_tag) if pipeline == PipelineEnum.NEMO.name \
             else None    
-        total_metrics.append(mbaf)
+        if mbaf is not None:
+            self._sink[1].writerow(mbaf.to_row(self.metric_columns))
+            self._sink[0].flush()
+
+    ## Escribe el RTF por etapa a partir de los registros de etapas de las pipelines, si los hay. Devuelve la ruta del CSV o None.
+    def write_stage_rtf(self):
+        stage_records = []
+        for pipeline in PipelineEnum:
+            for record in load_stage_times(stage_time_file_path(self.hypotheses_path, pipeline.name)):
+                record["pipeline"] = pipeline.value
+                stage_records.append(record)
+        if os.path.exists(self.stage_rtf_path):
+            os.remove(self.stage_rtf_path)
+        if not stage_records:
+            return None
+        stage_rtf_breakdown(stage_records).to_csv(self.stage_rtf_path, index=False, na_rep='NA')
+        print(f"RTF por etapa escrito en {self.stage_rtf_path}")
+        self.logger.info(f"RTF por etapa escrito en {self.stage_rtf_path}")
+        return self.stage_rtf_path
 
+    ## Genera el Excel con formato a partir del CSV de métricas; las filas de NeMo (sin modelo de segmentación) van sombreadas
     def write_metrics(self):    
-        index = [ i for i, _ in enumerate(total_metrics)]
-        columns = ["Audios", "Datasets", "Pyannote Segmentation Model", "NeMo VAD Model", "P/N Embeddings Models"]
-        rttm_files = [ mbaf.rttm_file for mbaf in total_metrics]    
-        datasets = [ mbaf.dataset for mbaf in total_metrics]        
-        segmentation_models = [ mbaf.segmentation_model for mbaf in total_metrics]
-        vad_models = [ mbaf.vad_model for mbaf in total_metrics]
-        embeddings_models = [ mbaf.embedding_model for mbaf in total_metrics]
-        data = {"Audios": rttm_files, "Datasets": datasets, "Pyannote Segmentation Model": segmentation_models, "NeMo VAD Model": vad_models, "P/N Embeddings Models": embeddings_models}
-        list_metrics = [mbaf.metrics_map for mbaf in total_metrics]
-        for metrics in list_metrics:
-            for metric in metrics.keys():
-                if metric not in columns:
-                    columns += [metric]
-                if not metric in data:
-                    data[metric]=[metrics[metric]]
-                else: 
-                    data[metric].append(metrics[metric])
-
-        metrics_df = pd.DataFrame(data, index = index, columns=columns)  
-        metrics_path = os.path.join(self.hypotheses_path, os.path.pardir, "metrics")
-        if not os.path.exists(metrics_path):
-            os.makedirs( metrics_path, exist_ok=True )          
-        export_path = os.path.join(metrics_path, self.out_met_filename + ".xlsx")
-        metrics_df.to_excel(export_path,  index=False)
-        wb = load_workbook(export_path)
-        ws = wb["Sheet1"]   
-        ws.column_dimensions['A'].width = 55
-        ws.column_dimensions['B'].width = 15
-        ws.column_dimensions['C'].width = 30
-        ws.column_dimensions['D'].width = 20
-        ws.column_dimensions['E'].width = 30
-        for letter in string.ascii_uppercase[5:]:
-            ws.column_dimensions[letter].width = 27
-            
-        odd_fill = PatternFill(fills.FILL_PATTERN_LIGHTUP)               
-        for number in range(2, len(index)+2):        
-            if ws.cell(row=number, column=3).value == 'NA':
+        metrics_df = read_metrics_csv(self.csv_path)
+        export_path = os.path.join(self.metrics_path, self.out_met_filename + ".xlsx")
+        with pd.ExcelWriter(export_path, engine="openpyxl") as writer:
+            metrics_df.to_excel(writer, sheet_name="Sheet1", index=False, na_rep='NA')
+            ws = writer.sheets["Sheet1"]
+            ws.column_dimensions['A'].width = 55
+            ws.column_dimensions['B'].width = 15
+            ws.column_dimensions['C'].width = 30
+            ws.column_dimensions['D'].width = 20
+            ws.column_dimensions['E'].width = 30
+            ws.column_dimensions['F'].width = 30
+            for letter in string.ascii_uppercase[6:]:
+                ws.column_dimensions[letter].width = 27
+                
+            odd_fill = PatternFill(fills.FILL_PATTERN_LIGHTUP)               
+            for number in np.flatnonzero(metrics_df["Pyannote Segmentation Model"].to_numpy() == 'NA') + 2:
                 for y in range(1, ws.max_column+1):
-                    ws.cell(row=number, column=y).fill = odd_fill
-            
-        wb.save(export_path)
+                    ws.cell(row=int(number), column=y).fill = odd_fill
+            if os.path.exists(self.stage_rtf_path):
+                pd.read_csv(self.stage_rtf_path, keep_default_na=False, na_values={"Stage RTF": ['NA']}).to_excel(
+                    writer, sheet_name="Stage RTF", index=False, na_rep='NA')
+                for letter, width in zip("ABCDEFGH", [12, 55, 20, 20, 10, 15, 15, 15]):
+                    writer.sheets["Stage RTF"].column_dimensions[letter].width = width
+        print(f"Métricas escritas en {export_path}")
+        self.logger.info(f"Métricas escritas en {export_path}")
         
         
     ## Buscamos el archivo en el que está guardado el tiempo de ejecución del archivo de ese dataset usando ese modelo    
     def _calcula_ratio(self, base_rttms_hyp_path, dataset_subfolder_path, combined_model, rttm_file, pipeline:str):        
         rtf = 'NA'   
-        exec_file_path = os.path.join(base_rttms_hyp_path, pipeline + '_' + EXECUTION_TIME_FILE)
         dataset = os.path.basename(dataset_subfolder_path)
-        with open(exec_file_path, 'r', encoding="utf-8") as exec_file:
-            for line in exec_file:
-                word = line.rstrip().split(" ")
-                if rttm_file == word[0] and combined_model == word[1] and dataset == word[2]:
-                    exec_time = word[3]
-                    duration = word[4]        
-                    break
-        if rttm_file == word[0] and combined_model == word[1] and dataset == word[2]:
+        if pipeline not in self.exec_times:
+            # El registro de cada pipeline se lee e indexa una sola vez para todos sus archivos
+            self.exec_times[pipeline] = load_exec_times(os.path.join(base_rttms_hyp_path, pipeline + '_' + EXECUTION_TIME_FILE))
+        exec_record = self.exec_times[pipeline].get((rttm_file, combined_model, dataset))
+        if exec_record is not None:
+            exec_time, duration = exec_record
+            if duration is None or duration <= 0:
+                # Si el registro no trae la duración, se lee de la cabecera del audio del dataset
+                wav_file_path = os.path.join(base_rttms_hyp_path, os.path.pardir, "datasets", dataset, rttm_file.replace('.rttm', '.wav'))
+                duration = get_duration(wav_file_path) if os.path.exists(wav_file_path) else None
+            if duration is None or duration <= 0:
+                return rtf
             rtf = float(exec_time)/float(duration)  # Real-Time Factor
+            rtf_total = self.rtf_totals.setdefault((dataset, combined_model), [0.0, 0.0])
+            rtf_total[0] += float(exec_time)
+            rtf_total[1] += float(duration)
             self.logger.info(f"Ratio de procesamiento del audio {rttm_file.replace('.rttm', '')}: {str(rtf)}")
             print(f"Ratio de procesamiento del audio {rttm_file.replace('.rttm', '')}: {str(rtf)}")          
         return rtf
+
+    ## Pico de memoria (MB) y segundos de CPU del archivo según el muestreo de recursos del contenedor, o None si no se muestreó
+    def _resource_usage(self, base_rttms_hyp_path, dataset, combined_model, rttm_file, pipeline:str):
+        if pipeline not in self.resource_usage:
+            self.resource_usage[pipeline] = load_resource_usage(resource_usage_file_path(base_rttms_hyp_path, pipeline))
+        usage = self.resource_usage[pipeline].get((rttm_file, combined_model, dataset))
+        if usage is not None:
+            resource_total = self.resource_totals.setdefault((dataset, combined_model), [0.0, 0.0])
+            resource_total[0] = max(resource_total[0], usage[0])
+            resource_total[1] += usage[1]
+        return usage
             
 
 if __name__ == '__main__':
@@ -297,11 +566,15 @@ if __name__ == '__main__':
     parser.add_argument('-out', '--out_met_filename', type=str, default='metrics', help='Nombre del archivo de salida de métricas sin extensión')
     parser.add_argument('-co', '--collar', type=float, help='Collar (Umbral de holgura al principio  al final de cada segmento)')
     parser.add_argument('-so', '--skip_overlap', type=bool, default=False, help='Si se ignora el habla solapada o no')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Número de procesos para evaluar los archivos (por defecto, uno por CPU)')
+    parser.add_argument('-nox', '--no_excel', action='store_true', help='Sólo escribe el CSV de métricas, sin generar el Excel')
+    parser.add_argument('-rs', '--rescore', action='store_true', help='Evalúa de nuevo todas las hipótesis, sin reutilizar el almacén de resultados')
     args = parser.parse_args()
             
     if os.path.exists(args.hypotheses_path) and os.path.exists(args.reference_path):
         metrics_calc = MetricsCalculator(hypotheses_path=args.hypotheses_path, reference_path=args.reference_path, metrics_list=args.metrics_list, 
-                            out_met_filename=args.out_met_filename, collar=args.collar, skip_overlap=args.skip_overlap)
+                            out_met_filename=args.out_met_filename, collar=args.collar, skip_overlap=args.skip_overlap, workers=args.workers,
+                            write_excel=not args.no_excel, use_store=not args.rescore)
         metrics_calc.calculate_and_write_metrics()
     else:
         print("No existe la carpeta de archivos RTTM de hipótesis o la carpeta de archivos de referencia. NO se pueden calcular las métricas.")
@@ -0,0 +1,42 @@
+## Almacén de resultados de metrics.py (SQLite, `<metrics>/metrics_store.sqlite`) para no volver a evaluar hipótesis ya evaluadas.
+# Cada entrada son los componentes de un objeto de pyannote.metrics (una clave de METRIC_GROUPS) para un par hipótesis/referencia,
+# identificado por el hash del contenido de ambos RTTM y por el collar y skip_overlap con que se evaluó. Con los componentes se
+# recalculan las métricas del archivo y se acumulan las del corpus igual que si se acabaran de evaluar.
+import hashlib
+import json
+import os
+import sqlite3
+
+METRICS_STORE_FILE = "metrics_store.sqlite"
+
+
+def file_hash(file_path):
+    with open(file_path, 'rb') as rttm_file:
+        return hashlib.sha1(rttm_file.read()).hexdigest()
+
+
+class MetricsStore:
+
+    def __init__(self, metrics_path):
+        os.makedirs(metrics_path, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(metrics_path, METRICS_STORE_FILE))
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (hyp_hash TEXT, ref_hash TEXT, metric TEXT, collar REAL, "
+                                "skip_overlap INTEGER, components TEXT, PRIMARY KEY (hyp_hash, ref_hash, metric, collar, skip_overlap))")
+        self.connection.commit()
+
+    ## Componentes guardados de las métricas pedidas ({métrica: componentes}), o None si falta alguna
+    def get(self, hyp_hash, ref_hash, metric_keys, collar, skip_overlap):
+        rows = self.connection.execute("SELECT metric, components FROM results WHERE hyp_hash = ? AND ref_hash = ? AND collar = ? AND skip_overlap = ?",
+                                       (hyp_hash, ref_hash, collar, int(skip_overlap))).fetchall()
+        components_by_key = {metric: json.loads(components) for metric, components in rows if metric in metric_keys}
+        return components_by_key if len(components_by_key) == len(metric_keys) else None
+
+    ## Guarda en una única transacción una lista de (hash hipótesis, hash referencia, {métrica: componentes})
+    def put_many(self, entries, collar, skip_overlap):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                                        [(hyp_hash, ref_hash, metric, collar, int(skip_overlap), json.dumps(components, default=float))
+                                         for hyp_hash, ref_hash, components_by_key in entries for metric, components in components_by_key.items()])
+
+    def close(self):
+        self.connection.close()
@@ -8,11 +8,18 @@ import wget
 import numpy as np
 from nemo.collections.asr.models import ClusteringDiarizer
 from nemo_import import VADModels as VADModels
-from pydub import AudioSegment
+from result_cache import ResultCache
+from audio_duration import get_duration
+from dataset_scan import scan_by_extension
+from exec_time_log import append_exec_time, MODEL_LOAD
+from stage_timing import StageTimer, MODEL_LOAD_STAGE, OTHER_STAGE, append_stage_times, remove_stage_times, load_stage_times, \
+    write_chrome_trace, instrument_clustering_diarizer
 import torch
 
 STATUS_FILE = 'nemo_pipeline_status.txt'
-EXECUTION_TIME_FILE = "NEMO_exec_time.txt"
+EXECUTION_TIME_FILE = "NEMO_exec_time.csv"
+STAGE_TIME_FILE = "NEMO_stage_times.csv"
+CHROME_TRACE_FILE = "NEMO_stage_trace.json"
 PATH_BASE_DATASETS = "datasets"
 FIN="FIN"
 
@@ -26,14 +33,16 @@ def save_status(info_text):
         info_file.write(info_text)
         info_file.close()
 
-def _buscar_by_extension_in_dataset(path, extension):
-    resultados = []
-    for carpeta_actual, subcarpetas, archivos in os.walk(path):
-        nombre_carpeta = os.path.basename(carpeta_actual)
-        for archivo in archivos:
-            if archivo.lower().endswith(extension):
-                resultados.append((archivo, nombre_carpeta))
-    return resultados    
+## Devuelve un ClusteringDiarizer ya cargado para el tipo de VAD indicado, creándolo solo la primera vez.
+# El constructor es el que carga los checkpoints de VAD y de embeddings, por eso en modo batch se reutiliza entre archivos
+# y únicamente se cambian el manifiesto y la carpeta de salida. El modelo de embeddings se comparte entre diarizadores.
+def get_warm_diarizer(warm_diarizers:dict, config, vad_key:str):
+    if vad_key in warm_diarizers:
+        return warm_diarizers[vad_key], None
+    start_time = time.time()
+    speaker_model = next(iter(warm_diarizers.values()))._speaker_model if warm_diarizers else None
+    warm_diarizers[vad_key] = ClusteringDiarizer(cfg=config, speaker_model=speaker_model)
+    return warm_diarizers[vad_key], time.time() - start_time
 
 if __name__ == '__main__':
 
@@ -46,6 +55,11 @@ if __name__ == '__main__':
     parser.add_argument('-ns', '--num_speakers', default=None,  type=int, help='Indicamos el numero de speakers (pero tendría que ser el mismo número en todos los archivos)')    
     parser.add_argument('-mm', '--msdd_model', type=str, default='diar_infer_general', help='Indicamos el nombre del modelo Multiscala Diarization Decoder')
     parser.add_argument('-wl', '--window_lengths', type=str, default='[1.5]', help='Lista de longitudes de ventana modelo Multiscale Diarization Decoder')
+    parser.add_argument('-bm', '--batch_mode', action='store_true', help='Carga los modelos una sola vez y reutiliza el diarizador para todos los archivos')
+    parser.add_argument('-rt', '--run_tag', type=str, default=None, help='Sufijo de la carpeta de salida de los RTTM (tras "__") para distinguir ejecuciones con distintos hiperparámetros')
+    parser.add_argument('-aet', '--append_exec_time', action='store_true', help='No borra el archivo de tiempos de ejecución al empezar, añade las nuevas líneas')
+    parser.add_argument('-ctr', '--chrome_trace', action='store_true', help='Escribe al terminar una traza de Chrome con los tiempos por etapa')
+    parser.add_argument('-nc', '--no_cache', action='store_true', help='No reutiliza resultados de la caché aunque el audio, los modelos y los parámetros coincidan')
     args = parser.parse_args()
     
     logs_path = os.path.join(args.volume_path, "logs")
@@ -100,9 +114,11 @@ if __name__ == '__main__':
          print(f'No existe la carpeta {datasets_path}')
          logger.error(f'No existe la carpeta {datasets_path}')        
          exit(1)
-    tuplas = _buscar_by_extension_in_dataset(datasets_path, ".wav") 
-    if os.path.exists(os.path.join(args.volume_path, "rttm", EXECUTION_TIME_FILE)):
+    tuplas = scan_by_extension(datasets_path, ".wav") 
+    if not args.append_exec_time and os.path.exists(os.path.join(args.volume_path, "rttm", EXECUTION_TIME_FILE)):
         os.remove(os.path.join(args.volume_path, "rttm", EXECUTION_TIME_FILE))
+    if not args.append_exec_time:
+        remove_stage_times(os.path.join(args.volume_path, "rttm", STAGE_TIME_FILE))
     combined_models_subfolder_name = ''
     ## INICIO Configuración general para todos los archivos de audio 
     config_diar_inf_filename = args.msdd_model + '.yaml'
@@ -124,6 +140,8 @@ if __name__ == '__main__':
     config.diarizer.speaker_embeddings.parameters.multiscale_weights= window_weights
     config.diarizer.clustering.parameters.oracle_num_speakers = provide_num_speakers    
     ## FIN Configuración general para todos los archivos de audio 
+    result_cache = None if args.no_cache else ResultCache(args.volume_path, "nemo")
+    warm_diarizers = {}  # Modo batch: diarizadores ya cargados, uno por tipo de VAD efectivo (Oracle o el modelo VAD)
     for tupla in tuplas:
         rttm_ref_not_found = False
         wav_audio_file = tupla[0]   
@@ -158,6 +176,8 @@ if __name__ == '__main__':
                 combined_models_subfolder_name=str('NeMo__' + VADModels.MARBLE.model + '+' + args.speaker_model)
             else:    
                 combined_models_subfolder_name=str('NeMo__' + vad_model + '+' + args.speaker_model)
+            if args.run_tag:
+                combined_models_subfolder_name += '__' + args.run_tag
             print(f'La carpeta de salida del rttm de hipótesis será {combined_models_subfolder_name} para el audio {wav_audio_file}')
             logger.info(f'La carpeta de salida del rttm de hipótesis será {combined_models_subfolder_name} para el audio {wav_audio_file}')
             rttm_hyp_model_path = os.path.join(args.volume_path, "rttm", dataset_subfolder, combined_models_subfolder_name)
@@ -197,10 +217,56 @@ if __name__ == '__main__':
                 #config.diarizer.vad.parameters.min_duration_on = 0.5 # Threshold for short speech segment deletion
                 config.diarizer.vad.parameters.min_duration_off = args.min_duration_off # Threshold for small non_speech deletion                
 
+            if result_cache is not None:
+                # La clave lleva toda la configuración del diarizador (la del YAML de --msdd_model y la de los argumentos), salvo las rutas
+                # del manifiesto y de salida, que cambian con cada archivo. Con Oracle VAD el resultado depende también del RTTM de
+                # referencia, así que entra su hash en la clave
+                diarizer_config = OmegaConf.to_container(config.diarizer, resolve=True)
+                diarizer_config.pop("manifest_filepath", None)
+                diarizer_config.pop("out_dir", None)
+                cache_params = {
+                    "msdd_model": args.msdd_model,
+                    "diarizer": diarizer_config,
+                    "num_speakers": args.num_speakers,
+                    "rttm_ref": result_cache.content_hash(rttm_ref_filepath) if config.diarizer.oracle_vad else None
+                }
+                cache_key = result_cache.key(wav_file_path, combined_models_subfolder_name, cache_params)
+                cached = result_cache.get(cache_key)
+                if cached is not None:
+                    result_cache.restore(cache_key, os.path.join(rttm_hyp_model_path, rttm_filename), os.path.splitext(wav_audio_file)[0])
+                    print(f'Reutilizada de la caché la diarización de {wav_file_path}')
+                    logger.info(f'Reutilizada de la caché la diarización de {wav_file_path}')
+                    append_exec_time(os.path.join(args.volume_path, "rttm", EXECUTION_TIME_FILE), rttm_filename, combined_models_subfolder_name,
+                                     dataset_subfolder, cached['diarization_time'], cached['duration'])
+                    print(f'FIN de la diarización por NeMo del audio {wav_file_path}.')
+                    logger.info(f'FIN de la diarización por NeMo del audio {wav_file_path}.')
+                    save_status(f'FIN de la diarizacion por NeMo del audio {wav_file_path}.')
+                    continue
+
+            if args.batch_mode:
+                vad_key = VADModels.ORACLE.model if config.diarizer.oracle_vad else config.diarizer.vad.model_path
+                oracle_vad_clusdiar_model, load_time = get_warm_diarizer(warm_diarizers, config, vad_key)
+                if load_time is not None:
+                    # El tiempo de carga de modelos va en su propia línea para no inflar el RTF de ningún archivo
+                    print(f'Tiempo de carga de los modelos de NeMo para {combined_models_subfolder_name} : {load_time} segundos')
+                    logger.info(f'Tiempo de carga de los modelos de NeMo para {combined_models_subfolder_name} : {load_time} segundos')
+                    append_exec_time(os.path.join(args.volume_path, "rttm", EXECUTION_TIME_FILE), MODEL_LOAD, combined_models_subfolder_name,
+                                     '-', load_time, 0)
+                    append_stage_times(os.path.join(args.volume_path, "rttm", STAGE_TIME_FILE), MODEL_LOAD, combined_models_subfolder_name,
+                                       '-', [[MODEL_LOAD_STAGE, time.time() - load_time, time.time()]], 0)
+                # Solo cambian el manifiesto y la carpeta de salida, el resto de la configuración es común a todos los archivos
+                oracle_vad_clusdiar_model._diarizer_params.manifest_filepath = config.diarizer.manifest_filepath
+                oracle_vad_clusdiar_model._diarizer_params.out_dir = config.diarizer.out_dir
+
             start_time = time.time()
+            timer = StageTimer()  # Etapas de la diarización: carga de modelos (fuera del modo batch), VAD, segmentación, embeddings y clustering
             ##### INICIO DE LA DIARIZACION ###########
-            oracle_vad_clusdiar_model = ClusteringDiarizer(cfg=config)            
-            oracle_vad_clusdiar_model.diarize()                            
+            if not args.batch_mode:
+                with timer.span(MODEL_LOAD_STAGE):
+                    oracle_vad_clusdiar_model = ClusteringDiarizer(cfg=config)
+            with instrument_clustering_diarizer(oracle_vad_clusdiar_model, timer):
+                oracle_vad_clusdiar_model.diarize()
+            timer.mark(OTHER_STAGE)
             ##### FIN DE LA DIARIZACION ###########
             diarization_time = time.time() - start_time            
             print(f'Tiempo de diarización realizada con NeMo de {wav_file_path} : {diarization_time} segundos')            
@@ -210,15 +276,26 @@ if __name__ == '__main__':
             shutil.copy2(os.path.join(rttm_hyp_model_path, 'pred_rttms', rttm_filename), os.path.join(rttm_hyp_model_path, rttm_filename))            
             shutil.rmtree(os.path.join(rttm_hyp_model_path, 'pred_rttms'))
                 
-            with open( os.path.join(args.volume_path, "rttm", EXECUTION_TIME_FILE), "a", encoding="utf-8") as execution_time_file:                       
-                audio_Segment = AudioSegment.from_file(wav_file_path)            
-                print(f"Duración del audio: {audio_Segment.duration_seconds}")                                          
-                logger.info(f"Duración del audio: {audio_Segment.duration_seconds}")                                          
-                execution_time_file.write(f"{rttm_filename} {combined_models_subfolder_name} {dataset_subfolder} {diarization_time} {audio_Segment.duration_seconds}\n")            
+            duration = get_duration(wav_file_path)
+            print(f"Duración del audio: {duration}")                                          
+            logger.info(f"Duración del audio: {duration}")                                          
+            append_exec_time(os.path.join(args.volume_path, "rttm", EXECUTION_TIME_FILE), rttm_filename, combined_models_subfolder_name,
+                             dataset_subfolder, diarization_time, duration)
+            append_stage_times(os.path.join(args.volume_path, "rttm", STAGE_TIME_FILE), rttm_filename, combined_models_subfolder_name,
+                               dataset_subfolder, timer.spans, duration)
+            if result_cache is not None:
+                result_cache.put(cache_key, os.path.join(rttm_hyp_model_path, rttm_filename), diarization_time, duration)
             print(f'FIN de la diarización por NeMo del audio {wav_file_path}.')       # Imprime a stdout el fin de la diarización de uno de los archivos       
             logger.info(f'FIN de la diarización por NeMo del audio {wav_file_path}.') # Imprime al archivo de logging el fin de la diarización de uno de los archivos               
             save_status(f'FIN de la diarizacion por NeMo del audio {wav_file_path}.') # Imprime al archivo de estado el fin de la diarización de uno de los archivos, 
             # Este archivo es la manera que tiene el gestor de contenedores de saber que ha terminado la ejecución del script.                          
+    if result_cache is not None:
+        result_cache.save_hash_index()
+    if args.chrome_trace:
+        trace_path = write_chrome_trace(os.path.join(args.volume_path, "rttm", CHROME_TRACE_FILE),
+                                        load_stage_times(os.path.join(args.volume_path, "rttm", STAGE_TIME_FILE)))
+        print(f'Traza de Chrome de las etapas escrita en {trace_path}')
+        logger.info(f'Traza de Chrome de las etapas escrita en {trace_path}')
     logger.info(f'NeMo {combined_models_subfolder_name} FIN\n')
     print(f'NeMo {combined_models_subfolder_name} FIN\n')
     save_status(FIN)   
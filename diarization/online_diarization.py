@@ -0,0 +1,226 @@
+## Diarización en línea (para subtítulos en directo) con el modelo de segmentación de Pyannote o de diarizers y un modelo de embeddings.
+# El audio llega por trozos (reproducción de un WAV a velocidad real, un WAV que va creciendo o PCM por stdin) y se guarda sólo la
+# última ventana del modelo de segmentación. Cada `step` segundos se segmenta esa ventana, se extrae el embedding de cada hablante
+# local y se enlaza con los hablantes globales por sus centroides (SpeakerLinker de long_audio.py, con memoria limitada para que
+# los centroides sigan la evolución de la voz). Se emiten como definitivos los turnos hasta `latency` segundos antes del final del
+# audio recibido, es decir, cada instante se decide viendo como mucho `latency` segundos de audio posterior.
+#
+# Ejecutado como script diariza la entrada, informa de los percentiles de latencia (tiempo desde que llega el audio de un instante
+# hasta que se emite su turno) y, si la entrada es un WAV, del DER respecto de la diarización offline de la pipeline.
+import argparse
+import bisect
+import os
+import sys
+import time
+import numpy as np
+import torch
+from pyannote.core import Annotation, Segment
+from long_audio import SpeakerLinker, DEFAULT_LINK_THRESHOLD
+
+SAMPLE_RATE = 16000         # Los WAV de los datasets y el PCM de entrada son de 16 kHz, mono y 16 bits
+CHUNK_DURATION = 0.1        # Segundos de audio de cada lectura
+STEP = 0.5                  # Cada cuántos segundos de audio nuevo se vuelve a segmentar la ventana
+LATENCY = 2.0               # Segundos de audio posterior con que se decide cada instante
+ACTIVITY_THRESHOLD = 0.5
+MIN_SPEECH = 0.5            # Segundos mínimos de habla de un hablante local en la ventana para extraer su embedding
+CENTROID_MEMORY = 60.0      # Segundos de habla máximos que pesa cada centroide global frente a la nueva
+IDLE_TIMEOUT = 5.0          # Segundos sin que crezca el archivo seguido para darlo por terminado
+
+
+class OnlineDiarizer():
+
+    def __init__(self, segmentation_model, embedding, latency=LATENCY, step=STEP, link_threshold=DEFAULT_LINK_THRESHOLD,
+                 device=torch.device('cpu'), on_turn=None):
+        from pyannote.audio import Inference
+        self.segmentation = Inference(segmentation_model, window="whole", device=device)
+        self.frames = segmentation_model.receptive_field
+        self.embedding = embedding
+        self.window_duration = segmentation_model.specifications.duration
+        self.latency = min(max(latency, step), self.window_duration)
+        self.step = step
+        self.linker = SpeakerLinker(link_threshold)
+        self.on_turn = on_turn
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.received = 0.0         # Segundos de audio recibidos
+        self.processed = 0.0        # Final del audio recibido en la última segmentación
+        self.emitted_until = 0.0    # Hasta dónde son ya definitivos los turnos
+        self.arrivals = []          # (final en segundos de cada trozo recibido, momento en que llegó)
+        self.latencies = []
+        self.annotation = Annotation()
+        self.tracks = 0             # Nombre del siguiente turno en la anotación (dos turnos pueden tener el mismo segmento)
+
+    ## Añade un trozo de audio (muestras float32) llegado en el instante `arrival` y procesa si hay `step` segundos nuevos
+    def feed(self, samples, arrival):
+        self.buffer = np.concatenate([self.buffer, samples])[-int(self.window_duration * SAMPLE_RATE):]
+        self.received += len(samples) / SAMPLE_RATE
+        self.arrivals.append((self.received, arrival))
+        if self.received - self.processed >= self.step:
+            self._process(self.received - self.latency)
+
+    ## Al terminar la entrada se emite lo que quedaba pendiente, ya sin audio posterior
+    def flush(self):
+        if self.received > self.emitted_until:
+            self._process(self.received)
+        return self.annotation.support()
+
+    def _process(self, region_end):
+        self.processed = self.received
+        window_start = self.received - len(self.buffer) / SAMPLE_RATE
+        waveform = torch.from_numpy(self.buffer)[None]
+        activations = self.segmentation({"waveform": waveform, "sample_rate": SAMPLE_RATE})
+        binarized = activations > ACTIVITY_THRESHOLD
+        local_to_global = self._link_local_speakers(waveform, binarized)
+        if region_end <= self.emitted_until:
+            return
+        middles = window_start + np.array([self.frames[index].middle for index in range(binarized.shape[0])])
+        in_region = (middles >= self.emitted_until) & (middles < region_end)
+        turns = []
+        for local, speaker in local_to_global.items():
+            active = binarized[:, local] & in_region
+            # Tramos contiguos de frames activos, cada frame cubre `step` del receptive field alrededor de su centro
+            edges = np.diff(np.concatenate([[0], active.astype(np.int8), [0]]))
+            for first, last in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1):
+                segment = Segment(max(middles[first] - self.frames.step / 2, self.emitted_until), min(middles[last] + self.frames.step / 2, region_end))
+                if segment:
+                    turns.append((segment, f"SPEAKER_{speaker:02d}"))
+        self._emit(turns, region_end)
+
+    ## Embedding de cada hablante local con habla suficiente (sin los solapamientos si queda bastante) y su hablante global
+    def _link_local_speakers(self, waveform, binarized):
+        durations = binarized.sum(axis=0) * self.frames.step
+        speakers = [local for local in range(binarized.shape[1]) if durations[local] >= MIN_SPEECH]
+        if not speakers:
+            return {}
+        single = binarized & (binarized.sum(axis=1, keepdims=True) == 1)
+        masks = np.stack([single[:, local] if single[:, local].sum() * self.frames.step >= MIN_SPEECH else binarized[:, local] for local in speakers])
+        embeddings = self.embedding(waveform[None].repeat(len(speakers), 1, 1), torch.from_numpy(masks.astype(np.float32)))
+        valid = [row for row in range(len(speakers)) if not np.any(np.isnan(embeddings[row]))]
+        if not valid:
+            return {}
+        mapping = self.linker.link(embeddings[valid], [durations[speakers[row]] for row in valid])
+        self.linker.weights = [min(weight, CENTROID_MEMORY) for weight in self.linker.weights]
+        return {speakers[row]: mapping[index] for index, row in enumerate(valid)}
+
+    def _emit(self, turns, region_end):
+        now = time.time()
+        position = bisect.bisect_left([end for end, _ in self.arrivals], region_end - 1e-6)
+        arrival = self.arrivals[min(position, len(self.arrivals) - 1)][1]
+        self.latencies.append(now - arrival)
+        self.arrivals = self.arrivals[max(position - 1, 0):]
+        for segment, label in turns:
+            self.annotation[segment, self.tracks] = label
+            self.tracks += 1
+            if self.on_turn is not None:
+                self.on_turn(segment, label)
+        self.emitted_until = region_end
+
+    def run(self, chunks):
+        for samples, arrival in chunks:
+            self.feed(samples, arrival)
+        return self.flush()
+
+
+## Reproduce un WAV a `speed` veces la velocidad real. El instante de llegada de cada trozo es el previsto por la reproducción,
+# así que si la diarización se retrasa, el retraso acumulado cuenta en la latencia
+def replay_wav(wav_file_path, chunk_duration=CHUNK_DURATION, speed=1.0):
+    from pyannote.audio import Audio
+    waveform, _ = Audio(sample_rate=SAMPLE_RATE, mono="downmix")(wav_file_path)
+    samples = waveform[0].numpy().astype(np.float32)
+    chunk_size = int(chunk_duration * SAMPLE_RATE)
+    start_time = time.time()
+    for offset in range(0, len(samples), chunk_size):
+        end = min(offset + chunk_size, len(samples))
+        arrival = start_time + end / SAMPLE_RATE / speed
+        if arrival > time.time():
+            time.sleep(arrival - time.time())
+        yield samples[offset:end], arrival
+
+## Lee PCM de 16 bits (stdin, p. ej. `ffmpeg ... -f s16le -ac 1 -ar 16000 -`, o el cuerpo de un WAV). Con `follow` espera a que el
+# archivo crezca hasta que pasan `idle_timeout` segundos sin datos nuevos
+def read_pcm(stream, chunk_duration=CHUNK_DURATION, follow=False, idle_timeout=IDLE_TIMEOUT):
+    chunk_bytes = int(chunk_duration * SAMPLE_RATE) * 2
+    pending = b''
+    last_data_time = time.time()
+    while True:
+        data = stream.read(chunk_bytes)
+        if not data:
+            if not follow or time.time() - last_data_time > idle_timeout:
+                break
+            time.sleep(chunk_duration)
+            continue
+        last_data_time = time.time()
+        pending += data
+        usable = len(pending) - len(pending) % 2
+        if usable:
+            yield np.frombuffer(pending[:usable], dtype='<i2').astype(np.float32) / 32768.0, last_data_time
+            pending = pending[usable:]
+
+## Sigue un WAV que se está escribiendo: se salta la cabecera hasta el chunk `data` (cuyo tamaño aún no es el definitivo) y lee el PCM
+def follow_wav(wav_file_path, chunk_duration=CHUNK_DURATION, idle_timeout=IDLE_TIMEOUT):
+    with open(wav_file_path, 'rb') as wav_file:
+        header = b''
+        while b'data' not in header[12:] or len(header) < header.find(b'data', 12) + 8:
+            data = wav_file.read(4096)
+            if not data:
+                time.sleep(chunk_duration)
+            header += data
+        data_offset = header.find(b'data', 12) + 8
+        wav_file.seek(data_offset)
+        yield from read_pcm(wav_file, chunk_duration, follow=True, idle_timeout=idle_timeout)
+
+def load_online_diarizer(segmentation_model_name, speaker_model_name, huggingface_token, device, **kwargs):
+    from pyannote.audio.pipelines.speaker_verification import PretrainedSpeakerEmbedding
+    from pyannote_pipeline import load_segmentation_model
+    segmentation_model = load_segmentation_model(segmentation_model_name, huggingface_token)
+    embedding = PretrainedSpeakerEmbedding(speaker_model_name, device=device, use_auth_token=huggingface_token)
+    return OnlineDiarizer(segmentation_model, embedding, device=device, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Diarización en línea con latencia acotada')
+    parser.add_argument('-i', '--input', type=str, help="WAV de entrada, o '-' para leer PCM de 16 kHz, mono y 16 bits por stdin")
+    parser.add_argument('-f', '--follow', action='store_true', help='El WAV de entrada se está escribiendo: leerlo a medida que crece')
+    parser.add_argument('-sp', '--speed', type=float, default=1.0, help='Velocidad de reproducción del WAV de entrada (1 = tiempo real)')
+    parser.add_argument('-hft', '--huggingface_token', type=str, help="Token de Huggingface")
+    parser.add_argument('-sem', '--segmentation_model', type=str, default='pyannote/segmentation-3.0', help="Modelo de segmentacion")
+    parser.add_argument('-sm', '--speaker_model', type=str, default='pyannote/embedding', help="Modelo de embedding o del hablante")
+    parser.add_argument('-lat', '--latency', type=float, default=LATENCY, help='Segundos de audio posterior con que se decide cada instante')
+    parser.add_argument('-st', '--step', type=float, default=STEP, help='Cada cuántos segundos de audio nuevo se segmenta la ventana')
+    parser.add_argument('-lt', '--link_threshold', type=float, default=DEFAULT_LINK_THRESHOLD, help='Distancia euclídea máxima entre embeddings normalizados (escala del umbral de clustering de Pyannote) para enlazar con un hablante conocido')
+    parser.add_argument('-o', '--output_rttm', type=str, help='RTTM donde escribir la diarización en línea')
+    parser.add_argument('-or', '--offline_rttm', type=str, help='RTTM de la diarización offline del WAV; si no se indica se calcula con la pipeline')
+    parser.add_argument('-nd', '--no_der', action='store_true', help='No calcular el DER respecto de la diarización offline')
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print_turn = lambda segment, label: print(f"{segment.start:.2f} {segment.end:.2f} {label}", flush=True)
+    diarizer = load_online_diarizer(args.segmentation_model, args.speaker_model, args.huggingface_token, device, latency=args.latency,
+                                    step=args.step, link_threshold=args.link_threshold, on_turn=print_turn)
+    if args.input == '-':
+        chunks = read_pcm(sys.stdin.buffer)
+    elif args.follow:
+        chunks = follow_wav(args.input)
+    else:
+        chunks = replay_wav(args.input, speed=args.speed)
+    online_diarization = diarizer.run(chunks)
+    uri = os.path.splitext(os.path.basename(args.input))[0] if args.input != '-' else 'stdin'
+    online_diarization.uri = uri
+    if args.output_rttm:
+        with open(args.output_rttm, 'w', encoding="utf-8") as rttm_file:
+            online_diarization.write_rttm(rttm_file)
+
+    latencies = np.array(diarizer.latencies)
+    if len(latencies):
+        print(f"Latencia (s) de {len(latencies)} emisiones: p50 {np.percentile(latencies, 50):.3f}, p90 {np.percentile(latencies, 90):.3f}, "
+              f"p99 {np.percentile(latencies, 99):.3f}, máxima {latencies.max():.3f}")
+    if args.input != '-' and not args.no_der:
+        from pyannote.metrics.diarization import DiarizationErrorRate
+        if args.offline_rttm:
+            from pyannote.database.util import load_rttm
+            offline_diarization = next(iter(load_rttm(args.offline_rttm).values()))
+        else:
+            from pyannote_pipeline import build_pipeline_params, load_pipeline
+            pipeline = load_pipeline(args.segmentation_model, args.speaker_model, args.huggingface_token, device)
+            pipeline.instantiate(build_pipeline_params(args.segmentation_model, 0.0, 'centroid', 12, 0.7045654963945799))
+            offline_diarization = pipeline(args.input)
+        print(f"DER respecto de la diarización offline: {DiarizationErrorRate()(offline_diarization, online_diarization):.4f}")
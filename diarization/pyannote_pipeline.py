@@ -7,17 +7,32 @@ from pyannote.audio import Model
 from pyannote.audio.pipelines import SpeakerDiarization
 from pyannote.audio.pipelines.utils.hook import ProgressHook
 import os, argparse, logging
+import json
+import itertools
+import multiprocessing
 from enum import Enum
 from datetime import datetime
 import time
-from pydub import AudioSegment
+from audio_duration import get_duration
+from dataset_scan import scan_by_extension
+from exec_time_log import append_exec_time
 import torch
 from diarizers.models.model import SegmentationModel
+from result_cache import ResultCache
+from embedding_cache import CachedSpeakerDiarization
+from batched_segmentation import enable_batched_segmentation, DEFAULT_BATCH_SIZE
+from quantize_segmentation import quantize_segmentation_model, QUANTIZED_SUFFIX
+from long_audio import diarize_long_audio, BLOCK_OVERLAP
+from stage_timing import StageTimer, append_stage_times, remove_stage_times, load_stage_times, write_chrome_trace
 
 STATUS_FILE = 'pyannote_pipeline_status.txt'
-EXECUTION_TIME_FILE = "PYANNOTE_exec_time.txt"
+EXECUTION_TIME_FILE = "PYANNOTE_exec_time.csv"
+STAGE_TIME_FILE = "PYANNOTE_stage_times.csv"
+CHROME_TRACE_FILE = "PYANNOTE_stage_trace.json"
 PATH_BASE_DATASETS = "datasets"
+PATH_JOBS = "jobs"
 FIN="FIN"
+ERROR="ERROR"   # Estado de un trabajo del worker que ha fallado
 
 class PipelineVersions(Enum):
     V2_1 ='speaker-diarization@2.1'
@@ -30,15 +45,391 @@ def save_status(info_text):
     with open(os.path.join(args.volume_path, STATUS_FILE), 'w', encoding="utf-8") as info_file:        
         info_file.write(info_text)
         info_file.close()
-        
-def _buscar_by_extension_in_dataset(path, extension):
-    resultados = []
-    for carpeta_actual, subcarpetas, archivos in os.walk(path):
-        nombre_carpeta = os.path.basename(carpeta_actual)
-        for archivo in archivos:
-            if archivo.lower().endswith(extension):
-                resultados.append((archivo, nombre_carpeta))
-    return resultados        
+
+## Modelo de segmentación para la pipeline: los modelos afinados con diarizers se convierten a un modelo de Pyannote y los de
+# Pyannote se pasan por nombre, salvo que haga falta el objeto (`as_model`, p. ej. para cuantizarlo)
+def load_segmentation_model(segmentation_model_name, huggingface_token, as_model=True):
+    if not segmentation_model_name.startswith("pyannote/"):
+        return SegmentationModel().from_pretrained(segmentation_model_name,).to_pyannote_model()
+    if as_model:
+        return Model.from_pretrained(segmentation_model_name, use_auth_token=huggingface_token)
+    return segmentation_model_name
+
+## Carga los modelos de segmentación y de embeddings y construye la pipeline (todavía sin hiperparámetros instanciados).
+# Es la parte costosa: el worker la hace una sola vez por combinación de modelos.
+# Con `embedding_cache_path` la segmentación y los embeddings de cada audio se guardan en disco y se reutilizan.
+# Con `quantize_segmentation` el modelo de segmentación se cuantiza a int8 (quantize_segmentation.py), que sólo corre en CPU.
+def load_pipeline(segmentation_model_name, speaker_model_name, huggingface_token, device, embedding_cache_path=None, quantize_segmentation=False):
+    segmentation_model = load_segmentation_model(segmentation_model_name, huggingface_token, as_model=quantize_segmentation)
+    if quantize_segmentation:
+        segmentation_model = quantize_segmentation_model(segmentation_model)
+        device = torch.device('cpu')
+    if speaker_model_name.startswith("pyannote/"):
+        embedding_model = Model.from_pretrained(speaker_model_name, use_auth_token=huggingface_token)
+    else:
+        embedding_model = speaker_model_name
+    if embedding_cache_path is not None:
+        return CachedSpeakerDiarization(embedding_cache_path, embedding=embedding_model, segmentation=segmentation_model,
+                                        clustering="AgglomerativeClustering",
+                                        use_auth_token=huggingface_token).to(device=device)
+    return SpeakerDiarization(embedding=embedding_model, segmentation=segmentation_model,
+                              clustering="AgglomerativeClustering" ,
+                              use_auth_token=huggingface_token).to(device=device)
+
+## Hiperparámetros de la pipeline, se pueden volver a instanciar sin recargar los pesos de los modelos
+def build_pipeline_params(segmentation_model_name, min_duration_off, method_cluster, min_cluster_size, threshold_cluster):
+    pipeline_params_dict = {
+        "segmentation": {
+            "min_duration_off": min_duration_off
+        },
+        "clustering": {
+            "method": method_cluster,
+            "min_cluster_size": min_cluster_size,
+            "threshold": threshold_cluster
+        }
+    }
+    if segmentation_model_name == "pyannote/segmentation": ##Pipeline 2.1
+        pipeline_params_dict["segmentation"]["threshold"] = 0.5
+    return pipeline_params_dict
+
+def get_combined_models_subfolder_name(segmentation_model_name, speaker_model_name, quantize_segmentation=False):
+    if quantize_segmentation:
+        segmentation_model_name += QUANTIZED_SUFFIX
+    return str('Pyannote__' + segmentation_model_name + '+' + speaker_model_name).replace('/', '-')
+
+def get_embedding_cache_path(volume_path, combined_models_subfolder_name):
+    return os.path.join(volume_path, "cache", "embeddings", combined_models_subfolder_name)
+
+## Lee la rejilla del barrido (YAML o JSON): cada clave es un hiperparámetro con la lista de valores a probar,
+# los que no aparecen toman el valor de los argumentos del script
+def load_clustering_grid(clustering_grid_path, defaults:dict):
+    with open(clustering_grid_path, 'r', encoding="utf-8") as grid_file:
+        if clustering_grid_path.lower().endswith(".json"):
+            grid = json.load(grid_file)
+        else:
+            import yaml
+            grid = yaml.safe_load(grid_file)
+    keys = ["threshold_cluster", "method_cluster", "min_cluster_size", "min_duration_off"]
+    values = []
+    for key in keys:
+        value = grid.get(key, defaults[key])
+        values.append(value if isinstance(value, list) else [value])
+    return [dict(zip(keys, point)) for point in itertools.product(*values)]
+
+## Sufijo de la carpeta de salida de cada punto de la rejilla, tras un '__' para que metrics.py siga separando los modelos
+def get_sweep_tag(grid_point:dict):
+    return f"thr{grid_point['threshold_cluster']}-mcs{grid_point['min_cluster_size']}-{grid_point['method_cluster']}-mdo{grid_point['min_duration_off']}"
+
+## Barrido de los hiperparámetros del clustering: la pipeline debe estar cargada con caché de embeddings, así que la segmentación
+# y los embeddings se calculan en el primer punto de la rejilla y el resto sólo vuelve a ejecutar el clustering.
+# Cada punto escribe su propio juego de RTTM en `<modelos>__<tag>`; su tiempo de ejecución registrado es el del clustering.
+def sweep_clustering(pipeline, volume_path, segmentation_model_name, combined_models_subfolder_name, grid, num_speakers=None,
+                     result_cache=None, reset_exec_time=True, batch_segmentation_files=None, segmentation_batch_size=DEFAULT_BATCH_SIZE,
+                     long_audio_block=None, long_audio_overlap=BLOCK_OVERLAP):
+    if reset_exec_time:
+        reset_exec_times(volume_path)
+    for index, grid_point in enumerate(grid):
+        sweep_subfolder_name = combined_models_subfolder_name + '__' + get_sweep_tag(grid_point)
+        print(f'Barrido {index + 1}/{len(grid)}: {sweep_subfolder_name}')
+        logger.info(f'Barrido {index + 1}/{len(grid)}: {sweep_subfolder_name}')
+        pipeline_params = build_pipeline_params(segmentation_model_name, float(grid_point["min_duration_off"]), grid_point["method_cluster"],
+                                                int(grid_point["min_cluster_size"]), float(grid_point["threshold_cluster"]))
+        pipeline.instantiate(pipeline_params)
+        cache_params = {"pipeline": pipeline_params, "num_speakers": num_speakers}
+        if long_audio_block:
+            cache_params["long_audio"] = [long_audio_block, long_audio_overlap]
+        diarize_dataset(pipeline, volume_path, sweep_subfolder_name, num_speakers, None, result_cache, cache_params, reset_exec_time=False,
+                        batch_segmentation_files=batch_segmentation_files, segmentation_batch_size=segmentation_batch_size,
+                        long_audio_block=long_audio_block, long_audio_overlap=long_audio_overlap)
+
+## ProgressHook que además mide las etapas de la pipeline: cada llamada de la pipeline al hook cierra el tiempo transcurrido desde la
+# anterior y lo atribuye a su paso. Lo que va del final de los embeddings a la llamada de "discrete_diarization" es el clustering.
+class StageTimingHook(ProgressHook):
+    STAGE_NAMES = {"discrete_diarization": "clustering"}
+
+    def __init__(self, timer:StageTimer, transient=False):
+        super().__init__(transient=transient)
+        self.timer = timer
+
+    def __call__(self, step_name, step_artifact, file=None, total=None, completed=None):
+        self.timer.mark(self.STAGE_NAMES.get(step_name, step_name))
+        super().__call__(step_name, step_artifact, file=file, total=total, completed=completed)
+
+## Borra los registros de tiempos (total y por etapa) de una ejecución anterior
+def reset_exec_times(volume_path):
+    if os.path.exists(os.path.join(volume_path, "rttm", EXECUTION_TIME_FILE)):
+        os.remove(os.path.join(volume_path, "rttm", EXECUTION_TIME_FILE))
+    remove_stage_times(os.path.join(volume_path, "rttm", STAGE_TIME_FILE))
+
+## Diariza un único archivo y escribe su RTTM de hipótesis. Devuelve lo necesario para registrar el tiempo de ejecución.
+# `segmentation_time` es la parte que le corresponde del tiempo de la segmentación por lotes, si se calculó antes junto a otros archivos.
+# Con `long_audio_block` los audios que superan esa duración se diarizan por bloques solapados (long_audio.py).
+def diarize_file(pipeline, volume_path, combined_models_subfolder_name, wav_audio_file, dataset_subfolder, num_speakers=None, segmentation_time=0.0,
+                 long_audio_block=None, long_audio_overlap=BLOCK_OVERLAP):
+    wav_file_path = os.path.join(volume_path, PATH_BASE_DATASETS, dataset_subfolder, wav_audio_file)
+    start_time = time.time() - segmentation_time
+    timer = StageTimer()
+    # La parte de la segmentación por lotes de este archivo se calculó antes, se registra como segmentación
+    timer.add("segmentation", start_time, start_time + segmentation_time)
+
+    with StageTimingHook(timer) as hook:
+        if long_audio_block:
+            diarization = diarize_long_audio(pipeline, wav_file_path, long_audio_block, long_audio_overlap, num_speakers, hook=hook)
+        elif num_speakers is None:
+            diarization = pipeline(wav_file_path, hook=hook)
+        else:
+            diarization = pipeline(wav_file_path, hook=hook, num_speakers=num_speakers)
+    timer.mark("postprocessing")
+
+    diarization_time = time.time() - start_time
+    logger.info(f'Tiempo de diarización realizada con Pyannote de {wav_file_path} : {diarization_time} segundos')
+    print(f'Tiempo de diarización realizada con Pyannote de {wav_file_path} : {diarization_time} segundos')
+    # dump the diarization output to disk using RTTM format
+    rttm_filename = wav_audio_file.replace('.wav', '.rttm')
+
+    logger.info(f'INICIO de la escritura de la diarización del audio {wav_file_path} ...')
+    print(f'INICIO de la escritura de la diarización del audio {wav_file_path} ...')
+    rttm_hyp_model_path = os.path.join(volume_path, "rttm", dataset_subfolder, combined_models_subfolder_name)
+    if not os.path.exists(rttm_hyp_model_path):
+        os.makedirs(rttm_hyp_model_path, exist_ok=True)
+        logger.info(f'Se crea la carpeta de salida para los RTTM: {rttm_hyp_model_path}.')
+        print(f'Se crea la carpeta de salida para los RTTM: {rttm_hyp_model_path}.')
+
+    with open( os.path.join(rttm_hyp_model_path, rttm_filename), "w", encoding="utf-8") as rttm_file:
+        diarization.write_rttm(rttm_file)
+    duration = get_duration(wav_file_path)
+    print(f"Duración del audio: {duration}")
+
+    for turn, _, speaker in diarization.itertracks(yield_label=True):
+        logger.debug(f'start={turn.start:.1f}s stop={turn.end:.1f}s speaker_{speaker}')
+        print(f"start={turn.start:.1f}s stop={turn.end:.1f}s speaker_{speaker}")
+    return rttm_filename, dataset_subfolder, diarization_time, duration, wav_file_path, timer.spans
+
+## Registra el tiempo de ejecución y el estado de un archivo ya diarizado. Sólo lo llama el proceso principal,
+# así el archivo de tiempos y el de estado tienen un único escritor aunque se diarice con varios procesos.
+def record_file_done(volume_path, combined_models_subfolder_name, rttm_filename, dataset_subfolder, diarization_time, duration, wav_file_path,
+                     stage_spans=None):
+    append_exec_time(os.path.join(volume_path, "rttm", EXECUTION_TIME_FILE), rttm_filename, combined_models_subfolder_name, dataset_subfolder,
+                     diarization_time, duration)
+    append_stage_times(os.path.join(volume_path, "rttm", STAGE_TIME_FILE), rttm_filename, combined_models_subfolder_name, dataset_subfolder,
+                       stage_spans, duration)
+    logger.info(f'FIN de la diarización por Pyannote del audio {wav_file_path}.') # Imprime al archivo de logging el fin de la diarización de uno de los archivos
+    print(f'FIN de la diarización por Pyannote del audio {wav_file_path}.')       # Imprime a stdout el fin de la diarización de uno de los archivos
+    save_status(f'FIN de la diarizacion por Pyannote del audio {wav_file_path}.') # Imprime al archivo de estado el fin de la diarización de uno de los archivos,
+                # este archivo es la manera que tiene el gestor de contenedores de saber que ha terminado la ejecución del script.
+
+## Devuelve las tuplas (archivo, subcarpeta de dataset) a diarizar
+def _dataset_tasks(volume_path, tuplas=None):
+    if tuplas is None:
+        tuplas = scan_by_extension(os.path.join(volume_path, PATH_BASE_DATASETS), ".wav")
+    tasks = []
+    for tupla in tuplas:
+        wav_audio_file = tupla[0]
+        if volume_path != tupla[1]:
+            if PATH_BASE_DATASETS==tupla[1]:
+                dataset_subfolder = '.'
+                print(f'El audio {wav_audio_file} no tiene una carpeta de Datasets asociada')
+                logger.warning(f'El audio {wav_audio_file} no tiene una carpeta de Datasets asociada')
+            else:
+                dataset_subfolder = tupla[1]
+            tasks.append((wav_audio_file, dataset_subfolder))
+    return tasks
+
+def _rttm_hyp_file_path(volume_path, combined_models_subfolder_name, wav_audio_file, dataset_subfolder):
+    return os.path.join(volume_path, "rttm", dataset_subfolder, combined_models_subfolder_name, wav_audio_file.replace('.wav', '.rttm'))
+
+## Restaura de la caché de resultados los archivos ya diarizados con el mismo audio, modelos y parámetros, registrando el tiempo
+# de ejecución que se guardó en su momento. Devuelve las tareas que sí hay que diarizar y la clave de caché de cada una.
+def _restore_cached_tasks(result_cache, cache_params, volume_path, combined_models_subfolder_name, tasks):
+    if result_cache is None:
+        return tasks, {}
+    pending_tasks, cache_keys = [], {}
+    for wav_audio_file, dataset_subfolder in tasks:
+        wav_file_path = os.path.join(volume_path, PATH_BASE_DATASETS, dataset_subfolder, wav_audio_file)
+        key = result_cache.key(wav_file_path, combined_models_subfolder_name, cache_params)
+        cached = result_cache.get(key)
+        if cached is None:
+            pending_tasks.append((wav_audio_file, dataset_subfolder))
+            cache_keys[(wav_audio_file, dataset_subfolder)] = key
+            continue
+        result_cache.restore(key, _rttm_hyp_file_path(volume_path, combined_models_subfolder_name, wav_audio_file, dataset_subfolder),
+                             os.path.splitext(wav_audio_file)[0])
+        print(f'Reutilizada de la caché la diarización de {wav_file_path}')
+        logger.info(f'Reutilizada de la caché la diarización de {wav_file_path}')
+        record_file_done(volume_path, combined_models_subfolder_name, wav_audio_file.replace('.wav', '.rttm'), dataset_subfolder,
+                         cached["diarization_time"], cached["duration"], wav_file_path)
+    result_cache.save_hash_index()
+    return pending_tasks, cache_keys
+
+def _store_in_cache(result_cache, cache_keys, volume_path, combined_models_subfolder_name, wav_audio_file, result):
+    if result_cache is None:
+        return
+    _, dataset_subfolder, diarization_time, duration = result[:4]
+    result_cache.put(cache_keys[(wav_audio_file, dataset_subfolder)],
+                     _rttm_hyp_file_path(volume_path, combined_models_subfolder_name, wav_audio_file, dataset_subfolder),
+                     diarization_time, duration)
+
+## Calcula por lotes la segmentación de un bloque de tareas, salvo la de los audios que ya la tienen en la caché de embeddings.
+# Devuelve el tiempo de segmentación que corresponde a cada archivo.
+def _precompute_segmentations(pipeline, volume_path, tasks, segmentation_batch_size):
+    batched_segmentation = enable_batched_segmentation(pipeline, segmentation_batch_size)
+    files = [{"audio": os.path.join(volume_path, PATH_BASE_DATASETS, dataset_subfolder, wav_audio_file)} for wav_audio_file, dataset_subfolder in tasks]
+    if isinstance(pipeline, CachedSpeakerDiarization):
+        files = [file for file in files if not pipeline.has_cached_segmentation(file)]
+    if not files:
+        return {}
+    print(f'Segmentación por lotes de {len(files)} archivos')
+    logger.info(f'Segmentación por lotes de {len(files)} archivos')
+    return batched_segmentation.precompute(files)
+
+## Aplica la pipeline iterativamente en el volumen de archivos de audio, o sólo en las tuplas (archivo, dataset) indicadas.
+# Con `batch_segmentation_files` la segmentación se calcula por bloques de ese número de archivos, juntando sus fragmentos
+# en lotes de `segmentation_batch_size`, antes de diarizar cada archivo del bloque.
+def diarize_dataset(pipeline, volume_path, combined_models_subfolder_name, num_speakers=None, tuplas=None, result_cache=None, cache_params=None,
+                    reset_exec_time=True, batch_segmentation_files=None, segmentation_batch_size=DEFAULT_BATCH_SIZE,
+                    long_audio_block=None, long_audio_overlap=BLOCK_OVERLAP):
+    tasks = _dataset_tasks(volume_path, tuplas)
+    if reset_exec_time:
+        reset_exec_times(volume_path)
+    tasks, cache_keys = _restore_cached_tasks(result_cache, cache_params, volume_path, combined_models_subfolder_name, tasks)
+    block_size = batch_segmentation_files if batch_segmentation_files else max(1, len(tasks))
+    for block_start in range(0, len(tasks), block_size):
+        block = tasks[block_start:block_start + block_size]
+        segmentation_times = _precompute_segmentations(pipeline, volume_path, block, segmentation_batch_size) if batch_segmentation_files else {}
+        for wav_audio_file, dataset_subfolder in block:
+            wav_file_path = os.path.join(volume_path, PATH_BASE_DATASETS, dataset_subfolder, wav_audio_file)
+            result = diarize_file(pipeline, volume_path, combined_models_subfolder_name, wav_audio_file, dataset_subfolder, num_speakers,
+                                  segmentation_times.get(wav_file_path, 0.0), long_audio_block, long_audio_overlap)
+            _store_in_cache(result_cache, cache_keys, volume_path, combined_models_subfolder_name, wav_audio_file, result)
+            record_file_done(volume_path, combined_models_subfolder_name, *result)
+
+_process_pipeline = None  # Pipeline propia de cada proceso en modo --workers
+
+def _init_process_pipeline(segmentation_model_name, speaker_model_name, huggingface_token, pipeline_params, num_threads, embedding_cache_path=None,
+                           quantize_segmentation=False):
+    global _process_pipeline
+    torch.set_num_threads(num_threads)  # Limitamos los hilos intra-op para que los procesos no compitan por los mismos cores
+    _process_pipeline = load_pipeline(segmentation_model_name, speaker_model_name, huggingface_token, torch.device('cpu'),
+                                      embedding_cache_path, quantize_segmentation).instantiate(pipeline_params)
+
+## Diariza en el proceso un bloque de archivos; con `batch_segmentation_files` su segmentación se calcula antes por lotes
+def _diarize_block_in_process(task):
+    volume_path, combined_models_subfolder_name, block, num_speakers, batch_segmentation_files, segmentation_batch_size, \
+        long_audio_block, long_audio_overlap = task
+    segmentation_times = _precompute_segmentations(_process_pipeline, volume_path, block, segmentation_batch_size) if batch_segmentation_files else {}
+    results = []
+    for wav_audio_file, dataset_subfolder in block:
+        wav_file_path = os.path.join(volume_path, PATH_BASE_DATASETS, dataset_subfolder, wav_audio_file)
+        results.append((wav_audio_file, diarize_file(_process_pipeline, volume_path, combined_models_subfolder_name, wav_audio_file, dataset_subfolder,
+                                                     num_speakers, segmentation_times.get(wav_file_path, 0.0), long_audio_block, long_audio_overlap)))
+    return results
+
+## Reparte los archivos del dataset entre `workers` procesos, cada uno con su propia pipeline cargada y con
+# cpu_count/workers hilos de torch. Los procesos sólo escriben los RTTM; los tiempos y el estado los registra el proceso principal.
+# Con `batch_segmentation_files` cada proceso recibe bloques de ese número de archivos y segmenta cada bloque por lotes.
+def diarize_dataset_parallel(workers, segmentation_model_name, speaker_model_name, huggingface_token, pipeline_params,
+                             volume_path, combined_models_subfolder_name, num_speakers=None, tuplas=None, result_cache=None, cache_params=None,
+                             embedding_cache_path=None, reset_exec_time=True, quantize_segmentation=False, long_audio_block=None,
+                             long_audio_overlap=BLOCK_OVERLAP, batch_segmentation_files=None, segmentation_batch_size=DEFAULT_BATCH_SIZE):
+    tasks = _dataset_tasks(volume_path, tuplas)
+    if reset_exec_time:
+        reset_exec_times(volume_path)
+    tasks, cache_keys = _restore_cached_tasks(result_cache, cache_params, volume_path, combined_models_subfolder_name, tasks)
+    if not tasks:
+        return
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f'Diarizando {len(tasks)} archivos con {workers} procesos de {num_threads} hilos cada uno')
+    logger.info(f'Diarizando {len(tasks)} archivos con {workers} procesos de {num_threads} hilos cada uno')
+    # 'fork' para que los procesos hereden el logger y los argumentos del script
+    with multiprocessing.get_context('fork').Pool(processes=workers, initializer=_init_process_pipeline,
+                                                  initargs=(segmentation_model_name, speaker_model_name, huggingface_token,
+                                                            pipeline_params, num_threads, embedding_cache_path, quantize_segmentation)) as pool:
+        block_size = batch_segmentation_files if batch_segmentation_files else 1
+        for results in pool.imap_unordered(_diarize_block_in_process,
+                                           [(volume_path, combined_models_subfolder_name, tasks[block_start:block_start + block_size], num_speakers,
+                                             batch_segmentation_files, segmentation_batch_size, long_audio_block, long_audio_overlap)
+                                            for block_start in range(0, len(tasks), block_size)]):
+            for wav_audio_file, result in results:
+                _store_in_cache(result_cache, cache_keys, volume_path, combined_models_subfolder_name, wav_audio_file, result)
+                record_file_done(volume_path, combined_models_subfolder_name, *result)
+
+## Convierte la lista de archivos de un trabajo (rutas absolutas o relativas a la carpeta de datasets) en tuplas (archivo, dataset)
+def _tuplas_from_job_files(datasets_path, files):
+    tuplas = []
+    for file in files:
+        wav_file_path = os.path.join(datasets_path, file)
+        tuplas.append((os.path.basename(wav_file_path), os.path.basename(os.path.dirname(wav_file_path))))
+    return tuplas
+
+## Modo worker: sustituye a keep_alive.py como proceso principal del contenedor. Mantiene las pipelines cargadas en memoria
+# (una por combinación de modelos) y atiende los trabajos que el gestor de contenedores deja en la carpeta de spool `jobs`.
+# Cada trabajo es un JSON con los modelos, los hiperparámetros y opcionalmente la lista de archivos a diarizar;
+# los hiperparámetros se vuelven a instanciar en la pipeline ya cargada, sin recargar los pesos.
+def run_worker(volume_path, device, result_cache=None, poll_interval=1.0):
+    jobs_path = os.path.join(volume_path, PATH_JOBS, "pyannote_pipeline")
+    os.makedirs(jobs_path, exist_ok=True)
+    pipelines = {}
+    print(f'Worker de Pyannote esperando trabajos en {jobs_path} ...')
+    logger.info(f'Worker de Pyannote esperando trabajos en {jobs_path} ...')
+    while True:
+        job_files = sorted(job_file for job_file in os.listdir(jobs_path) if job_file.endswith(".json"))
+        if not job_files:
+            time.sleep(poll_interval)
+            continue
+        job_path = os.path.join(jobs_path, job_files[0])
+        running_path = job_path.replace(".json", ".running")
+        try:
+            os.rename(job_path, running_path)  # Reclamamos el trabajo de forma atómica
+        except OSError:
+            continue
+        result = {"job": job_files[0], "status": "OK"}
+        try:
+            # Un trabajo ilegible termina con ERROR como cualquier otro fallo, sin detener el worker
+            try:
+                with open(running_path, 'r', encoding="utf-8") as job_file:
+                    job = json.load(job_file)
+            finally:
+                os.remove(running_path)  # El trabajo puede llevar el token de Huggingface, no lo dejamos en el volumen compartido
+            segmentation_model_name = job.get("segmentation_model", 'pyannote/segmentation-3.0')
+            speaker_model_name = job.get("speaker_model", 'pyannote/embedding')
+            quantize_segmentation = bool(job.get("quantize_segmentation", False))
+            combined_models_subfolder_name = get_combined_models_subfolder_name(segmentation_model_name, speaker_model_name, quantize_segmentation)
+            # La segmentación y los embeddings sólo dependen de los modelos, no del run_tag
+            embedding_cache_path = get_embedding_cache_path(volume_path, combined_models_subfolder_name) if job.get("cache_embeddings") else None
+            pipeline_key = (segmentation_model_name, speaker_model_name, quantize_segmentation, embedding_cache_path)
+            if pipeline_key not in pipelines:
+                start_time = time.time()
+                pipelines[pipeline_key] = load_pipeline(segmentation_model_name, speaker_model_name, job.get("huggingface_token"), device,
+                                                        embedding_cache_path, quantize_segmentation)
+                print(f'Pipeline cargada para {segmentation_model_name} + {speaker_model_name} en {time.time() - start_time} segundos')
+                logger.info(f'Pipeline cargada para {segmentation_model_name} + {speaker_model_name} en {time.time() - start_time} segundos')
+            pipeline = pipelines[pipeline_key]
+            pipeline_params = build_pipeline_params(segmentation_model_name, float(job.get("min_duration_off", 0.0)),
+                                                    job.get("method_cluster", 'centroid'), int(job.get("min_cluster_size", 12)),
+                                                    float(job.get("threshold_cluster", 0.7045654963945799)))
+            pipeline.instantiate(pipeline_params)
+            num_speakers = int(job["num_speakers"]) if job.get("num_speakers") is not None else None
+            tuplas = _tuplas_from_job_files(os.path.join(volume_path, PATH_BASE_DATASETS), job["files"]) if job.get("files") else None
+            if job.get("run_tag"):
+                combined_models_subfolder_name += '__' + job["run_tag"]
+            long_audio_block = float(job["long_audio_block"]) if job.get("long_audio_block") else None
+            long_audio_overlap = float(job.get("long_audio_overlap", BLOCK_OVERLAP))
+            cache_params = {"pipeline": pipeline_params, "num_speakers": num_speakers}
+            if long_audio_block:
+                cache_params["long_audio"] = [long_audio_block, long_audio_overlap]
+            diarize_dataset(pipeline, volume_path, combined_models_subfolder_name, num_speakers, tuplas, result_cache, cache_params,
+                            not job.get("append_exec_time", False),
+                            int(job["batch_segmentation_files"]) if job.get("batch_segmentation_files") else None,
+                            long_audio_block=long_audio_block, long_audio_overlap=long_audio_overlap)
+        except Exception as e:
+            print(f'Error en el trabajo {job_files[0]}: {e}')
+            logger.error(f'Error en el trabajo {job_files[0]}: {e}')
+            result = {"job": job_files[0], "status": "ERROR", "error": str(e)}
+        with open(job_path.replace(".json", ".done"), 'w', encoding="utf-8") as done_file:
+            json.dump(result, done_file)
+        logger.info(f'Trabajo {job_files[0]} terminado: {result["status"]}')
+        print(f'Trabajo {job_files[0]} terminado: {result["status"]}')
+        save_status(FIN if result["status"] == "OK" else ERROR)
 
 if __name__ == '__main__':
     print("Llamado el Pipeline de Pyannote ... ")
@@ -54,7 +445,20 @@ if __name__ == '__main__':
     parser.add_argument('-thr', '--threshold_cluster', type=float, default=0.7045654963945799, help="Umbral utilizado en el clustering aglomerativo")
     parser.add_argument('-ns', '--num_speakers', default=None,  type=int, help='Indicamos el numero de speakers (pero tendría que ser el mismo número en todos los archivos de esta pasada)')
     parser.add_argument('-vp', '--volume_path', type=str, help='Carpeta con los archivos de audio(.wav)')
-    args = parser.parse_args()  
+    parser.add_argument('-wk', '--worker', action='store_true', help='Arranca como worker persistente que atiende trabajos de la carpeta jobs del volumen')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Número de procesos entre los que se reparten los archivos a diarizar')
+    parser.add_argument('-nc', '--no_cache', action='store_true', help='No reutiliza resultados de la caché aunque el audio, los modelos y los parámetros coincidan')
+    parser.add_argument('-ce', '--cache_embeddings', action='store_true', help='Guarda en disco la segmentación y los embeddings de cada audio para reutilizarlos')
+    parser.add_argument('-rt', '--run_tag', type=str, default=None, help='Sufijo de la carpeta de salida de los RTTM (tras "__") para distinguir ejecuciones con distintos hiperparámetros')
+    parser.add_argument('-ctr', '--chrome_trace', action='store_true', help='Escribe al terminar una traza de Chrome con los tiempos por etapa')
+    parser.add_argument('-aet', '--append_exec_time', action='store_true', help='No borra el archivo de tiempos de ejecución al empezar, añade las nuevas líneas')
+    parser.add_argument('-bsf', '--batch_segmentation_files', type=int, default=None, help='Calcula la segmentación por bloques de este número de archivos, juntando sus fragmentos en lotes')
+    parser.add_argument('-sbs', '--segmentation_batch_size', type=int, default=DEFAULT_BATCH_SIZE, help='Fragmentos por lote en la segmentación por bloques')
+    parser.add_argument('-qs', '--quantize_segmentation', action='store_true', help='Cuantiza a int8 el modelo de segmentación para inferencia en CPU')
+    parser.add_argument('-lab', '--long_audio_block', type=float, default=None, help='Diariza por bloques solapados de estos segundos los audios más largos (memoria acotada)')
+    parser.add_argument('-lao', '--long_audio_overlap', type=float, default=BLOCK_OVERLAP, help='Segundos de solape entre bloques en la diarización por bloques')
+    parser.add_argument('-clg', '--clustering_grid', type=str, default=None, help='YAML/JSON con listas de valores de threshold_cluster, method_cluster, min_cluster_size y min_duration_off a barrer (sólo clustering; el barrido de modelos es --sweep_grid de main.py)')
+    args = parser.parse_args()
     print("Parseados los argumentos en el Pipeline de Pyannote ... ")
     if type(args.pipeline_version) == PipelineVersions:
         pipeline_version = args.pipeline_version.value         
@@ -67,6 +471,13 @@ if __name__ == '__main__':
     logging.basicConfig(filename=f'{logs_path}/reg_pipeline_{pipeline_version}_{datetime.now().strftime("%Y%m%d%H%M%S")}.log', force=True,
                         encoding='utf-8', level=logging.DEBUG, format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')   
     logger = logging.getLogger(__name__)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    result_cache = None if args.no_cache else ResultCache(args.volume_path, "pyannote")
+    if args.worker:
+        run_worker(args.volume_path, device, result_cache)
+        exit(0)
+
     logger.info(f'pyannote/{pipeline_version} START obtención del modelo')    
     print(f'pyannote/{pipeline_version} START obtención del modelo')   
     
@@ -76,85 +487,46 @@ if __name__ == '__main__':
          logger.error(f'No existe la carpeta {datasets_path}')        
          exit(1)        
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    if not args.segmentation_model.startswith("pyannote/"):
-        segmentation_model = SegmentationModel().from_pretrained(args.segmentation_model,).to_pyannote_model()    
-    else:
-        segmentation_model = args.segmentation_model        
-    if args.speaker_model.startswith("pyannote/"):
-        embedding_model = Model.from_pretrained(args.speaker_model, use_auth_token=args.huggingface_token)
-    else:    
-        embedding_model = args.speaker_model
-        
-    pipeline_params_dict = {
-        "segmentation": {
-            "min_duration_off": args.min_duration_off
-        },
-        "clustering": {
-            "method": args.method_cluster,
-            "min_cluster_size": args.min_cluster_size,
-            "threshold": args.threshold_cluster
-        }
-    }
-    if args.segmentation_model == "pyannote/segmentation": ##Pipeline 2.1
-        pipeline_params_dict["segmentation"]["threshold"] = 0.5
-    pipeline = SpeakerDiarization(embedding=embedding_model, segmentation=segmentation_model, 
-                                  clustering="AgglomerativeClustering" , 
-                                  use_auth_token=args.huggingface_token).instantiate(pipeline_params_dict) \
-                .to(device=device)        
-                
-    combined_models_subfolder_name = str('Pyannote__' + args.segmentation_model + '+' + args.speaker_model).replace('/', '-') 
+    pipeline_params = build_pipeline_params(args.segmentation_model, args.min_duration_off, args.method_cluster,
+                                            args.min_cluster_size, args.threshold_cluster)
+    combined_models_subfolder_name = get_combined_models_subfolder_name(args.segmentation_model, args.speaker_model, args.quantize_segmentation)
+    cache_params = {"pipeline": pipeline_params, "num_speakers": args.num_speakers}
+    if args.long_audio_block:
+        cache_params["long_audio"] = [args.long_audio_block, args.long_audio_overlap]
+    embedding_cache_path = None
+    if args.cache_embeddings or args.clustering_grid:
+        # La segmentación y los embeddings sólo dependen de los modelos, no del run_tag
+        embedding_cache_path = get_embedding_cache_path(args.volume_path, combined_models_subfolder_name)
+    if args.run_tag:
+        combined_models_subfolder_name += '__' + args.run_tag
     if os.path.isdir(args.volume_path):
-        tuplas = _buscar_by_extension_in_dataset(datasets_path, ".wav") 
-        if os.path.exists(os.path.join(args.volume_path, "rttm", EXECUTION_TIME_FILE)):
-            os.remove(os.path.join(args.volume_path, "rttm", EXECUTION_TIME_FILE))
-    # aplica la pipeline iterativamente en el volumen de archivos de audio            
-        for tupla in tuplas:
-            wav_audio_file = tupla[0]   
-            if args.volume_path != tupla[1]:
-                if PATH_BASE_DATASETS==tupla[1]:
-                    dataset_subfolder = '.'
-                    print(f'El audio {wav_audio_file} no tiene una carpeta de Datasets asociada')
-                    logger.warning(f'El audio {wav_audio_file} no tiene una carpeta de Datasets asociada')                    
-                else:    
-                    dataset_subfolder = tupla[1]                   
-                wav_file_path = os.path.join(datasets_path, dataset_subfolder, wav_audio_file)                                    
-                start_time = time.time()
-
-                with ProgressHook() as hook:
-                    if args.num_speakers is None:
-                        diarization = pipeline(wav_file_path, hook=hook)
-                    else:                           
-                        diarization = pipeline(wav_file_path, hook=hook, num_speakers=args.num_speakers)         
-                    
-                diarization_time = time.time() - start_time
-                logger.info(f'Tiempo de diarización realizada con Pyannote de {wav_file_path} : {diarization_time} segundos')
-                print(f'Tiempo de diarización realizada con Pyannote de {wav_file_path} : {diarization_time} segundos')
-                # dump the diarization output to disk using RTTM format
-                rttm_filename = wav_audio_file.replace('.wav', '.rttm')
-                
-                logger.info(f'INICIO de la escritura de la diarización del audio {wav_file_path} ...')
-                print(f'INICIO de la escritura de la diarización del audio {wav_file_path} ...')
-                rttm_hyp_model_path = os.path.join(args.volume_path, "rttm", dataset_subfolder, combined_models_subfolder_name)
-                if not os.path.exists(rttm_hyp_model_path):
-                    os.makedirs(rttm_hyp_model_path, exist_ok=True)
-                    logger.info(f'Se crea la carpeta de salida para los RTTM: {rttm_hyp_model_path}.')
-                    print(f'Se crea la carpeta de salida para los RTTM: {rttm_hyp_model_path}.')
-                    
-                with open( os.path.join(rttm_hyp_model_path, rttm_filename), "w", encoding="utf-8") as rttm_file:
-                    diarization.write_rttm(rttm_file)                 
-                with open( os.path.join(args.volume_path, "rttm", EXECUTION_TIME_FILE), "a", encoding="utf-8") as execution_time_file:                       
-                    audio_Segment = AudioSegment.from_file(wav_file_path)            
-                    print(f"Duración del audio: {audio_Segment.duration_seconds}")                                          
-                    execution_time_file.write(f"{rttm_filename} {combined_models_subfolder_name} {dataset_subfolder} {diarization_time} {audio_Segment.duration_seconds}\n")
-                    
-                for turn, _, speaker in diarization.itertracks(yield_label=True):                
-                    logger.debug(f'start={turn.start:.1f}s stop={turn.end:.1f}s speaker_{speaker}')
-                    print(f"start={turn.start:.1f}s stop={turn.end:.1f}s speaker_{speaker}")
-                logger.info(f'FIN de la diarización por Pyannote del audio {wav_file_path}.') # Imprime al archivo de logging el fin de la diarización de uno de los archivos   
-                print(f'FIN de la diarización por Pyannote del audio {wav_file_path}.')       # Imprime a stdout el fin de la diarización de uno de los archivos   
-                save_status(f'FIN de la diarizacion por Pyannote del audio {wav_file_path}.') # Imprime al archivo de estado el fin de la diarización de uno de los archivos, 
-                            # este archivo es la manera que tiene el gestor de contenedores de saber que ha terminado la ejecución del script.  
+        if args.clustering_grid:
+            grid = load_clustering_grid(args.clustering_grid, {"threshold_cluster": args.threshold_cluster, "method_cluster": args.method_cluster,
+                                                     "min_cluster_size": args.min_cluster_size, "min_duration_off": args.min_duration_off})
+            print(f'Barrido de {len(grid)} combinaciones de hiperparámetros del clustering')
+            logger.info(f'Barrido de {len(grid)} combinaciones de hiperparámetros del clustering')
+            pipeline = load_pipeline(args.segmentation_model, args.speaker_model, args.huggingface_token, device, embedding_cache_path,
+                                     args.quantize_segmentation)
+            sweep_clustering(pipeline, args.volume_path, args.segmentation_model, combined_models_subfolder_name, grid,
+                             args.num_speakers, result_cache, not args.append_exec_time, args.batch_segmentation_files, args.segmentation_batch_size,
+                             args.long_audio_block, args.long_audio_overlap)
+        elif args.workers > 1:
+            diarize_dataset_parallel(args.workers, args.segmentation_model, args.speaker_model, args.huggingface_token, pipeline_params,
+                                     args.volume_path, combined_models_subfolder_name, args.num_speakers, None, result_cache, cache_params,
+                                     embedding_cache_path, not args.append_exec_time, args.quantize_segmentation, args.long_audio_block,
+                                     args.long_audio_overlap, args.batch_segmentation_files, args.segmentation_batch_size)
+        else:
+            pipeline = load_pipeline(args.segmentation_model, args.speaker_model, args.huggingface_token, device, embedding_cache_path,
+                                     args.quantize_segmentation)
+            pipeline.instantiate(pipeline_params)
+            diarize_dataset(pipeline, args.volume_path, combined_models_subfolder_name, args.num_speakers, None, result_cache, cache_params,
+                            not args.append_exec_time, args.batch_segmentation_files, args.segmentation_batch_size, args.long_audio_block,
+                            args.long_audio_overlap)
+        if args.chrome_trace:
+            trace_path = write_chrome_trace(os.path.join(args.volume_path, "rttm", CHROME_TRACE_FILE),
+                                            load_stage_times(os.path.join(args.volume_path, "rttm", STAGE_TIME_FILE)))
+            print(f'Traza de Chrome de las etapas escrita en {trace_path}')
+            logger.info(f'Traza de Chrome de las etapas escrita en {trace_path}')
         logger.info(f'pyannote/{pipeline_version} FIN\n')
         print(f'pyannote/{pipeline_version} FIN\n')
         save_status(FIN)   
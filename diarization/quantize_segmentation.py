@@ -0,0 +1,74 @@
+## Cuantización dinámica int8 del modelo de segmentación (PyanNet: SincNet -> BiLSTM -> capas lineales) para inferencia en CPU.
+# Las LSTM y las capas lineales, que son casi todo el cómputo, pasan a pesos int8 con activaciones cuantizadas al vuelo
+# (torch.ao.quantization.quantize_dynamic); SincNet y las convoluciones se quedan en float. El modelo sigue siendo un
+# `pyannote.audio.Model`, así que la pipeline lo usa igual que el original (pyannote_pipeline.py --quantize_segmentation).
+#
+# Ejecutado como script compara el modelo cuantizado con el float sobre audios del volumen: la diferencia media de las salidas
+# por frame y el DER de la diarización cuantizada tomando como referencia la float. Termina con error si alguna supera su tolerancia.
+import argparse
+import copy
+import os
+import torch
+
+QUANTIZED_SUFFIX = "-int8"  # Sufijo del modelo de segmentación en la carpeta de salida, para no mezclar resultados con los del float
+FRAME_TOLERANCE = 0.02      # Diferencia media máxima de las salidas por frame (con salidas binarias, fracción de frames que cambian)
+DER_TOLERANCE = 0.02        # DER máximo de la diarización cuantizada respecto de la float
+
+
+def quantize_segmentation_model(segmentation_model):
+    quantized_model = copy.deepcopy(segmentation_model).to(torch.device('cpu')).eval()
+    return torch.ao.quantization.quantize_dynamic(quantized_model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8)
+
+## Diferencia media de las salidas por frame de ambos modelos en cada audio, con la misma ventana deslizante de la pipeline
+def compare_frame_outputs(float_model, quantized_model, audio_files):
+    from pyannote.audio import Inference
+    float_inference = Inference(float_model, skip_aggregation=True, device=torch.device('cpu'))
+    quantized_inference = Inference(quantized_model, skip_aggregation=True, device=torch.device('cpu'))
+    differences = {}
+    for audio_file in audio_files:
+        float_output = float_inference(audio_file).data
+        quantized_output = quantized_inference(audio_file).data
+        differences[audio_file] = float(abs(float_output - quantized_output).mean())
+    return differences
+
+## DER de la diarización con el modelo cuantizado tomando como referencia la del modelo float, por audio
+def compare_diarizations(float_pipeline, quantized_pipeline, audio_files):
+    from pyannote.metrics.diarization import DiarizationErrorRate
+    ders = {}
+    for audio_file in audio_files:
+        ders[audio_file] = DiarizationErrorRate()(float_pipeline(audio_file), quantized_pipeline(audio_file))
+    return ders
+
+
+if __name__ == '__main__':
+    from pyannote_pipeline import PATH_BASE_DATASETS, build_pipeline_params, load_pipeline, load_segmentation_model
+    from dataset_scan import scan_by_extension
+    parser = argparse.ArgumentParser(description='Comprueba la cuantización int8 del modelo de segmentación de Pyannote')
+    parser.add_argument('-hft', '--huggingface_token', type=str, help="Token de Huggingface")
+    parser.add_argument('-sem', '--segmentation_model', type=str, default='pyannote/segmentation-3.0', help="Modelo de segmentacion")
+    parser.add_argument('-sm', '--speaker_model', type=str, default='pyannote/embedding', help="Modelo de embedding o del hablante")
+    parser.add_argument('-vp', '--volume_path', type=str, help='Carpeta del volumen, con los audios en datasets')
+    parser.add_argument('-n', '--num_files', type=int, default=5, help='Número de audios del volumen con los que se compara')
+    parser.add_argument('-ft', '--frame_tolerance', type=float, default=FRAME_TOLERANCE, help='Diferencia media máxima de las salidas por frame')
+    parser.add_argument('-dt', '--der_tolerance', type=float, default=DER_TOLERANCE, help='DER máximo de la diarización cuantizada respecto de la float')
+    args = parser.parse_args()
+
+    datasets_path = os.path.join(args.volume_path, PATH_BASE_DATASETS)
+    audio_files = [os.path.join(datasets_path, dataset, wav_audio_file) if dataset != PATH_BASE_DATASETS else os.path.join(datasets_path, wav_audio_file)
+                   for wav_audio_file, dataset in scan_by_extension(datasets_path, ".wav")][:args.num_files]
+    float_model = load_segmentation_model(args.segmentation_model, args.huggingface_token)
+    quantized_model = quantize_segmentation_model(float_model)
+    frame_differences = compare_frame_outputs(float_model, quantized_model, audio_files)
+
+    pipeline_params = build_pipeline_params(args.segmentation_model, 0.0, 'centroid', 12, 0.7045654963945799)
+    float_pipeline = load_pipeline(args.segmentation_model, args.speaker_model, args.huggingface_token, torch.device('cpu')).instantiate(pipeline_params)
+    quantized_pipeline = load_pipeline(args.segmentation_model, args.speaker_model, args.huggingface_token, torch.device('cpu'),
+                                       quantize_segmentation=True).instantiate(pipeline_params)
+    ders = compare_diarizations(float_pipeline, quantized_pipeline, audio_files)
+
+    failed = False
+    for audio_file in audio_files:
+        ok = frame_differences[audio_file] <= args.frame_tolerance and ders[audio_file] <= args.der_tolerance
+        failed = failed or not ok
+        print(f"{'OK ' if ok else 'MAL'} {audio_file}: diferencia por frame {frame_differences[audio_file]:.4f}, DER respecto del float {ders[audio_file]:.4f}")
+    exit(1 if failed else 0)
@@ -0,0 +1,197 @@
+## Muestreo de los recursos (CPU, memoria y E/S de bloque) que usa cada contenedor mientras ejecuta un comando del gestor de Docker.
+# Un hilo lee el stream de estadísticas de la API de Docker (`container.stats(stream=True, decode=True)`, una muestra por segundo)
+# o cualquier otro iterable de diccionarios con su mismo formato, p. ej. `proc_stats_stream` para un proceso local sin Docker.
+# Al terminar, cada muestra se atribuye al archivo que se estaba diarizando: por los intervalos de sus registros de etapas
+# (stage_timing) o, si no los hay, por el archivo de estado, que cambia al terminar cada audio. Por archivo se guardan el pico de
+# memoria, los segundos de CPU y la E/S de bloque en `<PIPELINE>_resources.csv`, que metrics.py une a la tabla junto al RTF.
+import csv
+import os
+import re
+import threading
+import time
+from exec_time_log import csv_line, MODEL_LOAD
+
+RESOURCE_SAMPLE_FIELDS = ["timestamp", "container", "cpu_percent", "cpu_seconds", "memory_bytes", "block_read_bytes", "block_write_bytes", "status"]
+RESOURCE_USAGE_FIELDS = ["rttm_file", "combination", "dataset", "peak_memory_mb", "cpu_seconds", "block_read_mb", "block_write_mb", "samples"]
+SAMPLE_INTERVAL = 1.0
+PATH_BASE_DATASETS = "datasets"
+STATUS_AUDIO_PATTERN = re.compile(r"del audio (.+?)\.?$")  # Ruta del audio en "FIN de la diarizacion por <pipeline> del audio <ruta>."
+
+
+def resource_usage_file_path(rttm_path, pipeline_name):
+    return os.path.join(rttm_path, f"{pipeline_name}_resources.csv")
+
+def resource_samples_file_path(rttm_path, pipeline_name):
+    return os.path.join(rttm_path, f"{pipeline_name}_resource_samples.csv")
+
+
+## Convierte una muestra de la API de estadísticas de Docker en los valores que se guardan. El % de CPU se calcula como `docker stats`:
+# uso de CPU del contenedor entre el del sistema desde la muestra anterior (precpu_stats), por el número de CPUs
+def parse_docker_stats(stats):
+    cpu_stats, precpu_stats = stats.get("cpu_stats") or {}, stats.get("precpu_stats") or {}
+    total_usage = (cpu_stats.get("cpu_usage") or {}).get("total_usage", 0)
+    previous_usage = (precpu_stats.get("cpu_usage") or {}).get("total_usage", 0)
+    system_delta = cpu_stats.get("system_cpu_usage", 0) - precpu_stats.get("system_cpu_usage", 0)
+    online_cpus = cpu_stats.get("online_cpus") or len((cpu_stats.get("cpu_usage") or {}).get("percpu_usage") or []) or 1
+    cpu_percent = (total_usage - previous_usage) / system_delta * online_cpus * 100 if system_delta > 0 and previous_usage else 0.0
+    memory_stats = stats.get("memory_stats") or {}
+    # Como `docker stats`, sin la caché de páginas (cgroup v1: cache, cgroup v2: inactive_file)
+    page_cache = (memory_stats.get("stats") or {}).get("cache", (memory_stats.get("stats") or {}).get("inactive_file", 0))
+    block_entries = (stats.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []
+    return {"cpu_percent": cpu_percent, "cpu_seconds": total_usage / 1e9, "memory_bytes": max(memory_stats.get("usage", 0) - page_cache, 0),
+            "block_read_bytes": sum(entry.get("value", 0) for entry in block_entries if str(entry.get("op", "")).lower() == "read"),
+            "block_write_bytes": sum(entry.get("value", 0) for entry in block_entries if str(entry.get("op", "")).lower() == "write")}
+
+## Estadísticas con el formato de la API de Docker para un proceso local (Linux, /proc), sustituto del contenedor sin Docker
+def proc_stats_stream(pid=None, interval=SAMPLE_INTERVAL):
+    pid = pid or os.getpid()
+    ticks, page_size, cpus = os.sysconf("SC_CLK_TCK"), os.sysconf("SC_PAGE_SIZE"), os.cpu_count() or 1
+    previous = {}
+    while os.path.exists(f"/proc/{pid}"):
+        try:
+            with open(f"/proc/{pid}/stat", 'r') as stat_file:
+                fields = stat_file.read().rsplit(')', 1)[1].split()
+            with open("/proc/stat", 'r') as system_stat_file:
+                system_jiffies = sum(int(value) for value in system_stat_file.readline().split()[1:])
+            with open(f"/proc/{pid}/statm", 'r') as statm_file:
+                resident_bytes = int(statm_file.read().split()[1]) * page_size
+            io = {}
+            if os.access(f"/proc/{pid}/io", os.R_OK):
+                with open(f"/proc/{pid}/io", 'r') as io_file:
+                    io = dict((key, int(value)) for key, value in (line.split(':') for line in io_file))
+        except (OSError, ValueError, IndexError):
+            return
+        cpu_stats = {"cpu_usage": {"total_usage": (int(fields[11]) + int(fields[12])) * 1e9 / ticks},
+                     "system_cpu_usage": system_jiffies * 1e9 / ticks, "online_cpus": cpus}
+        yield {"cpu_stats": cpu_stats, "precpu_stats": previous, "memory_stats": {"usage": resident_bytes},
+               "blkio_stats": {"io_service_bytes_recursive": [{"op": "read", "value": io.get("read_bytes", 0)},
+                                                              {"op": "write", "value": io.get("write_bytes", 0)}]}}
+        previous = cpu_stats
+        time.sleep(interval)
+
+
+class ContainerResourceSampler():
+
+    ## `stats_stream`: iterable de estadísticas con el formato de Docker. `status_path`: archivo de estado de la pipeline en el host
+    def __init__(self, container_name, stats_stream, status_path=None, interval=SAMPLE_INTERVAL):
+        self.container_name = container_name
+        self.stats_stream = stats_stream
+        self.status_path = status_path
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def docker_stats_stream(container):
+        return container.stats(stream=True, decode=True)
+
+    def _read_status(self):
+        if self.status_path is None or not os.path.exists(self.status_path):
+            return ''
+        try:
+            with open(self.status_path, 'r', encoding="utf-8") as status_file:
+                return status_file.read().strip()
+        except OSError:
+            return ''
+
+    def _sample(self):
+        last_time = 0.0
+        try:
+            for stats in self.stats_stream:
+                if self._stop.is_set():
+                    break
+                now = time.time()
+                if now - last_time < self.interval * 0.9:
+                    continue
+                last_time = now
+                self.samples.append(dict(parse_docker_stats(stats), timestamp=now, container=self.container_name, status=self._read_status()))
+        except Exception:
+            return  # El stream se cierra al detener el contenedor
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    ## El stream de Docker sólo avanza con cada muestra, así que se espera como mucho un par de intervalos a que el hilo acabe
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2 * self.interval + 1)
+        return self.samples
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+
+## Archivo (rttm, combinación, dataset) del audio del texto de estado, con la combinación del registro de tiempos de ejecución
+def _file_from_status(status, exec_times):
+    match = STATUS_AUDIO_PATTERN.search(status)
+    if match is None:
+        return None
+    wav_file_path = os.path.normpath(match.group(1))
+    rttm_file, dataset = os.path.basename(wav_file_path).replace('.wav', '.rttm'), os.path.basename(os.path.dirname(wav_file_path))
+    if dataset == PATH_BASE_DATASETS:
+        dataset = '.'  # Audio directamente en la carpeta de datasets, como lo registran las pipelines
+    combinations = [combination for file, combination, file_dataset in exec_times if file == rttm_file and file_dataset == dataset]
+    return (rttm_file, combinations[-1] if combinations else '', dataset)
+
+## Atribuye las muestras a los archivos y acumula por archivo: pico de memoria, y CPU y E/S desde la muestra anterior.
+# Una muestra es de un archivo si cae en el intervalo de sus etapas; si no, es del audio que aparece en el siguiente estado distinto
+# (el estado cambia al terminar cada audio, así que mientras muestra el anterior se está diarizando el siguiente).
+def attribute_samples(samples, stage_records, exec_times=None):
+    intervals = {}
+    for record in stage_records:
+        if record["rttm_file"] == MODEL_LOAD:
+            continue
+        key = (record["rttm_file"], record["combination"], record["dataset"])
+        start, end = intervals.get(key, (record["start"], record["start"]))
+        intervals[key] = (min(start, record["start"]), max(end, record["start"] + record["stage_time"]))
+    statuses = list(dict.fromkeys(sample["status"] for sample in samples))
+    next_status = dict(zip(statuses, statuses[1:]))
+    usage = {}
+    previous = None
+    for sample in samples:
+        key = next((key for key, (start, end) in intervals.items() if start <= sample["timestamp"] <= end), None)
+        if key is None and sample["status"] in next_status:
+            key = _file_from_status(next_status[sample["status"]], exec_times or {})
+        if key is not None:
+            file_usage = usage.setdefault(key, {"peak_memory_mb": 0.0, "cpu_seconds": 0.0, "block_read_mb": 0.0, "block_write_mb": 0.0, "samples": 0})
+            file_usage["peak_memory_mb"] = max(file_usage["peak_memory_mb"], sample["memory_bytes"] / 2**20)
+            if previous is not None:
+                file_usage["cpu_seconds"] += max(sample["cpu_seconds"] - previous["cpu_seconds"], 0.0)
+                file_usage["block_read_mb"] += max(sample["block_read_bytes"] - previous["block_read_bytes"], 0) / 2**20
+                file_usage["block_write_mb"] += max(sample["block_write_bytes"] - previous["block_write_bytes"], 0) / 2**20
+            file_usage["samples"] += 1
+        previous = sample
+    return usage
+
+def write_resource_samples(log_path, samples, append=False):
+    _write_csv(log_path, RESOURCE_SAMPLE_FIELDS, ([sample[field] for field in RESOURCE_SAMPLE_FIELDS] for sample in samples), append)
+
+def write_resource_usage(log_path, usage, append=False):
+    _write_csv(log_path, RESOURCE_USAGE_FIELDS, (list(key) + [file_usage[field] for field in RESOURCE_USAGE_FIELDS[3:]]
+                                                 for key, file_usage in usage.items()), append)
+
+def _write_csv(log_path, fields, rows, append):
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, "a" if append else "w", encoding="utf-8", newline="") as log_file:
+        records = "".join(csv_line(row) for row in rows)
+        if log_file.tell() == 0:
+            records = csv_line(fields) + records
+        log_file.write(records)
+
+## Devuelve {(archivo RTTM, combinación, dataset): (pico de memoria en MB, segundos de CPU)}; si un archivo aparece varias veces
+# vale su último registro
+def load_resource_usage(log_path):
+    resource_usage = {}
+    if os.path.exists(log_path):
+        with open(log_path, "r", encoding="utf-8", newline="") as log_file:
+            for row in csv.DictReader(log_file):
+                resource_usage[(row["rttm_file"], row["combination"], row["dataset"])] = (float(row["peak_memory_mb"]), float(row["cpu_seconds"]))
+    return resource_usage
@@ -0,0 +1,81 @@
+## Caché de resultados de diarización direccionada por contenido, común a las pipelines de Pyannote y de NeMo.
+# La clave combina el hash del contenido del audio, la combinación de modelos (`combined_models_subfolder_name`) y los
+# parámetros de la pipeline, de modo que un audio ya diarizado con la misma configuración no se vuelve a procesar aunque
+# cambie de nombre o de dataset: se reutilizan su RTTM y el tiempo de ejecución que se registró entonces.
+import hashlib
+import json
+import os
+
+CACHE_FOLDER = "cache"
+HASH_INDEX_FILE = "audio_hashes.json"
+HASH_BLOCK_SIZE = 1 << 20
+
+
+class ResultCache:
+
+    def __init__(self, volume_path, pipeline_name):
+        self.cache_path = os.path.join(volume_path, CACHE_FOLDER, pipeline_name)
+        os.makedirs(self.cache_path, exist_ok=True)
+        # Índice ruta -> (tamaño, fecha de modificación, hash) para no volver a leer audios que no han cambiado. Cada pipeline tiene
+        # el suyo, porque sus contenedores pueden estar escribiéndolo a la vez (--parallel)
+        self.hash_index_path = os.path.join(self.cache_path, HASH_INDEX_FILE)
+        self.hash_index = {}
+        self._hash_index_changed = False
+        if os.path.exists(self.hash_index_path):
+            with open(self.hash_index_path, 'r', encoding="utf-8") as index_file:
+                self.hash_index = json.load(index_file)
+
+    def content_hash(self, file_path):
+        stat = os.stat(file_path)
+        indexed = self.hash_index.get(file_path)
+        if indexed is not None and indexed[0] == stat.st_size and indexed[1] == stat.st_mtime:
+            return indexed[2]
+        sha = hashlib.sha256()
+        with open(file_path, 'rb') as audio_file:
+            for block in iter(lambda: audio_file.read(HASH_BLOCK_SIZE), b''):
+                sha.update(block)
+        self.hash_index[file_path] = [stat.st_size, stat.st_mtime, sha.hexdigest()]
+        self._hash_index_changed = True
+        return sha.hexdigest()
+
+    ## Guarda el índice de hashes si ha cambiado; las pipelines lo llaman una vez por lote de archivos, no por cada hash nuevo
+    def save_hash_index(self):
+        if not self._hash_index_changed:
+            return
+        tmp_path = self.hash_index_path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding="utf-8") as index_file:
+            json.dump(self.hash_index, index_file)
+        os.replace(tmp_path, self.hash_index_path)
+        self._hash_index_changed = False
+
+    def key(self, wav_file_path, combined_models_subfolder_name, params:dict):
+        description = json.dumps({"audio": self.content_hash(wav_file_path), "models": combined_models_subfolder_name, "params": params},
+                                 sort_keys=True, default=str)
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    ## Devuelve el registro (tiempo de ejecución y duración) de la clave si está en caché, o None
+    def get(self, key):
+        record_path = os.path.join(self.cache_path, key + ".json")
+        if not os.path.exists(record_path) or not os.path.exists(os.path.join(self.cache_path, key + ".rttm")):
+            return None
+        with open(record_path, 'r', encoding="utf-8") as record_file:
+            return json.load(record_file)
+
+    ## Copia el RTTM de la caché a su carpeta de salida, sustituyendo el identificador del archivo (uri) por el del audio actual
+    def restore(self, key, rttm_path, uri):
+        os.makedirs(os.path.dirname(rttm_path), exist_ok=True)
+        with open(os.path.join(self.cache_path, key + ".rttm"), 'r', encoding="utf-8") as cached_file, \
+                open(rttm_path, 'w', encoding="utf-8") as rttm_file:
+            for line in cached_file:
+                fields = line.split(' ')
+                if len(fields) > 1:
+                    fields[1] = uri
+                rttm_file.write(' '.join(fields))
+
+    def put(self, key, rttm_path, diarization_time, duration):
+        with open(rttm_path, 'r', encoding="utf-8") as rttm_file, \
+                open(os.path.join(self.cache_path, key + ".rttm.tmp"), 'w', encoding="utf-8") as cached_file:
+            cached_file.write(rttm_file.read())
+        os.replace(os.path.join(self.cache_path, key + ".rttm.tmp"), os.path.join(self.cache_path, key + ".rttm"))
+        with open(os.path.join(self.cache_path, key + ".json"), 'w', encoding="utf-8") as record_file:
+            json.dump({"diarization_time": diarization_time, "duration": duration}, record_file)
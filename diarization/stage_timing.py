@@ -0,0 +1,139 @@
+## Tiempos por etapa de la diarización (`<PIPELINE>_stage_times.csv` en la carpeta de RTTM), junto al tiempo total por archivo de
+# exec_time_log. En Pyannote las etapas salen de las llamadas de la pipeline al hook de progreso (segmentación, recuento de hablantes,
+# embeddings y clustering) y en NeMo de envolver las fases del ClusteringDiarizer (carga de modelos, VAD, segmentación, embeddings
+# y clustering). Cada archivo escribe todas sus etapas con una única escritura en modo append, como el registro de tiempos.
+# Con los registros se puede generar una traza de Chrome (chrome://tracing o Perfetto) y metrics.py calcula el RTF por etapa.
+import contextlib
+import csv
+import functools
+import json
+import os
+import time
+from exec_time_log import csv_line
+
+STAGE_TIME_FIELDS = ["rttm_file", "combination", "dataset", "stage", "start", "stage_time", "duration"]
+MODEL_LOAD_STAGE = "model_load"
+OTHER_STAGE = "other"   # Tiempo entre las etapas medidas (preparación, escritura de resultados...)
+MIN_SPAN = 1e-3         # Los huecos más cortos no se registran como etapa
+
+# Fases del ClusteringDiarizer de NeMo: métodos del diarizador y funciones del módulo clustering_diarizer
+NEMO_STAGE_METHODS = {"_perform_speech_activity_detection": "vad", "_run_segmentation": "segmentation", "_extract_embeddings": "embeddings"}
+NEMO_STAGE_FUNCTIONS = {"perform_clustering": "clustering"}
+
+
+def stage_time_file_path(rttm_path, pipeline_name):
+    return os.path.join(rttm_path, f"{pipeline_name}_stage_times.csv")
+
+
+## Intervalos [etapa, inicio, fin] (segundos de época) de la diarización de un archivo. Dos intervalos seguidos de la misma etapa
+# se unen en uno.
+class StageTimer():
+
+    def __init__(self):
+        self.spans = []
+        self._last = time.time()
+
+    def add(self, stage, start, end):
+        if end <= start:
+            return
+        if self.spans and self.spans[-1][0] == stage and start - self.spans[-1][2] < MIN_SPAN:
+            self.spans[-1][2] = end
+        else:
+            self.spans.append([stage, start, end])
+        self._last = max(self._last, end)
+
+    ## El tiempo desde el último intervalo registrado se atribuye a `stage`
+    def mark(self, stage):
+        now = time.time()
+        if now - self._last >= MIN_SPAN:
+            self.add(stage, self._last, now)
+        self._last = now
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        self.mark(OTHER_STAGE)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, start, time.time())
+
+    def totals(self):
+        totals = {}
+        for stage, start, end in self.spans:
+            totals[stage] = totals.get(stage, 0.0) + end - start
+        return totals
+
+
+def append_stage_times(log_path, rttm_file, combination, dataset, spans, duration):
+    if not spans:
+        return
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, "a", encoding="utf-8", newline="") as log_file:
+        records = "".join(csv_line([rttm_file, combination, dataset, stage, start, end - start, duration]) for stage, start, end in spans)
+        if log_file.tell() == 0:
+            records = csv_line(STAGE_TIME_FIELDS) + records
+        log_file.write(records)
+
+def remove_stage_times(log_path):
+    if os.path.exists(log_path):
+        os.remove(log_path)
+
+## Registros de etapas como diccionarios con los tiempos en float. Si un archivo se diarizó varias veces vale su última escritura
+# (las filas de una escritura van seguidas).
+def load_stage_times(log_path):
+    if not os.path.exists(log_path):
+        return []
+    records, previous_key = {}, None
+    with open(log_path, "r", encoding="utf-8", newline="") as log_file:
+        for row in csv.DictReader(log_file):
+            key = (row["rttm_file"], row["combination"], row["dataset"])
+            if key != previous_key:
+                records[key] = []
+                previous_key = key
+            records[key].append(dict(row, start=float(row["start"]), stage_time=float(row["stage_time"]), duration=float(row["duration"] or 0)))
+    return [record for key_records in records.values() for record in key_records]
+
+## Traza de Chrome con un evento completo ("X") por etapa: un proceso por combinación de modelos y un hilo por archivo
+def write_chrome_trace(trace_path, stage_records):
+    process_ids, thread_ids, events = {}, {}, []
+    for record in stage_records:
+        pid = process_ids.setdefault(record["combination"], len(process_ids) + 1)
+        tid = thread_ids.setdefault((pid, record["dataset"], record["rttm_file"]), len(thread_ids) + 1)
+        events.append({"name": record["stage"], "cat": record["combination"], "ph": "X", "ts": record["start"] * 1e6,
+                       "dur": record["stage_time"] * 1e6, "pid": pid, "tid": tid,
+                       "args": {"rttm_file": record["rttm_file"], "dataset": record["dataset"], "duration": record["duration"]}})
+    for combination, pid in process_ids.items():
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": combination}})
+    for (pid, dataset, rttm_file), tid in thread_ids.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": f"{dataset}/{rttm_file}"}})
+    with open(trace_path, "w", encoding="utf-8") as trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+    return trace_path
+
+
+def _timed(timer, stage, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with timer.span(stage):
+            return function(*args, **kwargs)
+    return wrapper
+
+## Mide con `timer` las fases de `diarizer.diarize()` mientras dura el bloque. Las fases que no existan en la versión de NeMo
+# instalada quedan dentro de "other".
+@contextlib.contextmanager
+def instrument_clustering_diarizer(diarizer, timer):
+    from nemo.collections.asr.models import clustering_diarizer
+    originals = {name: getattr(clustering_diarizer, name) for name in NEMO_STAGE_FUNCTIONS if hasattr(clustering_diarizer, name)}
+    methods = [name for name in NEMO_STAGE_METHODS if hasattr(diarizer, name)]
+    try:
+        for name in methods:
+            setattr(diarizer, name, _timed(timer, NEMO_STAGE_METHODS[name], getattr(diarizer, name)))
+        for name, function in originals.items():
+            setattr(clustering_diarizer, name, _timed(timer, NEMO_STAGE_FUNCTIONS[name], function))
+        yield diarizer
+    finally:
+        for name in methods:
+            delattr(diarizer, name)
+        for name, function in originals.items():
+            setattr(clustering_diarizer, name, function)
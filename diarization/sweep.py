@@ -0,0 +1,187 @@
+## Barrido (grid search) de combinaciones de modelos e hiperparámetros de las pipelines, lanzado desde main.py con --sweep_grid.
+# La rejilla es un YAML (o JSON) con una sección por contenedor y una sección `common` para ambos; cada clave es un parámetro
+# de main.py/DockerDiarizationManager con la lista de valores a probar (los nombres de modelos van completos), por ejemplo:
+#
+#   name: barrido_clustering
+#   common:
+#     min_duration_off: [0.0, 0.5]
+#   pyannote_pipeline:
+#     segmentation_model: [pyannote/segmentation-3.0]
+#     speaker_model_pyannote: [pyannote/embedding, pyannote/wespeaker-voxceleb-resnet34-LM]
+#     threshold_cluster: [0.6, 0.7045654963945799]
+#     method_cluster: [centroid, average]
+#   nemo_pipeline:
+#     vad_model: [oracle_vad, vad_multilingual_marblenet]
+#     window_lengths: ["[1.5]", "[1.5,1.0,0.5]"]
+#
+# Cada combinación se ejecuta con una etiqueta propia (`run_tag`), derivada de sus parámetros, que es el sufijo de su carpeta de RTTM,
+# y su estado se guarda en `<volumen>/sweeps/<name>.json` al terminar: si el barrido se interrumpe, al relanzarlo se saltan las
+# combinaciones ya completadas. Los contenedores ejecutan sus combinaciones a la vez, cada uno en su hilo, y al final se escribe
+# una única tabla de métricas con todas las combinaciones del barrido.
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+import pandas as pd
+from metrics import MetricsCalculator, read_metrics_csv, METRICS_COLUMNS, TOTAL_ROW
+
+PATH_SWEEPS = "sweeps"
+COMMON_SECTION = "common"
+# Parámetros de la línea de comandos que no cambian el resultado de una combinación (o son secretos) y no entran en su etiqueta
+RUN_TAG_EXCLUDED_PARAMS = {"huggingface_token", "workers", "batch_segmentation_files", "batch_mode"}
+
+
+def load_grid(grid_path):
+    with open(grid_path, 'r', encoding="utf-8") as grid_file:
+        if grid_path.lower().endswith(".json"):
+            return json.load(grid_file)
+        import yaml
+        return yaml.safe_load(grid_file)
+
+## Etiqueta estable de una combinación: no depende del orden de la rejilla, así que sobrevive a que se amplíe entre relanzamientos.
+# Entran también los parámetros base de la línea de comandos (modelos, número de hablantes...), que la rejilla completa: relanzar la
+# misma rejilla con otro modelo da combinaciones nuevas en lugar de saltarlas como ya completadas
+def get_run_tag(container_name, params:dict, base_params:dict=None):
+    merged_params = dict(base_params or {})
+    merged_params.update(params)
+    merged_params = {key: value for key, value in merged_params.items() if key not in RUN_TAG_EXCLUDED_PARAMS and value is not None}
+    description = json.dumps({"container": container_name, "params": merged_params}, sort_keys=True, default=str)
+    return "sw" + hashlib.sha1(description.encode("utf-8")).hexdigest()[:10]
+
+## Expande la rejilla en una lista de combinaciones (run_tag, parámetros) por contenedor
+def expand_grid(grid:dict, container_names, base_params_by_container:dict=None):
+    combinations = {}
+    common = grid.get(COMMON_SECTION) or {}
+    for container_name in container_names:
+        if container_name not in grid:
+            continue
+        section = dict(common)
+        section.update(grid[container_name] or {})
+        keys = sorted(section.keys())
+        values = [section[key] if isinstance(section[key], list) else [section[key]] for key in keys]
+        combinations[container_name] = []
+        for point in itertools.product(*values):
+            # Los parámetros se pasan como texto en la línea de comandos, salvo los indicadores booleanos
+            params = {key: (value if value is None or isinstance(value, bool) else str(value)) for key, value in zip(keys, point)}
+            combinations[container_name].append((get_run_tag(container_name, params, (base_params_by_container or {}).get(container_name)), params))
+    return combinations
+
+
+class SweepRunner():
+
+    def __init__(self, docker_manager, grid_path, host_volume_path, base_params_by_container:dict):
+        self.docker_manager = docker_manager
+        self.grid = load_grid(grid_path)
+        self.name = self.grid.get("name", os.path.splitext(os.path.basename(grid_path))[0])
+        self.host_volume_path = host_volume_path
+        self.base_params_by_container = base_params_by_container
+        self.logger = logging.getLogger(__name__)
+        self.state_path = os.path.join(host_volume_path, PATH_SWEEPS, self.name + ".json")
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        self.state_lock = threading.Lock()
+        self.state = {"name": self.name, "combinations": {}}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding="utf-8") as state_file:
+                self.state = json.load(state_file)
+
+    def _save_state(self):
+        with open(self.state_path + '.tmp', 'w', encoding="utf-8") as state_file:
+            json.dump(self.state, state_file, indent=2)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def _mark(self, run_tag, container_name, params, status):
+        with self.state_lock:
+            self.state["combinations"][run_tag] = {"container": container_name, "params": params, "status": status,
+                                                  "finished": datetime.now().isoformat(timespec='seconds')}
+            self._save_state()
+
+    ## Ejecuta en orden las combinaciones pendientes de un contenedor, sin pararlo entre una y otra. Si una falla,
+    # el gestor de contenedores ya ha parado el contenedor, así que se marca como fallida y se abandona el resto de su cola,
+    # que también queda marcada como fallida para que el estado del barrido recoja todas las combinaciones sin completar.
+    def _run_container_queue(self, container_name, pending:list):
+        for index, (run_tag, params) in enumerate(pending):
+            print(f"Barrido {self.name}: {container_name} {index + 1}/{len(pending)} ({run_tag}) {params}")
+            self.logger.info(f"Barrido {self.name}: {container_name} {index + 1}/{len(pending)} ({run_tag}) {params}")
+            command_params = dict(self.base_params_by_container.get(container_name, {}))
+            command_params.update(params)
+            command_params['run_tag'] = run_tag
+            command_params['append_exec_time'] = True
+            if container_name == "pyannote_pipeline":
+                # Las combinaciones que sólo cambian el clustering reutilizan la segmentación y los embeddings
+                command_params['cache_embeddings'] = True
+            try:
+                self.docker_manager.execute_command(container_name, command_params, stop_after=False)
+            except SystemExit:
+                print(f"Barrido {self.name}: ha fallado la combinación {run_tag} de {container_name}")
+                self.logger.error(f"Barrido {self.name}: ha fallado la combinación {run_tag} de {container_name}")
+                self._mark(run_tag, container_name, params, "failed")
+                for skipped_run_tag, skipped_params in pending[index + 1:]:
+                    print(f"Barrido {self.name}: no se ejecuta la combinación {skipped_run_tag} de {container_name} tras el fallo de {run_tag}")
+                    self.logger.warning(f"Barrido {self.name}: no se ejecuta la combinación {skipped_run_tag} de {container_name} tras el fallo de {run_tag}")
+                    self._mark(skipped_run_tag, container_name, skipped_params, "failed")
+                return
+            self._mark(run_tag, container_name, params, "done")
+
+    def run(self):
+        # Los tiempos de ejecución se añaden a los registros existentes (append_exec_time): cada combinación escribe con su run_tag,
+        # así que no se mezcla con otras ejecuciones ni hace falta borrar sus tiempos
+        combinations = expand_grid(self.grid, self.docker_manager.containers.keys(), self.base_params_by_container)
+        pending_by_container = {}
+        for container_name, container_combinations in combinations.items():
+            pending_by_container[container_name] = [(run_tag, params) for run_tag, params in container_combinations
+                                                    if self.state["combinations"].get(run_tag, {}).get("status") != "done"]
+            done = len(container_combinations) - len(pending_by_container[container_name])
+            print(f"Barrido {self.name}: {container_name} tiene {len(container_combinations)} combinaciones, {done} ya completadas")
+            self.logger.info(f"Barrido {self.name}: {container_name} tiene {len(container_combinations)} combinaciones, {done} ya completadas")
+        threads = [threading.Thread(target=self._run_container_queue, args=(container_name, pending), daemon=True)
+                   for container_name, pending in pending_by_container.items() if pending]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for container_name in pending_by_container:
+            self.docker_manager.stop_if_running(self.docker_manager.containers[container_name].name)
+        run_tags = [run_tag for container_combinations in combinations.values() for run_tag, _ in container_combinations]
+        failed = [run_tag for run_tag in run_tags if self.state["combinations"].get(run_tag, {}).get("status") != "done"]
+        if failed:
+            print(f"Barrido {self.name}: {len(failed)} combinaciones sin completar, se pueden relanzar con el mismo --sweep_grid")
+            self.logger.warning(f"Barrido {self.name}: {len(failed)} combinaciones sin completar, se pueden relanzar con el mismo --sweep_grid")
+        return run_tags
+
+    ## Calcula las métricas de todos los RTTM y escribe la tabla consolidada del barrido: una fila por combinación con sus
+    # parámetros y las métricas del corpus, acumuladas sobre todos sus audios, datasets y carpetas de combinación.
+    # El detalle por audio queda en `<name>.csv` y `<name>.xlsx`.
+    def write_consolidated_metrics(self, run_tags, hypotheses_path, reference_path, metrics_list, collar, skip_overlap):
+        metrics_calc = MetricsCalculator(hypotheses_path=hypotheses_path, reference_path=reference_path, metrics_list=metrics_list,
+                                         out_met_filename=self.name, collar=collar, skip_overlap=skip_overlap)
+        metrics_df = read_metrics_csv(metrics_calc.calculate_and_write_metrics())
+        metrics_df = metrics_df[metrics_df["Run Tag"].isin(run_tags)]
+        audios = metrics_df[metrics_df["Audios"] != TOTAL_ROW]["Run Tag"].value_counts().to_dict()
+        # Con NeMo una combinación puede repartirse en dos carpetas (si falta la referencia para Oracle VAD se usa MarbleNet):
+        # se acumulan los componentes de todas sus carpetas y datasets en una sola métrica, como las filas ALL
+        metrics = [metric.strip() for metric in metrics_calc.metrics_list.split(',')]
+        run_tag_of = lambda combined_model_subfolder, pipeline: '__'.join(combined_model_subfolder.split('__')[2:]) or None
+        run_tag_metrics = {run_tag: metrics_map for run_tag, metrics_map in metrics_calc.grouped_corpus_metrics(metrics, run_tag_of).items()
+                           if run_tag in run_tags}
+        if not run_tag_metrics:
+            print(f"Barrido {self.name}: no hay métricas de ninguna combinación")
+            self.logger.warning(f"Barrido {self.name}: no hay métricas de ninguna combinación")
+            return None
+        metric_columns = [column for column in metrics_df.columns if column not in METRICS_COLUMNS]
+        summary_df = pd.DataFrame([{"Run Tag": run_tag, "Pipeline": self.state["combinations"][run_tag]["container"],
+                                    "Audios": audios.get(run_tag, 0), **{column: metrics_map.get(column, 'NA') for column in metric_columns}}
+                                   for run_tag, metrics_map in sorted(run_tag_metrics.items())]).set_index("Run Tag")
+        params_df = pd.DataFrame([{"Run Tag": run_tag, **self.state["combinations"][run_tag]["params"]}
+                                  for run_tag in summary_df.index]).set_index("Run Tag")
+        summary_df = summary_df.join(params_df).reset_index()
+        metrics_path = os.path.join(hypotheses_path, os.path.pardir, "metrics")
+        os.makedirs(metrics_path, exist_ok=True)
+        export_path = os.path.join(metrics_path, self.name + "_summary.xlsx")
+        summary_df.to_excel(export_path, index=False)
+        print(f"Barrido {self.name}: tabla consolidada de métricas en {export_path}")
+        self.logger.info(f"Barrido {self.name}: tabla consolidada de métricas en {export_path}")
+        return export_path